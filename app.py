@@ -1,9 +1,11 @@
 import os
+import hmac
 import json
 import logging
 import re
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from flask import Flask, request, abort, jsonify
+from flask import Flask, Response, request, abort, jsonify
 from dotenv import load_dotenv  
 from linebot.v3 import WebhookHandler
 from linebot.v3.messaging import Configuration, ApiClient, MessagingApi
@@ -14,22 +16,51 @@ from linebot.v3.messaging import (
 from linebot.v3.exceptions import InvalidSignatureError
 from google.protobuf.json_format import MessageToDict
 
-from retriever import search_from_documents
-from dialogflow import detect_intent_texts
+# โหลด environment variables จากไฟล์ .env (ก่อน import โมดูลที่อ่านค่า config)
+load_dotenv()
+
+import metrics
+from tracing import trace
+from retriever import (
+    search_from_documents, retrieve_documents, speculative_answer, preload,
+    reload_index, index_status
+)
+from ollama_client import start_prewarm, health as llm_health
+from dialogflow import detect_intent_texts, init_sessions_client
 from message import (
     process_payload, create_flex_message,
     send_multiple_messages, send_text_message,
-    prepend_bot_name_for_group
+    prepend_bot_name_for_group, push_messages,
+    get_push_target, is_reply_token_fresh
 )
-
-# โหลด environment variables จากไฟล์ .env
-load_dotenv()
+from speculative import SpeculativeTask
+from work_queue import WorkQueue
 
 # ตรวจสอบและกำหนดค่าตัวแปรสภาพแวดล้อมที่จำเป็น
 GOOGLE_APPLICATION_CREDENTIALS = os.getenv("GOOGLE_APPLICATION_CREDENTIALS")
 DIALOGFLOW_PROJECT_ID = os.getenv("DIALOGFLOW_PROJECT_ID")
 LINE_CHANNEL_ACCESS_TOKEN = os.getenv("LINE_CHANNEL_ACCESS_TOKEN")
 LINE_CHANNEL_SECRET = os.getenv("LINE_CHANNEL_SECRET")
+# ปลายทางของ LINE Messaging API (ชี้ไปที่ stub ได้ตอน load test)
+LINE_API_ENDPOINT = os.getenv("LINE_API_ENDPOINT", "https://api.line.me")
+
+# โหมด webhook แบบ async: ตอบ OK ให้ LINE ทันทีแล้วประมวลผลใน worker
+ASYNC_WEBHOOK = os.getenv("ASYNC_WEBHOOK", "false").lower() == "true"
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", "4"))
+WEBHOOK_QUEUE_SIZE = int(os.getenv("WEBHOOK_QUEUE_SIZE", "100"))
+WEBHOOK_ENQUEUE_TIMEOUT = float(os.getenv("WEBHOOK_ENQUEUE_TIMEOUT", "0.5"))
+# reply token ใช้ได้ไม่นาน หากเกินเวลานี้จะเปลี่ยนไปใช้ push message แทน
+REPLY_TOKEN_TTL = float(os.getenv("REPLY_TOKEN_TTL", "50"))
+# ส่งคำตอบจาก LLM ทีละช่วง: ช่วงแรกใช้ reply ที่เหลือส่งเป็น push message
+STREAM_RESPONSES = os.getenv("STREAM_RESPONSES", "false").lower() == "true"
+STREAM_PUSH_MIN_CHARS = int(os.getenv("STREAM_PUSH_MIN_CHARS", "200"))
+# ค้นหาเอกสารล่วงหน้าระหว่างรอ Dialogflow: off | retrieve (เฉพาะค้นหา) | full (ค้นหาและสร้างคำตอบด้วย LLM)
+SPECULATIVE_MODE = os.getenv("SPECULATIVE_MODE", "off").lower()
+SPECULATIVE_WORKERS = int(os.getenv("SPECULATIVE_WORKERS", "4"))
+# โหลด index และ encoder ตอนเริ่มระบบ (ใช้คู่กับ gunicorn --preload เพื่อแชร์หน่วยความจำระหว่าง worker)
+PRELOAD_RAG = os.getenv("PRELOAD_RAG", "false").lower() == "true"
+# token ของ endpoint ผู้ดูแล (/admin/...) ส่งใน header X-Admin-Token (ว่าง = ปิด endpoint)
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", "")
 
 # กำหนดค่า Config
 os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = GOOGLE_APPLICATION_CREDENTIALS
@@ -41,11 +72,34 @@ logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(
 logger = app.logger
 
 # Line Bot
-configuration = Configuration(access_token=LINE_CHANNEL_ACCESS_TOKEN)
+configuration = Configuration(host=LINE_API_ENDPOINT, access_token=LINE_CHANNEL_ACCESS_TOKEN)
 handler = WebhookHandler(LINE_CHANNEL_SECRET)
 api_client = ApiClient(configuration)
 line_bot_api = MessagingApi(api_client)
 
+# thread pool สำหรับงานที่เริ่มล่วงหน้า
+speculative_executor = ThreadPoolExecutor(
+    max_workers=SPECULATIVE_WORKERS, thread_name_prefix="speculative"
+) if SPECULATIVE_MODE in ("retrieve", "full") else None
+
+# สร้าง Dialogflow client ครั้งเดียวตอนเริ่มระบบ
+init_sessions_client()
+
+if PRELOAD_RAG:
+    preload()
+
+# โหลดโมเดลใน Ollama ล่วงหน้า (OLLAMA_PREWARM)
+start_prewarm()
+
+# คิวงานสำหรับโหมด async
+work_queue = WorkQueue(
+    workers=WEBHOOK_WORKERS,
+    max_size=WEBHOOK_QUEUE_SIZE,
+    enqueue_timeout=WEBHOOK_ENQUEUE_TIMEOUT
+) if ASYNC_WEBHOOK else None
+
+answers_total = metrics.counter("answers_total", "Replies by source")
+
 # คำตอบที่ไม่ต้องการจาก Dialogflow (หากได้คำตอบเหล่านี้จะถือว่า Dialogflow ไม่สามารถตอบคำถามได้)
 INVALID_DIALOGFLOW_RESPONSES = [
     "ขอโทษค่ะ พูดอีกครั้งได้ไหมคะ",
@@ -65,15 +119,124 @@ def callback():
     logger.info(f"ได้รับคำขอ: {body}")
 
     try:
-        handler.handle(body, signature)
+        if work_queue is None:
+            handler.handle(body, signature)
+        else:
+            # ตรวจสอบลายเซ็นแล้วส่ง event เข้าคิว ไม่รอการประมวลผล
+            for event in handler.parser.parse(body, signature):
+                if not work_queue.submit(dispatch_event, event):
+                    reply_busy(event)
     except InvalidSignatureError:
         logger.error("ลายเซ็นไม่ถูกต้อง")
         abort(400)
 
     return 'OK'
 
+@app.route("/stats", methods=['GET'])
+def stats():
+    """
+    แสดงค่า metrics ภายใน เช่น ความยาวคิวและเวลารอ
+    """
+    return jsonify(metrics.snapshot())
+
+@app.route("/metrics", methods=['GET'])
+def prometheus_metrics():
+    """
+    metrics ทั้งหมดในรูปแบบที่ Prometheus อ่านได้
+    """
+    return Response(metrics.render_prometheus(), content_type="text/plain; version=0.0.4; charset=utf-8")
+
+@app.route("/health", methods=['GET'])
+def health():
+    """
+    ตรวจสถานะของ LLM backend ที่ตั้งค่าไว้
+    """
+    status = llm_health()
+    return jsonify({"llm": status, "index": index_status()}), (200 if status.get("ok") else 503)
+
+@app.route("/admin/reload", methods=['POST'])
+def admin_reload():
+    """
+    สร้าง index ใหม่จาก data/json ใน background แล้วสลับมาใช้โดยไม่ต้อง restart
+    (?wait=true รอจนเสร็จ) กับ gunicorn หลาย worker ให้ใช้ INDEX_WATCH_INTERVAL แทน เพราะคำขอไปถึง worker เดียว
+    """
+    if not ADMIN_TOKEN or not hmac.compare_digest(request.headers.get('X-Admin-Token', ''), ADMIN_TOKEN):
+        abort(403)
+    started = reload_index("admin", wait=request.args.get('wait') == 'true')
+    return jsonify({"started": started, "index": index_status()}), (202 if started else 409)
+
+def dispatch_event(event):
+    """
+    ประมวลผล event ที่ได้จากคิว (ทำงานใน worker thread)
+    """
+    if isinstance(event, MessageEvent) and isinstance(event.message, TextMessageContent):
+        handle_message(event)
+
+def reply_busy(event):
+    if getattr(event, 'reply_token', None):
+        send_text_message(line_bot_api, event.reply_token, "ขออภัยค่ะ ขณะนี้มีผู้ใช้งานจำนวนมาก กรุณาลองใหม่อีกครั้ง")
+
+def reply_messages(event, messages):
+    """
+    ตอบกลับด้วย reply token ถ้ายังไม่หมดอายุ ไม่เช่นนั้นใช้ push message
+    """
+    if is_reply_token_fresh(event.timestamp, REPLY_TOKEN_TTL):
+        send_multiple_messages(line_bot_api, event.reply_token, messages)
+    else:
+        logger.info("reply token หมดอายุแล้ว เปลี่ยนไปใช้ push message")
+        push_messages(line_bot_api, get_push_target(event.source), messages)
+
+def _text_message(text):
+    text = text if text else "ขออภัย ไม่พบข้อมูล"
+    if len(text) > 4997:
+        text = text[:4997] + "..."
+    return TextMessage(text=text)
+
+def start_speculation(question):
+    """
+    เริ่มค้นหาเอกสาร (และสร้างคำตอบในโหมด full) ไปพร้อมกับ Dialogflow
+    """
+    if speculative_executor is None:
+        return None
+    if SPECULATIVE_MODE == "full":
+        return SpeculativeTask(speculative_executor, "full", speculative_answer, question, cancellable=True)
+    return SpeculativeTask(speculative_executor, "retrieve", retrieve_documents, question)
+
+def send_reply_text(event, text):
+    reply_messages(event, [_text_message(text)])
+
+def reply_streamed(event, chunks, quick_replies=None):
+    """
+    ส่งช่วงแรกของคำตอบด้วย reply token ทันที
+    ช่วงที่เหลือต่อกันตรง ๆ (chunk มีช่องว่างของตัวเองอยู่แล้ว) จนยาวพอแล้วส่งต่อเป็น push message
+    """
+    first = next(chunks, None)
+    first_message = _text_message(first.strip() if first else first)
+    if quick_replies:
+        first_message.quick_reply = quick_replies
+    reply_messages(event, [first_message])
+
+    target = get_push_target(event.source)
+    buffer = ""
+    for chunk in chunks:
+        buffer += chunk
+        if len(buffer.strip()) >= STREAM_PUSH_MIN_CHARS:
+            push_messages(line_bot_api, target, [_text_message(buffer.strip())])
+            buffer = ""
+    if buffer.strip():
+        # quick replies แสดงเฉพาะข้อความล่าสุด จึงแนบกับข้อความสุดท้ายด้วย
+        last_message = _text_message(buffer.strip())
+        if quick_replies:
+            last_message.quick_reply = quick_replies
+        push_messages(line_bot_api, target, [last_message])
+
 @handler.add(MessageEvent, message=TextMessageContent)
 def handle_message(event):
+    # วัดเวลาทั้งคำขอ และแยกตามขั้นตอน (Dialogflow, encode, ค้นหา, LLM, ส่งข้อความ)
+    with trace("handle_message"):
+        _handle_message(event)
+
+def _handle_message(event):
     user_id = event.source.user_id
     text_from_user = event.message.text
     logger.info(f"ข้อความจาก {user_id}: {text_from_user}")
@@ -86,9 +249,10 @@ def handle_message(event):
 
     if not should_respond or not actual_message:
         if should_respond:
-            send_text_message(line_bot_api, event.reply_token, f"สวัสดีค่ะ หนูชื่อ {bot_name} คุณต้องการสอบถามอะไรค่ะ?")
+            send_reply_text(event, f"สวัสดีค่ะ หนูชื่อ {bot_name} คุณต้องการสอบถามอะไรค่ะ?")
         return
 
+    speculative = start_speculation(actual_message)
     try:
         # ส่งคำถามไปยัง Dialogflow
         response = detect_intent_texts(DIALOGFLOW_PROJECT_ID, f"{SESSION_ID}-{user_id}", actual_message, 'th')
@@ -147,26 +311,48 @@ def handle_message(event):
             # หากมีอย่างน้อยหนึ่งข้อความให้ส่งทั้งหมด
             if messages_to_reply:
                 logger.info("พบคำตอบจาก Dialogflow ส่งคำตอบให้ผู้ใช้")
+                answers_total.inc(source="dialogflow")
                 # เพิ่ม quick replies ให้กับข้อความสุดท้าย (ถ้ามี)
                 if quick_replies and messages_to_reply:
                     messages_to_reply[-1].quick_reply = quick_replies
                 
-                send_multiple_messages(line_bot_api, event.reply_token, messages_to_reply)
+                reply_messages(event, messages_to_reply)
             else:
                 # ขั้นตอนที่ 2: ค้นหาในเอกสาร
                 logger.info("เริ่มขั้นตอนที่ 2: ค้นหาในเอกสาร")
-                reply_text, found_in_docs, rag_context = search_from_documents(actual_message)
+                speculative_result = None
+                if speculative:
+                    try:
+                        speculative_result = speculative.result()
+                    except Exception as e:
+                        # งานล่วงหน้าล้มเหลว: ค้นหาใหม่ตามปกติแทนการตอบข้อผิดพลาด
+                        logger.warning(f"Speculative {speculative.stage} failed, searching again: {str(e)}")
+                if speculative and speculative.stage == "full" and speculative_result:
+                    reply_text, found_in_docs, rag_context = speculative_result
+                else:
+                    reply_text, found_in_docs, rag_context = search_from_documents(
+                        actual_message, stream=STREAM_RESPONSES,
+                        retrieved=speculative_result if speculative and speculative.stage == "retrieve" else None
+                    )
+
+                if not isinstance(reply_text, str):
+                    reply_streamed(event, reply_text, quick_replies)
+                    return
 
                 # ส่งข้อความที่ได้
-                text_message = TextMessage(text=reply_text)
+                text_message = _text_message(reply_text)
                 if quick_replies:
                     text_message.quick_reply = quick_replies
                 
-                send_multiple_messages(line_bot_api, event.reply_token, [text_message])
+                reply_messages(event, [text_message])
         
     except Exception as e:
         logger.error(f"เกิดข้อผิดพลาดในการประมวลผลข้อความ: {str(e)}")
-        send_text_message(line_bot_api, event.reply_token, "ขออภัย เกิดข้อผิดพลาดในการประมวลผล กรุณาลองใหม่อีกครั้ง")
+        send_reply_text(event, "ขออภัย เกิดข้อผิดพลาดในการประมวลผล กรุณาลองใหม่อีกครั้ง")
+    finally:
+        # Dialogflow ตอบได้เองหรือเกิดข้อผิดพลาด: ทิ้งงานที่ทำล่วงหน้า
+        if speculative:
+            speculative.discard()
 
 
 if __name__ == "__main__":
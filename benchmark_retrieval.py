@@ -0,0 +1,435 @@
+"""
+Offline retrieval benchmark and recall regression check.
+
+Builds the index from data/json into a scratch cache, then measures build
+and load time, encode and FAISS search latency, throughput per batch size,
+and recall@k / MRR of the labelled queries (the questions of 1.json plus
+rule-based paraphrases) for every index type, and the error rates of the
+direct Q&A answer at each candidate QA_DIRECT_THRESHOLD.
+
+    python benchmark_retrieval.py --output cache/benchmark/baseline.json
+    python benchmark_retrieval.py --baseline cache/benchmark/baseline.json
+
+No baseline is shipped because latency depends on the machine and recall
+on the model: record one with --output on the machine that runs the check
+(e.g. from the main branch), then pass that file to --baseline. The run is
+compared metric by metric and exits with 1 when recall/MRR drops or
+latency grows past the allowed margins.
+"""
+import argparse
+import json
+import logging
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+import chunker
+import index_factory
+from lexical_index import normalize_text
+from rag import QA_DIRECT_MARGIN, RAGSystem
+
+logger = logging.getLogger(__name__)
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+LABELLED_FILE = os.path.join(BASE_DIR, 'data', 'json', '1.json')
+INDEX_TYPES = ('flat', 'ivf', 'hnsw', 'ivfsq8', 'ivfpq')
+KS = (1, 3, 5, 10)
+BATCH_SIZES = (1, 4, 16, 64)
+QA_DIRECT_THRESHOLDS = (0.85, 0.88, 0.9, 0.92, 0.94, 0.95, 0.96, 0.98)
+
+# คำ/วลีที่ใช้แทนกันได้ ใช้สร้างคำถามแบบ paraphrase จากคำถามใน 1.json
+PARAPHRASE_RULES = (
+    ("เป็นอย่างไร", "คืออะไร"),
+    ("อย่างไรบ้าง", "ยังไงบ้าง"),
+    ("อย่างไร", "ยังไง"),
+    ("อะไรบ้าง", "มีอะไร"),
+    ("วันที่ใด", "วันไหน"),
+    ("วันใด", "วันไหน"),
+    ("เมื่อใด", "เมื่อไหร่"),
+    ("ได้หรือไม่", "ได้ไหม"),
+    ("หรือไม่", "ไหม"),
+    ("ด้านใด", "ด้านไหน"),
+    ("ชั้นเรียนใด", "ชั้นไหน"),
+    ("ลิงค์", "ลิงก์"),
+    ("โรงเรียน", "สถานศึกษา"),
+    ("ต้อง", "จะต้อง"),
+)
+PARAPHRASE_PREFIXES = ("อยากทราบว่า", "ช่วยบอกหน่อยค่ะ ")
+
+
+def paraphrases(question: str, limit: int) -> List[str]:
+    """สร้าง paraphrase แบบกำหนดได้ (ไม่สุ่ม) โดยแทนคำทีละกฎ แทนทุกกฎ และเติมคำขึ้นต้น"""
+    base = question.rstrip('?？ ').strip()
+    variants = []
+    for old, new in PARAPHRASE_RULES:
+        if old in base:
+            variants.append(base.replace(old, new, 1))
+    combined = base
+    for old, new in PARAPHRASE_RULES:
+        combined = combined.replace(old, new)
+    variants.append(combined)
+    variants.extend(prefix + base for prefix in PARAPHRASE_PREFIXES)
+
+    seen = {normalize_text(question)}
+    unique = []
+    for variant in variants:
+        key = normalize_text(variant)
+        if key not in seen:
+            seen.add(key)
+            unique.append(variant)
+    return unique[:limit]
+
+
+def labelled_queries(system: RAGSystem, paraphrase_limit: int) -> List[Dict]:
+    """
+    คำถามจาก 1.json พร้อมเอกสารที่ถือว่าถูก: เอกสาร Q&A ที่มีคำตอบเดียวกัน
+    (1.json มีคำถามที่ถามซ้ำด้วยถ้อยคำต่างกัน จึงนับทุกข้อที่คำตอบตรงกัน)
+    """
+    with open(LABELLED_FILE, 'r', encoding='utf-8') as f:
+        items = [item for item in json.load(f) if 'question' in item and 'answer' in item]
+
+    by_answer = {}
+    for i in range(len(system.documents)):
+        answer = system.documents.get_field(i, 'answer')
+        if answer is not None and system.documents.get_field(i, 'question') is not None:
+            by_answer.setdefault(normalize_text(answer), set()).add(i)
+
+    queries = []
+    for item in items:
+        relevant = by_answer.get(normalize_text(item['answer']))
+        if not relevant:
+            logger.warning(f"No indexed document for labelled question: {item['question']}")
+            continue
+        queries.append({'query': item['question'], 'kind': 'original', 'relevant': relevant})
+        for variant in paraphrases(item['question'], paraphrase_limit):
+            queries.append({'query': variant, 'kind': 'paraphrase', 'relevant': relevant})
+    return queries
+
+
+def _percentiles(seconds: List[float]) -> Dict:
+    values = np.asarray(seconds) * 1000
+    return {
+        'p50_ms': round(float(np.percentile(values, 50)), 3),
+        'p95_ms': round(float(np.percentile(values, 95)), 3),
+        'p99_ms': round(float(np.percentile(values, 99)), 3),
+        'mean_ms': round(float(values.mean()), 3),
+    }
+
+
+def _ranking_metrics(rankings: List[Tuple[List[int], set]], ks=KS) -> Dict:
+    """recall@k (มีเอกสารที่ถูกใน k อันดับแรก) และ MRR ของอันดับแรกที่ถูก"""
+    result = {}
+    reciprocal = []
+    for ranked, relevant in rankings:
+        rank = next((position for position, idx in enumerate(ranked, start=1) if idx in relevant), None)
+        reciprocal.append(1.0 / rank if rank else 0.0)
+        for k in ks:
+            result.setdefault(f'recall@{k}', []).append(1.0 if rank and rank <= k else 0.0)
+    metrics = {key: round(float(np.mean(values)), 4) for key, values in result.items()}
+    metrics['mrr'] = round(float(np.mean(reciprocal)), 4)
+    return metrics
+
+
+def _by_kind(queries: List[Dict], rankings: List[List[int]]) -> Dict:
+    report = {}
+    for kind in ('all', 'original', 'paraphrase'):
+        pairs = [(ranked, q['relevant']) for q, ranked in zip(queries, rankings) if kind == 'all' or q['kind'] == kind]
+        if pairs:
+            report[kind] = _ranking_metrics(pairs)
+    return report
+
+
+def _question_ids(system: RAGSystem) -> Dict[str, List[int]]:
+    ids = {}
+    for i in range(len(system.documents)):
+        question = system.documents.get_field(i, 'question')
+        if question is not None:
+            ids.setdefault(normalize_text(question), []).append(i)
+    return ids
+
+
+def _pipeline_ranking(system: RAGSystem, question_ids: Dict[str, List[int]], query: str,
+                      embedding: np.ndarray, k: int) -> List[int]:
+    """อันดับจาก search_embedding (hybrid + รวม chunk) แปลงกลับเป็น id ของเอกสาร Q&A"""
+    ids = []
+    for result in system.search_embedding(embedding, k=k, query=query):
+        if 'question' in result:
+            ids.extend(question_ids.get(normalize_text(result['question']), []))
+        else:
+            ids.append(-1)
+    return ids
+
+
+def benchmark_index_types(system: RAGSystem, queries: List[Dict], query_embeddings: np.ndarray,
+                          index_types, repeats: int) -> Dict:
+    embeddings = np.asarray(system.embeddings, dtype='float32')
+    k = max(KS)
+    question_ids = _question_ids(system)
+    original_index, original_config = system.index, system.index_config
+    results = {}
+    try:
+        for index_type in index_types:
+            config = index_factory.choose_index_config(len(embeddings), embeddings.shape[1], index_type)
+            start = time.perf_counter()
+            try:
+                index = index_factory.build_index(embeddings, config)
+                config = index_factory.tune_index(index, config, embeddings)
+            except Exception as e:
+                logger.warning(f"Skipping {index_type}: {e}")
+                continue
+            build_seconds = time.perf_counter() - start
+
+            _, found = index.search(query_embeddings, k)
+            latencies = []
+            for _ in range(repeats):
+                for embedding in query_embeddings:
+                    start = time.perf_counter()
+                    index.search(embedding[None, :], k)
+                    latencies.append(time.perf_counter() - start)
+
+            # ทั้ง pipeline ของ RAGSystem (hybrid, รวม chunk) บน index ชนิดนี้
+            system.index, system.index_config = index, config
+            pipeline = [
+                _pipeline_ranking(system, question_ids, q['query'], query_embeddings[i:i + 1], k)
+                for i, q in enumerate(queries)
+            ]
+
+            results[index_type] = {
+                'config': {key: value for key, value in config.items() if key not in ('n', 'dimension')},
+                'build_seconds': round(build_seconds, 4),
+                'search_latency': _percentiles(latencies),
+                'index_recall': _by_kind(queries, found.tolist()),
+                'pipeline_recall': _by_kind(queries, pipeline),
+            }
+            logger.info(f"{index_type}: {results[index_type]['pipeline_recall']['all']}")
+    finally:
+        system.index, system.index_config = original_index, original_config
+    return results
+
+
+def benchmark_qa_direct(system: RAGSystem, queries: List[Dict], query_embeddings: np.ndarray,
+                        thresholds=QA_DIRECT_THRESHOLDS) -> Dict:
+    """
+    ทางลัด Q&A ที่แต่ละเกณฑ์: answered_rate และ wrong_rate (ตอบด้วยคำตอบผิด) ของคำถามที่มีใน index
+    และ held_out_false_positive_rate เมื่อเอาคำถามที่ถูกออกจาก index (คำถามที่ไม่มีคำตอบแต่คล้ายข้ออื่น)
+    ใช้เลือก QA_DIRECT_THRESHOLD / QA_DIRECT_MARGIN
+    """
+    if system.question_embeddings is None:
+        return {}
+    positions = {int(idx): p for p, idx in enumerate(system.question_ids.tolist())}
+    scores = np.asarray(query_embeddings @ np.asarray(system.question_embeddings).T)
+    report = {}
+    for threshold in thresholds:
+        answered = wrong = held_out = 0
+        for q, row in zip(queries, scores):
+            best = system.best_question(row, threshold)
+            if best is not None:
+                answered += 1
+                wrong += int(system.question_ids[best]) not in q['relevant']
+            masked = row.copy()
+            masked[[positions[i] for i in q['relevant'] if i in positions]] = -np.inf
+            held_out += system.best_question(masked, threshold) is not None
+        n = max(len(queries), 1)
+        report[f"{threshold:.2f}"] = {
+            'answered_rate': round(answered / n, 4),
+            'wrong_rate': round(wrong / max(answered, 1), 4),
+            'held_out_false_positive_rate': round(held_out / n, 4),
+        }
+    return {'margin': QA_DIRECT_MARGIN, 'thresholds': report}
+
+
+def benchmark_throughput(system: RAGSystem, texts: List[str], query_embeddings: np.ndarray,
+                         batch_sizes, total: int) -> Dict:
+    """จำนวน query ต่อวินาทีของการ encode และการค้นหา FAISS ที่ขนาด batch ต่าง ๆ"""
+    report = {}
+    k = max(KS)
+    for batch_size in batch_sizes:
+        rounds = max(1, total // batch_size)
+        batches = [[texts[(r * batch_size + j) % len(texts)] for j in range(batch_size)] for r in range(rounds)]
+        start = time.perf_counter()
+        for batch in batches:
+            system.encoder.encode(batch, batch_size=batch_size, convert_to_numpy=True, normalize_embeddings=True)
+        encode_seconds = time.perf_counter() - start
+
+        vectors = np.asarray(query_embeddings[np.arange(batch_size) % len(query_embeddings)], dtype='float32')
+        start = time.perf_counter()
+        for _ in range(rounds):
+            system.index.search(vectors, k)
+        search_seconds = time.perf_counter() - start
+
+        report[str(batch_size)] = {
+            'encode_qps': round(rounds * batch_size / encode_seconds, 1),
+            'search_qps': round(rounds * batch_size / search_seconds, 1),
+        }
+    return report
+
+
+def _git_commit() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=BASE_DIR,
+                              capture_output=True, text=True, timeout=5).stdout.strip()
+    except Exception:
+        return ''
+
+
+def run(args) -> Dict:
+    scratch = tempfile.mkdtemp(prefix='rag-benchmark-')
+    try:
+        start = time.perf_counter()
+        system = RAGSystem()
+        encoder_seconds = time.perf_counter() - start
+        # สร้าง index ใน cache ชั่วคราว เพื่อให้วัดการสร้างใหม่ทั้งหมดและไม่แตะ cache ที่ใช้งานจริง
+        system.cache_dir = scratch
+        system.query_cache = None
+        start = time.perf_counter()
+        if not system.load_documents(None):
+            raise RuntimeError("Could not build the index from data/json")
+        build_seconds = time.perf_counter() - start
+
+        start = time.perf_counter()
+        system.index = None
+        if not system.load_documents(None):
+            raise RuntimeError("Could not load the index from the scratch cache")
+        load_seconds = time.perf_counter() - start
+
+        queries = labelled_queries(system, args.paraphrases)
+        texts = [q['query'] for q in queries]
+        encode_latencies = []
+        for _ in range(args.repeats):
+            for text in texts:
+                start = time.perf_counter()
+                system.encoder.encode([text], convert_to_numpy=True, normalize_embeddings=True)
+                encode_latencies.append(time.perf_counter() - start)
+        query_embeddings = np.asarray(
+            system.encoder.encode(texts, batch_size=32, convert_to_numpy=True, normalize_embeddings=True),
+            dtype='float32'
+        )
+
+        return {
+            'meta': {
+                'timestamp': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+                'commit': _git_commit(),
+                'model': system.model_name,
+                'encoder': system.encoder.name,
+                'documents': len(system.documents),
+                'queries': len(queries),
+                'paraphrases': sum(1 for q in queries if q['kind'] == 'paraphrase'),
+                'chunking': chunker.settings(),
+                'index_settings': index_factory.settings(),
+                'configured_index': system.index_config,
+            },
+            'startup': {
+                'encoder_load_seconds': round(encoder_seconds, 3),
+                'index_build_seconds': round(build_seconds, 3),
+                'cold_load_seconds': round(load_seconds, 3),
+            },
+            'encode_latency': _percentiles(encode_latencies),
+            'throughput': benchmark_throughput(system, texts, query_embeddings, args.batch_sizes, args.throughput_queries),
+            'index_types': benchmark_index_types(system, queries, query_embeddings, args.index_types, args.repeats),
+            'qa_direct': benchmark_qa_direct(system, queries, query_embeddings),
+        }
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+
+
+def _flatten(data: Dict, prefix: str = '') -> Dict[str, float]:
+    flat = {}
+    for key, value in data.items():
+        path = f"{prefix}{key}"
+        if isinstance(value, dict):
+            flat.update(_flatten(value, path + '.'))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[path] = value
+    return flat
+
+
+def compare(current: Dict, baseline: Dict, max_recall_drop: float, max_slowdown: float,
+            min_delta_ms: float = 0.5) -> List[Dict]:
+    """
+    เทียบกับ baseline: recall/MRR ห้ามลดเกิน max_recall_drop (ค่าสัมบูรณ์)
+    เวลา (_ms, _seconds) ห้ามเพิ่มเกิน max_slowdown (สัดส่วน) และ qps ห้ามลดเกิน max_slowdown
+    เวลาที่ต่างกันไม่ถึง min_delta_ms ไม่นับ เพราะค่าระดับ µs แกว่งเกินสัดส่วนที่ตั้งไว้เสมอ
+    """
+    rows = []
+    now, before = _flatten(current), _flatten(baseline)
+    for key in sorted(set(now) & set(before)):
+        if key.startswith('meta.') or '.config.' in key:
+            continue
+        old, new = before[key], now[key]
+        name = key.rsplit('.', 1)[-1]
+        status = 'ok'
+        if name.startswith('recall@') or name == 'mrr':
+            if new < old - max_recall_drop:
+                status = 'regression'
+        elif name.endswith('_ms') or name.endswith('_seconds'):
+            scale = 1.0 if name.endswith('_ms') else 1000.0
+            if old > 0 and new > old * (1 + max_slowdown) and (new - old) * scale >= min_delta_ms:
+                status = 'regression'
+        elif name.endswith('_qps'):
+            if new < old * (1 - max_slowdown):
+                status = 'regression'
+        else:
+            continue
+        change = (new - old) / old * 100 if old else 0.0
+        rows.append({'metric': key, 'baseline': old, 'current': new, 'change_pct': round(change, 1), 'status': status})
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline retrieval benchmark for the RAG index")
+    parser.add_argument('--output', default=os.path.join(BASE_DIR, 'cache', 'benchmark', 'retrieval.json'))
+    parser.add_argument('--baseline', default=None, help="compare against a previous --output file")
+    parser.add_argument('--paraphrases', type=int, default=3, help="paraphrases per labelled question")
+    parser.add_argument('--index-types', default=','.join(INDEX_TYPES))
+    parser.add_argument('--batch-sizes', default=','.join(str(b) for b in BATCH_SIZES))
+    parser.add_argument('--throughput-queries', type=int, default=256)
+    parser.add_argument('--repeats', type=int, default=3, help="latency samples per query")
+    parser.add_argument('--max-recall-drop', type=float, default=0.02)
+    parser.add_argument('--max-slowdown', type=float, default=0.25)
+    parser.add_argument('--min-delta-ms', type=float, default=0.5,
+                        help="ignore latency changes smaller than this")
+    args = parser.parse_args()
+    args.index_types = [t for t in args.index_types.split(',') if t]
+    args.batch_sizes = [int(b) for b in args.batch_sizes.split(',') if b]
+
+    logging.basicConfig(level=logging.WARNING, format='%(levelname)s %(name)s: %(message)s')
+    logger.setLevel(logging.INFO)
+
+    report = run(args)
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    logger.info(f"Wrote {args.output}")
+
+    summary = {
+        index_type: {
+            'recall@5': result['pipeline_recall']['all']['recall@5'],
+            'mrr': result['pipeline_recall']['all']['mrr'],
+            'search_p95_ms': result['search_latency']['p95_ms'],
+        }
+        for index_type, result in report['index_types'].items()
+    }
+    print(json.dumps({'startup': report['startup'], 'encode_latency': report['encode_latency'],
+                      'index_types': summary, 'qa_direct': report['qa_direct']}, ensure_ascii=False, indent=2))
+
+    if args.baseline:
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+        rows = compare(report, baseline, args.max_recall_drop, args.max_slowdown, args.min_delta_ms)
+        regressions = [row for row in rows if row['status'] == 'regression']
+        for row in rows:
+            if row['status'] == 'regression' or abs(row['change_pct']) >= 5:
+                print(f"{row['status']:<10} {row['metric']:<60} {row['baseline']:>10} -> {row['current']:<10} ({row['change_pct']:+.1f}%)")
+        print(f"{len(regressions)} regression(s) against {args.baseline} (commit {baseline.get('meta', {}).get('commit', '?')})")
+        sys.exit(1 if regressions else 0)
+
+
+if __name__ == "__main__":
+    main()
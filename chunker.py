@@ -0,0 +1,94 @@
+import os
+import re
+from typing import Callable, Dict, List
+
+# แบ่ง section ยาวเป็นช่วงตามจำนวน token (0 = ไม่แบ่ง)
+CHUNK_MAX_TOKENS = int(os.getenv("CHUNK_MAX_TOKENS", "256"))
+CHUNK_OVERLAP_TOKENS = int(os.getenv("CHUNK_OVERLAP_TOKENS", "32"))
+
+# ภาษาไทยใช้ช่องว่างคั่นประโยค/วลี ส่วนภาษาอังกฤษใช้เครื่องหมายจบประโยค
+_SENTENCE_BREAK = re.compile(r'(?<=[.!?])\s+|\n+|\s{2,}|\s(?=\d+\.\s)|(?<=[\u0e00-\u0e7f)”"])\s+(?=[\u0e00-\u0e7f(“"])')
+
+
+def settings() -> Dict:
+    """ค่าที่มีผลต่อผลการแบ่ง หากเปลี่ยนต้อง parse และ encode ใหม่"""
+    return {'max_tokens': CHUNK_MAX_TOKENS, 'overlap_tokens': CHUNK_OVERLAP_TOKENS}
+
+
+def approximate_tokens(text: str) -> int:
+    # ใช้เมื่อไม่มี tokenizer: ภาษาไทยเฉลี่ยราว 3 ตัวอักษรต่อ token
+    return max(1, len(text) // 3)
+
+
+def split_sentences(text: str) -> List[str]:
+    return [s.strip() for s in _SENTENCE_BREAK.split(text or '') if s and s.strip()]
+
+
+def _split_long(sentence: str, max_tokens: int, count_tokens: Callable[[str], int]) -> List[str]:
+    """ตัดประโยคที่ยาวเกินงบ token ตามจำนวนตัวอักษร"""
+    tokens = count_tokens(sentence)
+    if tokens <= max_tokens:
+        return [sentence]
+    step = max(1, len(sentence) * max_tokens // tokens)
+    return [sentence[i:i + step] for i in range(0, len(sentence), step)]
+
+
+def chunk_text(text: str, max_tokens: int = CHUNK_MAX_TOKENS, overlap_tokens: int = CHUNK_OVERLAP_TOKENS,
+               count_tokens: Callable[[str], int] = approximate_tokens) -> List[str]:
+    """
+    Pack whole sentences into chunks of at most max_tokens, repeating the
+    last overlap_tokens worth of sentences at the start of the next chunk.
+    """
+    if max_tokens <= 0 or count_tokens(text) <= max_tokens:
+        return [text]
+
+    sentences = []
+    for sentence in split_sentences(text):
+        sentences.extend(_split_long(sentence, max_tokens, count_tokens))
+    sizes = [count_tokens(s) for s in sentences]
+
+    chunks = []
+    start = 0
+    while start < len(sentences):
+        end, used = start, 0
+        while end < len(sentences) and (end == start or used + sizes[end] <= max_tokens):
+            used += sizes[end]
+            end += 1
+        chunks.append(' '.join(sentences[start:end]))
+        if end >= len(sentences):
+            break
+        # ถอยกลับเพื่อให้ chunk ถัดไปมีข้อความซ้อนกับ chunk นี้
+        next_start, overlap = end, 0
+        while next_start - 1 > start and overlap + sizes[next_start - 1] <= overlap_tokens:
+            next_start -= 1
+            overlap += sizes[next_start]
+        start = next_start
+    return chunks
+
+
+def chunk_documents(documents: List[Dict], count_tokens: Callable[[str], int] = approximate_tokens,
+                    max_tokens: int = CHUNK_MAX_TOKENS, overlap_tokens: int = CHUNK_OVERLAP_TOKENS) -> List[Dict]:
+    """
+    แบ่งเอกสารแบบ section (มี metadata) ที่ยาวเกินงบ token เป็นหลาย chunk
+    แต่ละ chunk เก็บ parent (section เดิม) หน้า และลำดับ chunk ไว้ใน metadata
+    เอกสาร Q&A ไม่ถูกแบ่ง
+    """
+    chunked = []
+    for doc in documents:
+        metadata = doc.get('metadata')
+        if not metadata or max_tokens <= 0:
+            chunked.append(doc)
+            continue
+
+        parent = f"{metadata.get('source')}#{metadata.get('part')}/{metadata.get('page')}/{metadata.get('topic')}"
+        content = metadata.get('content', '')
+        prefix, _, _ = doc['text'].rpartition(content) if content else (doc['text'], '', '')
+        # งบของเนื้อหาต้องหักส่วนหัว (ส่วนที่ เรื่อง หน้า หัวข้อ ...) ที่ใส่ทุก chunk
+        budget = max(max_tokens - count_tokens(prefix), max_tokens // 4)
+        pieces = chunk_text(content, budget, overlap_tokens, count_tokens) if content else ['']
+        for i, piece in enumerate(pieces):
+            chunked.append({
+                'text': f"{prefix}{piece}",
+                'metadata': dict(metadata, content=piece, parent=parent, chunk=i)
+            })
+    return chunked
@@ -0,0 +1,122 @@
+import logging
+import threading
+import time
+from collections import deque
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+CLOSED = "closed"
+HALF_OPEN = "half_open"
+OPEN = "open"
+_STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+state_gauge = metrics.gauge("circuit_breaker_state", "Circuit breaker state (0 = closed, 1 = half-open, 2 = open)")
+short_circuits_total = metrics.counter("circuit_breaker_short_circuits_total", "Calls rejected without trying because the breaker was open")
+transitions_total = metrics.counter("circuit_breaker_transitions_total", "Circuit breaker state changes")
+failures_total = metrics.counter("circuit_breaker_failures_total", "Failures recorded by the circuit breaker")
+
+
+class CircuitBreaker:
+    """
+    Fails fast once a dependency keeps failing.
+
+    closed: calls go through; failure_threshold failures within window
+    seconds open the breaker.
+    open: calls are rejected for open_seconds.
+    half-open: one probe call at a time is let through; a success closes
+    the breaker again, a failure re-opens it.
+    """
+
+    def __init__(self, name: str, failure_threshold: int = 5, window: float = 60.0, open_seconds: float = 30.0):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.window = window
+        self.open_seconds = open_seconds
+        self._state = CLOSED
+        self._failures = deque()
+        self._opened_at = 0.0
+        self._probing = False
+        self._lock = threading.Lock()
+        state_gauge.set_function(lambda: _STATE_VALUES[self.state], breaker=name)
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            if self._state == OPEN and time.monotonic() - self._opened_at >= self.open_seconds:
+                return HALF_OPEN
+            return self._state
+
+    def available(self) -> bool:
+        """มีโอกาสเรียกได้หรือไม่ (ไม่จอง probe) ใช้ตัดสินใจล่วงหน้าว่าจะข้ามการเรียกเลย"""
+        return self.state != OPEN
+
+    def allow(self) -> bool:
+        """ขออนุญาตเรียกหนึ่งครั้ง ในสถานะ half-open จะให้ผ่านทีละหนึ่ง probe"""
+        with self._lock:
+            if self._state == OPEN:
+                if time.monotonic() - self._opened_at < self.open_seconds:
+                    short_circuits_total.inc(breaker=self.name)
+                    return False
+                self._transition(HALF_OPEN)
+            if self._state == HALF_OPEN:
+                if self._probing:
+                    short_circuits_total.inc(breaker=self.name)
+                    return False
+                self._probing = True
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self._probing = False
+            if self._state != CLOSED:
+                self._failures.clear()
+                self._transition(CLOSED)
+
+    def record_failure(self):
+        failures_total.inc(breaker=self.name)
+        with self._lock:
+            now = time.monotonic()
+            self._probing = False
+            if self._state == HALF_OPEN:
+                self._open(now)
+                return
+            self._failures.append(now)
+            while self._failures and now - self._failures[0] > self.window:
+                self._failures.popleft()
+            if self._state == CLOSED and len(self._failures) >= self.failure_threshold:
+                self._open(now)
+
+    def release(self):
+        """คืน probe ที่ขอไว้โดยไม่รู้ผล (เช่น ผู้เรียกยกเลิกกลางทาง)"""
+        with self._lock:
+            self._probing = False
+
+    def reset(self):
+        with self._lock:
+            self._failures.clear()
+            self._probing = False
+            if self._state != CLOSED:
+                self._transition(CLOSED)
+
+    def _open(self, now: float):
+        self._opened_at = now
+        self._failures.clear()
+        self._transition(OPEN)
+
+    def _transition(self, state: str):
+        # เรียกขณะถือ lock อยู่แล้ว
+        previous, self._state = self._state, state
+        transitions_total.inc(breaker=self.name, to=state)
+        log = logger.warning if state == OPEN else logger.info
+        log(f"Circuit breaker '{self.name}': {previous} -> {state}")
+
+    def status(self) -> dict:
+        return {
+            "state": self.state,
+            "short_circuits": short_circuits_total.value(breaker=self.name),
+            "failure_threshold": self.failure_threshold,
+            "window_seconds": self.window,
+            "open_seconds": self.open_seconds,
+        }
@@ -0,0 +1,110 @@
+import logging
+import os
+import re
+from typing import List, Sequence, Tuple, Union
+
+from chunker import split_sentences
+from lexical_index import tokenize
+
+logger = logging.getLogger(__name__)
+
+# tokenizer ของ LLM (ชื่อบน Hugging Face หรือ path ของ tokenizer.json) ถ้าไม่ตั้งจะใช้การประมาณ
+LLM_TOKENIZER = os.getenv("LLM_TOKENIZER", "")
+# เผื่อ token ไว้สำหรับความคลาดเคลื่อนของการนับ
+CONTEXT_SAFETY_TOKENS = int(os.getenv("CONTEXT_SAFETY_TOKENS", "32"))
+# จำกัดความยาว context สูงสุด (0 = ใช้งบที่เหลือทั้งหมด)
+CONTEXT_MAX_TOKENS = int(os.getenv("CONTEXT_MAX_TOKENS", "0"))
+# ไม่เติมข้อความสั้นกว่านี้ เมื่องบเหลือน้อยเกินจะได้ใจความ
+MIN_PASSAGE_TOKENS = 24
+
+_THAI = re.compile(r'[\u0e00-\u0e7f]')
+_tokenizer = None
+_tokenizer_loaded = False
+
+
+def _load_tokenizer():
+    global _tokenizer, _tokenizer_loaded
+    if _tokenizer_loaded:
+        return _tokenizer
+    _tokenizer_loaded = True
+    if not LLM_TOKENIZER:
+        return None
+    try:
+        from tokenizers import Tokenizer
+        if os.path.exists(LLM_TOKENIZER):
+            _tokenizer = Tokenizer.from_file(LLM_TOKENIZER)
+        else:
+            _tokenizer = Tokenizer.from_pretrained(LLM_TOKENIZER)
+        logger.info(f"Loaded LLM tokenizer: {LLM_TOKENIZER}")
+    except Exception as e:
+        logger.warning(f"Could not load LLM tokenizer {LLM_TOKENIZER}, using estimates: {e}")
+    return _tokenizer
+
+
+def count_tokens(text: str) -> int:
+    """นับ token ด้วย tokenizer ของ LLM หรือประมาณ (ไทยราว 2 ตัวอักษร/token อื่น ๆ ราว 4)"""
+    if not text:
+        return 0
+    tokenizer = _load_tokenizer()
+    if tokenizer is not None:
+        return len(tokenizer.encode(text, add_special_tokens=False).ids)
+    thai = len(_THAI.findall(text))
+    return (thai + 1) // 2 + (len(text) - thai + 3) // 4
+
+
+def _relevant_sentences(question: str, passage: str, budget: int) -> str:
+    """เลือกประโยคที่มีคำตรงกับคำถามมากที่สุดให้พอดีงบ แล้วเรียงตามลำดับเดิม"""
+    terms = set(tokenize(question))
+    sentences = split_sentences(passage)
+    ranked = sorted(
+        range(len(sentences)),
+        key=lambda i: (-len(terms & set(tokenize(sentences[i]))), i)
+    )
+    chosen, used = [], 0
+    for i in ranked:
+        size = count_tokens(sentences[i]) + 1
+        if used + size > budget:
+            continue
+        chosen.append(i)
+        used += size
+    return ' '.join(sentences[i] for i in sorted(chosen))
+
+
+def pack_context(question: str, passages: Union[str, Sequence[Union[str, Tuple[str, float]]]],
+                 budget: int) -> Tuple[str, int]:
+    """
+    Fill at most budget tokens with the retrieved passages, best score first.
+    A passage that does not fit is cut down to its most relevant sentences.
+    Returns the packed context and its token count.
+    """
+    if isinstance(passages, str):
+        passages = [p for p in passages.split('\n\n') if p.strip()]
+    scored: List[Tuple[str, float]] = [
+        p if isinstance(p, tuple) else (p, 0.0) for p in passages
+    ]
+    # sort แบบ stable: ถ้าไม่มี score จะคงลำดับเดิม
+    scored.sort(key=lambda p: p[1], reverse=True)
+
+    packed, used = [], 0
+    separator = count_tokens('\n\n')
+    for text, _ in scored:
+        remaining = budget - used - (separator if packed else 0)
+        if remaining < MIN_PASSAGE_TOKENS:
+            break
+        size = count_tokens(text)
+        if size > remaining:
+            text = _relevant_sentences(question, text, remaining)
+            if not text:
+                continue
+            size = count_tokens(text)
+        packed.append(text)
+        used += size + (separator if len(packed) > 1 else 0)
+    return '\n\n'.join(packed), used
+
+
+def context_budget(template_tokens: int, num_ctx: int, num_predict: int) -> int:
+    """จำนวน token ที่เหลือให้ context หลังหัก template คำถาม และ num_predict"""
+    budget = num_ctx - num_predict - template_tokens - CONTEXT_SAFETY_TOKENS
+    if CONTEXT_MAX_TOKENS > 0:
+        budget = min(budget, CONTEXT_MAX_TOKENS)
+    return max(budget, 0)
@@ -1,28 +1,119 @@
+import itertools
 import logging
-from google.cloud.dialogflow_v2 import SessionsClient
+import os
+import threading
+import time
+import weakref
+from google.cloud.dialogflow_v2 import SessionsClient, SessionsAsyncClient
 from google.cloud.dialogflow_v2.types import TextInput, QueryInput
 
+import metrics
+from tracing import span
+
 logger = logging.getLogger(__name__)
 
+# deadline ของแต่ละคำขอ (วินาที) และจำนวน client/gRPC channel ที่ใช้ร่วมกัน
+DIALOGFLOW_TIMEOUT = float(os.getenv("DIALOGFLOW_TIMEOUT", "5"))
+DIALOGFLOW_POOL_SIZE = int(os.getenv("DIALOGFLOW_POOL_SIZE", "1"))
+
+dialogflow_latency = metrics.histogram("dialogflow_latency_seconds", "Dialogflow detect_intent latency")
+
+_clients = []
+_clients_pid = None
+_clients_lock = threading.Lock()
+_next_client = itertools.count()
+_async_clients = weakref.WeakKeyDictionary()
+
+def init_sessions_client(pool_size=DIALOGFLOW_POOL_SIZE):
+    """
+    สร้าง SessionsClient ไว้ล่วงหน้าตอนเริ่มระบบ (โหลด credential และเปิด gRPC channel ครั้งเดียว)
+    """
+    global _clients_pid
+    with _clients_lock:
+        if _clients and _clients_pid == os.getpid():
+            return True
+        # gRPC channel ใช้ข้ามการ fork ไม่ได้ (gunicorn --preload) ต้องสร้างใหม่ใน process ลูก
+        _clients.clear()
+        try:
+            for _ in range(max(1, pool_size)):
+                _clients.append(SessionsClient())
+            _clients_pid = os.getpid()
+            logger.info(f"สร้าง Dialogflow SessionsClient จำนวน {len(_clients)} ตัว")
+            return True
+        except Exception as e:
+            _clients.clear()
+            logger.error(f"ไม่สามารถสร้าง Dialogflow client: {str(e)}")
+            return False
+
+def get_sessions_client():
+    """คืน client ที่ใช้ร่วมกัน (thread-safe) แบบวนรอบเมื่อมีหลาย channel"""
+    if (not _clients or _clients_pid != os.getpid()) and not init_sessions_client():
+        raise RuntimeError("Dialogflow client is not available")
+    return _clients[next(_next_client) % len(_clients)]
+
+def get_async_sessions_client():
+    """
+    คืน SessionsAsyncClient ของ event loop ปัจจุบัน
+    (async client ผูกกับ event loop ที่สร้างมัน จึงแยกตาม loop)
+    """
+    import asyncio
+    loop = asyncio.get_running_loop()
+    client = _async_clients.get(loop)
+    if client is None:
+        with _clients_lock:
+            # gRPC channel ของ client อ้างถึง loop ไว้ จึงต้องทิ้ง client ของ loop ที่ปิดแล้วเอง
+            for closed in [other for other in list(_async_clients.keys()) if other.is_closed()]:
+                _async_clients.pop(closed, None)
+            client = _async_clients[loop] = SessionsAsyncClient()
+    return client
+
+def _build_request(session_client, project_id, session_id, text, language_code):
+    session = session_client.session_path(project_id, session_id)
+    text_input = TextInput(text=text, language_code=language_code)
+    query_input = QueryInput(text=text_input)
+    return {"session": session, "query_input": query_input}
+
+def _mock_response():
+    # สร้าง response จำลองเพื่อให้โค้ดยังทำงานต่อได้
+    class MockResponse:
+        class MockQueryResult:
+            fulfillment_text = ""
+            fulfillment_messages = []
+        query_result = MockQueryResult()
+        _pb = type('MockPb', (object,), {})()
+    return MockResponse()
+
 def detect_intent_texts(project_id, session_id, text, language_code):
     """
     ส่งข้อความไปยัง Dialogflow เพื่อตรวจจับเจตนา (intent)
     """
+    start = time.perf_counter()
     try:
         logger.info(f"กำลังติดต่อ Dialogflow: Project={project_id}, Session={session_id}")
-        session_client = SessionsClient()
-        session = session_client.session_path(project_id, session_id)
-        text_input = TextInput(text=text, language_code=language_code)
-        query_input = QueryInput(text=text_input)
-        response = session_client.detect_intent(request={"session": session, "query_input": query_input})
+        session_client = get_sessions_client()
+        request = _build_request(session_client, project_id, session_id, text, language_code)
+        with span("dialogflow"):
+            response = session_client.detect_intent(request=request, timeout=DIALOGFLOW_TIMEOUT)
+        dialogflow_latency.observe(time.perf_counter() - start, outcome="ok")
+        return response
+    except Exception as e:
+        dialogflow_latency.observe(time.perf_counter() - start, outcome="error")
+        logger.error(f"เกิดข้อผิดพลาดกับ Dialogflow: {str(e)}")
+        return _mock_response()
+
+async def detect_intent_texts_async(project_id, session_id, text, language_code):
+    """
+    detect_intent_texts แบบ async สำหรับ webhook ที่ทำงานบน asyncio
+    """
+    start = time.perf_counter()
+    try:
+        logger.info(f"กำลังติดต่อ Dialogflow (async): Project={project_id}, Session={session_id}")
+        session_client = get_async_sessions_client()
+        request = _build_request(session_client, project_id, session_id, text, language_code)
+        response = await session_client.detect_intent(request=request, timeout=DIALOGFLOW_TIMEOUT)
+        dialogflow_latency.observe(time.perf_counter() - start, outcome="ok")
         return response
     except Exception as e:
+        dialogflow_latency.observe(time.perf_counter() - start, outcome="error")
         logger.error(f"เกิดข้อผิดพลาดกับ Dialogflow: {str(e)}")
-        # สร้าง response จำลองเพื่อให้โค้ดยังทำงานต่อได้
-        class MockResponse:
-            class MockQueryResult:
-                fulfillment_text = ""
-                fulfillment_messages = []
-            query_result = MockQueryResult()
-            _pb = type('MockPb', (object,), {})()
-        return MockResponse()
+        return _mock_response()
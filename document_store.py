@@ -0,0 +1,192 @@
+import json
+import mmap
+import os
+from typing import Dict, List
+
+import numpy as np
+
+# ฟิลด์ข้อความยาว เก็บเป็นช่วง (start, end) ใน buffer เดียว
+TEXT_FIELDS = ('text', 'question', 'answer', 'topic', 'summary', 'content')
+# ฟิลด์ที่ค่าซ้ำกันบ่อย (ชื่อไฟล์ ชื่อเรื่อง ฯลฯ) เก็บครั้งเดียวในตาราง values แล้วอ้างด้วยเลข
+INTERNED_FIELDS = ('part', 'title', 'page', 'keywords', 'source', 'parent', 'chunk')
+# ฟิลด์ของเอกสารแบบ section ที่อยู่ใต้ 'metadata'
+METADATA_FIELDS = ('part', 'title', 'topic', 'content', 'page', 'summary', 'keywords', 'source', 'parent', 'chunk')
+
+_FLAG_METADATA = 1
+
+
+class DocumentStore:
+    """
+    Columnar, read-only document store.
+
+    Every long string lives once in a single UTF-8 buffer and is addressed
+    by (start, end) byte offsets. A field that is a substring of the
+    document's 'text' (e.g. 'content') points into that span instead of
+    being stored again. Repeated short values are interned. Documents and
+    search results are only materialised as dicts when they are accessed.
+    """
+
+    def __init__(self, buffer, spans, interned, flags, values):
+        self._buffer = buffer
+        self._spans = spans          # (n, len(TEXT_FIELDS), 2), -1 = ไม่มีฟิลด์นี้
+        self._interned = interned    # (n, len(INTERNED_FIELDS)), -1 = ไม่มีฟิลด์นี้
+        self._flags = flags          # (n,)
+        self._values = values        # ค่าที่ intern ไว้ (เข้ารหัสเป็น JSON)
+        self._decoded_values = [json.loads(value) for value in values]
+        self._file = None
+
+    @classmethod
+    def from_documents(cls, documents: List[Dict]) -> 'DocumentStore':
+        buffer = bytearray()
+        spans = np.full((len(documents), len(TEXT_FIELDS), 2), -1, dtype=np.int64)
+        interned = np.full((len(documents), len(INTERNED_FIELDS)), -1, dtype=np.int32)
+        flags = np.zeros(len(documents), dtype=np.uint8)
+        values = []
+        value_ids = {}
+
+        for i, doc in enumerate(documents):
+            fields = dict(doc)
+            if 'metadata' in doc:
+                flags[i] |= _FLAG_METADATA
+                fields.pop('metadata')
+                fields.update(doc['metadata'])
+
+            text = fields.get('text', '').encode('utf-8')
+            text_start = len(buffer)
+            buffer += text
+            for f, name in enumerate(TEXT_FIELDS):
+                value = fields.get(name)
+                if value is None or not isinstance(value, str):
+                    continue
+                encoded = value.encode('utf-8')
+                position = text.find(encoded) if name != 'text' else 0
+                if position >= 0:
+                    spans[i, f] = (text_start + position, text_start + position + len(encoded))
+                else:
+                    spans[i, f] = (len(buffer), len(buffer) + len(encoded))
+                    buffer += encoded
+
+            for f, name in enumerate(INTERNED_FIELDS):
+                if name not in fields:
+                    continue
+                key = json.dumps(fields[name], ensure_ascii=False)
+                value_id = value_ids.get(key)
+                if value_id is None:
+                    value_id = value_ids[key] = len(values)
+                    values.append(key)
+                interned[i, f] = value_id
+
+        # offsets ขนาด 32 bit พอสำหรับ buffer ไม่เกิน 2 GB
+        if len(buffer) < 2 ** 31:
+            spans = spans.astype(np.int32)
+        return cls(bytes(buffer), spans, interned, flags, values)
+
+    def save(self, prefix: str):
+        """เขียนเป็นไฟล์แยกตามคอลัมน์ เพื่อให้ load แบบ memory-mapped ได้"""
+        with open(prefix + '.buf.tmp', 'wb') as f:
+            f.write(self._buffer)
+        for name, array in (('spans', self._spans), ('interned', self._interned), ('flags', self._flags)):
+            with open(f"{prefix}.{name}.npy.tmp", 'wb') as f:
+                np.save(f, array)
+        with open(prefix + '.values.json.tmp', 'w', encoding='utf-8') as f:
+            json.dump(self._values, f, ensure_ascii=False)
+        for suffix in ('.buf', '.spans.npy', '.interned.npy', '.flags.npy', '.values.json'):
+            os.replace(prefix + suffix + '.tmp', prefix + suffix)
+
+    @classmethod
+    def load(cls, prefix: str) -> 'DocumentStore':
+        """Open a saved store; the buffer and columns are memory-mapped, not copied"""
+        with open(prefix + '.values.json', 'r', encoding='utf-8') as f:
+            values = json.load(f)
+        file = open(prefix + '.buf', 'rb')
+        size = os.fstat(file.fileno()).st_size
+        # mmap ไม่รองรับไฟล์ขนาด 0
+        buffer = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) if size else b''
+        store = cls(
+            buffer,
+            np.load(prefix + '.spans.npy', mmap_mode='r'),
+            np.load(prefix + '.interned.npy', mmap_mode='r'),
+            np.load(prefix + '.flags.npy', mmap_mode='r'),
+            values
+        )
+        store._file = file
+        return store
+
+    @staticmethod
+    def exists(prefix: str) -> bool:
+        return all(os.path.exists(prefix + suffix)
+                   for suffix in ('.buf', '.spans.npy', '.interned.npy', '.flags.npy', '.values.json'))
+
+    def __len__(self):
+        return len(self._flags)
+
+    def _text(self, i: int, f: int):
+        start, end = int(self._spans[i, f, 0]), int(self._spans[i, f, 1])
+        if start < 0:
+            return None
+        return self._buffer[start:end].decode('utf-8')
+
+    def _value(self, i: int, f: int):
+        value_id = int(self._interned[i, f])
+        if value_id < 0:
+            return None
+        return self._decoded_values[value_id]
+
+    def get_field(self, i: int, name: str):
+        """อ่านฟิลด์เดียวโดยไม่สร้าง dict ของทั้งเอกสาร"""
+        if name in TEXT_FIELDS:
+            return self._text(i, TEXT_FIELDS.index(name))
+        return self._value(i, INTERNED_FIELDS.index(name))
+
+    def has_metadata(self, i: int) -> bool:
+        return bool(self._flags[i] & _FLAG_METADATA)
+
+    def __getitem__(self, idx):
+        """Materialise a document in the same shape load_documents produced it"""
+        if isinstance(idx, slice):
+            return [self[i] for i in range(*idx.indices(len(self)))]
+        if idx < 0:
+            idx += len(self)
+        if idx < 0 or idx >= len(self):
+            raise IndexError("document index out of range")
+        fields = {}
+        for f, name in enumerate(TEXT_FIELDS):
+            value = self._text(idx, f)
+            if value is not None:
+                fields[name] = value
+        for f, name in enumerate(INTERNED_FIELDS):
+            value_id = int(self._interned[idx, f])
+            if value_id >= 0:
+                fields[name] = self._decoded_values[value_id]
+        if self.has_metadata(idx):
+            metadata = {name: fields.pop(name) for name in METADATA_FIELDS if name in fields}
+            fields['metadata'] = metadata
+        return fields
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def search_result(self, i: int, score: float) -> Dict:
+        """สร้าง dict ผลค้นหาเฉพาะฟิลด์ที่ search() คืน"""
+        result = {
+            'score': score,
+            'text': self._text(i, 0) or ''
+        }
+        question = self.get_field(i, 'question')
+        answer = self.get_field(i, 'answer')
+        if question is not None and answer is not None:
+            result['question'] = question
+            result['answer'] = answer
+        if self.has_metadata(i):
+            result.update({
+                'topic': self.get_field(i, 'topic'),
+                'content': self.get_field(i, 'content'),
+                'page': self.get_field(i, 'page'),
+                'title': self.get_field(i, 'title')
+            })
+            parent = self.get_field(i, 'parent')
+            if parent is not None:
+                result['parent'] = parent
+                result['chunk'] = self.get_field(i, 'chunk')
+        return result
@@ -0,0 +1,391 @@
+"""
+Sentence encoders for RAGSystem.
+
+ENCODER_BACKEND selects how queries and documents are embedded:
+
+    torch      SentenceTransformer on PyTorch (default)
+    onnx       the same model exported to ONNX, run with ONNX Runtime
+    onnx-int8  the ONNX model with dynamically quantised int8 weights
+
+The ONNX backends need onnxruntime and tokenizers (pip install onnxruntime)
+but neither torch nor sentence-transformers at runtime. Export the model
+once (this step does need torch):
+
+    python encoders.py export --model intfloat/multilingual-e5-base --quantize
+
+and compare the backends (top-k parity with torch, startup, latency, RSS):
+
+    python encoders.py compare --backends torch,onnx,onnx-int8
+"""
+import argparse
+import json
+import logging
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Dict, List
+
+import numpy as np
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# torch | onnx | onnx-int8
+ENCODER_BACKEND = os.getenv("ENCODER_BACKEND", "torch").lower()
+# โฟลเดอร์ของโมเดล ONNX (ว่าง = cache/onnx/<ชื่อโมเดล>)
+ENCODER_ONNX_DIR = os.getenv("ENCODER_ONNX_DIR", "")
+# จำนวน thread ของ ONNX Runtime (0 = ค่าเริ่มต้นของ onnxruntime)
+ENCODER_THREADS = int(os.getenv("ENCODER_THREADS", "0"))
+ONNX_FILE = "model.onnx"
+INT8_FILE = "model_int8.onnx"
+CONFIG_FILE = "encoder.json"
+
+BACKENDS = ("torch", "onnx", "onnx-int8")
+
+encoder_load_seconds = metrics.gauge("encoder_load_seconds", "Time to load the sentence encoder")
+
+
+def _slug(model_name: str) -> str:
+    return model_name.replace('/', '__').replace(':', '_')
+
+
+def onnx_dir(model_name: str) -> str:
+    if ENCODER_ONNX_DIR:
+        return ENCODER_ONNX_DIR
+    return os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cache', 'onnx', _slug(model_name))
+
+
+class TorchEncoder:
+    """SentenceTransformer on PyTorch; torch is imported only when this backend is created"""
+
+    name = "torch"
+
+    def __init__(self, model_name: str):
+        from sentence_transformers import SentenceTransformer
+        self.model = SentenceTransformer(model_name)
+        self.tokenizer = getattr(self.model, 'tokenizer', None)
+        self.cache_id = model_name
+
+    def encode(self, texts, batch_size: int = 32, convert_to_numpy: bool = True,
+               normalize_embeddings: bool = True) -> np.ndarray:
+        return self.model.encode(texts, batch_size=batch_size, convert_to_numpy=True,
+                                 normalize_embeddings=normalize_embeddings)
+
+    def get_sentence_embedding_dimension(self) -> int:
+        return self.model.get_sentence_embedding_dimension()
+
+
+class _TokenCounter:
+    """ให้ tokenizers.Tokenizer มี encode(text, add_special_tokens) แบบเดียวกับ tokenizer ของ transformers"""
+
+    def __init__(self, tokenizer):
+        self._tokenizer = tokenizer
+
+    def encode(self, text: str, add_special_tokens: bool = True) -> List[int]:
+        return self._tokenizer.encode(text, add_special_tokens=add_special_tokens).ids
+
+
+class OnnxEncoder:
+    """
+    Exported transformer run with ONNX Runtime on CPU.
+    Pooling and normalisation follow the SentenceTransformer the model was
+    exported from (settings saved in encoder.json).
+    """
+
+    def __init__(self, model_name: str, model_dir: str, quantized: bool = False):
+        import onnxruntime as ort
+        from tokenizers import Tokenizer
+
+        path = os.path.join(model_dir, INT8_FILE if quantized else ONNX_FILE)
+        if not os.path.exists(path):
+            raise FileNotFoundError(
+                f"{path} not found, export it with: python encoders.py export --model {model_name}"
+                + (" --quantize" if quantized else "")
+            )
+        with open(os.path.join(model_dir, CONFIG_FILE), 'r', encoding='utf-8') as f:
+            config = json.load(f)
+        if config.get('model') != model_name:
+            raise ValueError(f"{model_dir} was exported from {config.get('model')}, not {model_name}")
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if ENCODER_THREADS > 0:
+            options.intra_op_num_threads = ENCODER_THREADS
+        self.session = ort.InferenceSession(path, options, providers=['CPUExecutionProvider'])
+        self._input_names = {i.name for i in self.session.get_inputs()}
+
+        tokenizer_path = os.path.join(model_dir, 'tokenizer.json')
+        tokenizer = Tokenizer.from_file(tokenizer_path)
+        tokenizer.enable_truncation(config['max_length'])
+        tokenizer.enable_padding(pad_id=config['pad_token_id'], pad_token=config['pad_token'])
+        self._tokenizer = tokenizer
+        # ตัวนับ token ของ chunker ต้องเห็นความยาวจริง จึงใช้อีก instance ที่ไม่ตัด/ไม่ pad
+        counter = Tokenizer.from_file(tokenizer_path)
+        counter.no_truncation()
+        counter.no_padding()
+        self.tokenizer = _TokenCounter(counter)
+        self.pooling = config.get('pooling', 'mean')
+        self.dimension = config['dimension']
+        self.name = "onnx-int8" if quantized else "onnx"
+        # embedding ของ int8 ต่างจาก torch เล็กน้อย จึงแยก cache ของ index
+        self.cache_id = f"{model_name}+int8" if quantized else model_name
+
+    def _pool(self, hidden: np.ndarray, mask: np.ndarray) -> np.ndarray:
+        if self.pooling == 'cls':
+            return hidden[:, 0]
+        weights = mask[:, :, None].astype(np.float32)
+        return (hidden * weights).sum(axis=1) / np.maximum(weights.sum(axis=1), 1e-9)
+
+    def encode(self, texts, batch_size: int = 32, convert_to_numpy: bool = True,
+               normalize_embeddings: bool = True) -> np.ndarray:
+        single = isinstance(texts, str)
+        if single:
+            texts = [texts]
+        embeddings = np.zeros((len(texts), self.dimension), dtype=np.float32)
+        # เรียงตามความยาวเพื่อลด padding ในแต่ละ batch แล้วคืนตามลำดับเดิม
+        order = sorted(range(len(texts)), key=lambda i: -len(texts[i]))
+        for start in range(0, len(order), batch_size):
+            positions = order[start:start + batch_size]
+            encodings = self._tokenizer.encode_batch([texts[i] for i in positions])
+            input_ids = np.asarray([e.ids for e in encodings], dtype=np.int64)
+            attention_mask = np.asarray([e.attention_mask for e in encodings], dtype=np.int64)
+            feed = {'input_ids': input_ids, 'attention_mask': attention_mask}
+            if 'token_type_ids' in self._input_names:
+                feed['token_type_ids'] = np.zeros_like(input_ids)
+            hidden = self.session.run(None, feed)[0]
+            embeddings[positions] = self._pool(hidden, attention_mask)
+        if normalize_embeddings:
+            embeddings /= np.maximum(np.linalg.norm(embeddings, axis=1, keepdims=True), 1e-12)
+        return embeddings[0] if single else embeddings
+
+    def get_sentence_embedding_dimension(self) -> int:
+        return self.dimension
+
+
+def create_encoder(model_name: str, backend: str = ENCODER_BACKEND):
+    """สร้าง encoder ตาม backend ถ้าโหลดโมเดล ONNX ไม่ได้จะใช้ torch แทน"""
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown ENCODER_BACKEND '{backend}', expected one of: {', '.join(BACKENDS)}")
+    start = time.perf_counter()
+    encoder = None
+    if backend != "torch":
+        try:
+            encoder = OnnxEncoder(model_name, onnx_dir(model_name), quantized=backend == "onnx-int8")
+        except Exception as e:
+            logger.warning(f"Could not load {backend} encoder, falling back to torch: {e}")
+    if encoder is None:
+        encoder = TorchEncoder(model_name)
+    elapsed = time.perf_counter() - start
+    encoder_load_seconds.set(elapsed, backend=encoder.name)
+    logger.info(f"Loaded {encoder.name} encoder for {model_name} in {elapsed:.2f}s")
+    return encoder
+
+
+def export_onnx(model_name: str, output_dir: str, quantize: bool = True, opset: int = 17) -> Dict:
+    """Export the transformer of a SentenceTransformer to ONNX (and an int8 copy)"""
+    import torch
+    from sentence_transformers import SentenceTransformer
+
+    model = SentenceTransformer(model_name, device='cpu')
+    transformer = model[0].auto_model.eval()
+    tokenizer = model.tokenizer
+    pooling = next((module for module in model if type(module).__name__ == 'Pooling'), None)
+    os.makedirs(output_dir, exist_ok=True)
+    tokenizer.save_pretrained(output_dir)
+
+    sample = tokenizer(["ตัวอย่างข้อความ", "example"], padding=True, return_tensors='pt')
+    input_names = [name for name in ('input_ids', 'attention_mask', 'token_type_ids') if name in sample]
+
+    class HiddenState(torch.nn.Module):
+        def __init__(self, inner):
+            super().__init__()
+            self.inner = inner
+
+        def forward(self, *inputs):
+            return self.inner(**dict(zip(input_names, inputs)))[0]
+
+    path = os.path.join(output_dir, ONNX_FILE)
+    dynamic_axes = {name: {0: 'batch', 1: 'sequence'} for name in input_names + ['last_hidden_state']}
+    with torch.no_grad():
+        torch.onnx.export(HiddenState(transformer), tuple(sample[name] for name in input_names), path,
+                          input_names=input_names, output_names=['last_hidden_state'],
+                          dynamic_axes=dynamic_axes, opset_version=opset)
+    logger.info(f"Exported {model_name} to {path}")
+
+    if quantize:
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+        int8_path = os.path.join(output_dir, INT8_FILE)
+        quantize_dynamic(path, int8_path, weight_type=QuantType.QInt8)
+        logger.info(f"Quantised int8 model written to {int8_path}")
+
+    config = {
+        'model': model_name,
+        'dimension': model.get_sentence_embedding_dimension(),
+        'pooling': 'cls' if pooling is not None and pooling.pooling_mode_cls_token else 'mean',
+        'max_length': model.max_seq_length,
+        'pad_token': tokenizer.pad_token,
+        'pad_token_id': tokenizer.pad_token_id,
+        'opset': opset,
+    }
+    with open(os.path.join(output_dir, CONFIG_FILE), 'w', encoding='utf-8') as f:
+        json.dump(config, f, ensure_ascii=False, indent=2)
+    return config
+
+
+def _corpus(limit: int):
+    """ข้อความเอกสารและคำถามทดสอบจาก data/json (คำถามของ Q&A และหัวข้อของ section)"""
+    import ingest
+    json_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'json')
+    texts, queries = [], []
+    for name in sorted(f for f in os.listdir(json_dir) if f.endswith('.json')):
+        for doc in ingest.parse_file(os.path.join(json_dir, name), name):
+            texts.append(doc['text'])
+            query = doc.get('question') or (doc.get('metadata') or {}).get('topic')
+            if query:
+                queries.append(query)
+    return texts, queries[:limit]
+
+
+def _measure(model_name: str, backend: str, output: str, queries_limit: int, repeats: int):
+    """วัดหนึ่ง backend ใน process ของตัวเอง เพื่อให้เวลาเริ่มต้นและ RSS ไม่ปนกัน"""
+    start = time.perf_counter()
+    encoder = create_encoder(model_name, backend)
+    encoder.encode(["warm up"])
+    startup = time.perf_counter() - start
+    rss_loaded = metrics.process_memory().get('rss', 0)
+
+    texts, queries = _corpus(queries_limit)
+    start = time.perf_counter()
+    documents = encoder.encode(texts, batch_size=32)
+    corpus_seconds = time.perf_counter() - start
+
+    latencies = [0.0]
+    for _ in range(repeats):
+        for query in queries:
+            start = time.perf_counter()
+            encoder.encode([query])
+            latencies.append(time.perf_counter() - start)
+    latencies = latencies[1:] or latencies
+    query_embeddings = encoder.encode(queries, batch_size=32)
+
+    np.savez(output, documents=documents, queries=query_embeddings)
+    latencies_ms = np.asarray(latencies) * 1000
+    print(json.dumps({
+        'backend': encoder.name,
+        'startup_seconds': round(startup, 3),
+        'rss_mb': round(rss_loaded / 2 ** 20, 1),
+        'peak_rss_mb': round(_peak_rss() / 2 ** 20, 1),
+        'query_p50_ms': round(float(np.percentile(latencies_ms, 50)), 2),
+        'query_p95_ms': round(float(np.percentile(latencies_ms, 95)), 2),
+        'corpus_docs_per_second': round(len(texts) / corpus_seconds, 1) if corpus_seconds else None,
+        'documents': len(texts),
+        'queries': len(queries),
+    }))
+
+
+def _peak_rss() -> int:
+    """RSS สูงสุดของ process นี้เป็น bytes (ru_maxrss เป็น KB บน Linux แต่เป็น bytes บน macOS)"""
+    import resource
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def _top_k(documents: np.ndarray, queries: np.ndarray, k: int) -> np.ndarray:
+    scores = queries @ documents.T
+    return np.argsort(-scores, axis=1)[:, :k]
+
+
+def parity(reference: Dict[str, np.ndarray], candidate: Dict[str, np.ndarray], k: int) -> Dict:
+    """
+    ความสอดคล้องกับ backend อ้างอิง: สัดส่วน top-k ที่ตรงกัน (แต่ละ backend ค้นใน embedding
+    ของตัวเอง เหมือนตอนใช้งานจริง), top-1 ที่ตรงกัน และ cosine ของ embedding ข้อความเดียวกัน
+    """
+    expected = _top_k(reference['documents'], reference['queries'], k)
+    actual = _top_k(candidate['documents'], candidate['queries'], k)
+    overlap = np.mean([len(set(e) & set(a)) / k for e, a in zip(expected, actual)])
+    cosine = np.sum(reference['documents'] * candidate['documents'], axis=1)
+    return {
+        f'top{k}_overlap': round(float(overlap), 4),
+        'top1_agreement': round(float(np.mean(expected[:, 0] == actual[:, 0])), 4),
+        'min_cosine': round(float(cosine.min()), 4),
+        'mean_cosine': round(float(cosine.mean()), 4),
+    }
+
+
+def compare(model_name: str, backends: List[str], k: int, queries_limit: int, repeats: int,
+            min_overlap: float) -> int:
+    results = []
+    embeddings = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        for backend in backends:
+            output = os.path.join(tmp, f"{backend}.npz")
+            process = subprocess.run(
+                [sys.executable, os.path.abspath(__file__), 'measure', '--model', model_name,
+                 '--backend', backend, '--output', output, '--queries', str(queries_limit),
+                 '--repeats', str(repeats)],
+                capture_output=True, text=True
+            )
+            if process.returncode != 0:
+                logger.error(f"{backend} failed:\n{process.stderr[-2000:]}")
+                continue
+            result = json.loads(process.stdout.strip().splitlines()[-1])
+            if result['backend'] != backend:
+                logger.error(f"{backend} was not available (loaded {result['backend']} instead)")
+                continue
+            with np.load(output) as data:
+                embeddings[backend] = {'documents': data['documents'], 'queries': data['queries']}
+            results.append(result)
+
+    reference = backends[0]
+    failed = False
+    for result in results:
+        if result['backend'] != reference and reference in embeddings:
+            result.update(parity(embeddings[reference], embeddings[result['backend']], k))
+            failed |= result[f'top{k}_overlap'] < min_overlap
+    print(json.dumps(results, ensure_ascii=False, indent=2))
+    if len(results) < len(backends) or failed:
+        return 1
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export and compare sentence encoder backends")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    export = commands.add_parser('export', help="export the model to ONNX (requires torch)")
+    export.add_argument('--model', default='intfloat/multilingual-e5-base')
+    export.add_argument('--output', default=None, help="default: ENCODER_ONNX_DIR or cache/onnx/<model>")
+    export.add_argument('--quantize', action='store_true', help="also write a dynamically quantised int8 model")
+    export.add_argument('--opset', type=int, default=17)
+
+    comparison = commands.add_parser('compare', help="parity, startup time, latency and RSS per backend")
+    comparison.add_argument('--model', default='intfloat/multilingual-e5-base')
+    comparison.add_argument('--backends', default=','.join(BACKENDS),
+                            help="comma separated; the first one is the parity reference")
+    comparison.add_argument('--k', type=int, default=5)
+    comparison.add_argument('--queries', type=int, default=200)
+    comparison.add_argument('--repeats', type=int, default=3)
+    comparison.add_argument('--min-overlap', type=float, default=0.9)
+
+    measure = commands.add_parser('measure')
+    measure.add_argument('--model', required=True)
+    measure.add_argument('--backend', required=True)
+    measure.add_argument('--output', required=True)
+    measure.add_argument('--queries', type=int, default=200)
+    measure.add_argument('--repeats', type=int, default=3)
+
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, stream=sys.stderr)
+    if args.command == 'export':
+        export_onnx(args.model, args.output or onnx_dir(args.model), args.quantize, args.opset)
+    elif args.command == 'compare':
+        sys.exit(compare(args.model, args.backends.split(','), args.k, args.queries, args.repeats, args.min_overlap))
+    else:
+        _measure(args.model, args.backend, args.output, args.queries, args.repeats)
+
+
+if __name__ == "__main__":
+    main()
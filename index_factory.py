@@ -0,0 +1,181 @@
+import logging
+import os
+import time
+from typing import Dict
+
+import faiss
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# auto | flat | ivf | hnsw | ivfsq8 | ivfpq
+INDEX_TYPE = os.getenv("INDEX_TYPE", "auto").lower()
+INDEX_FLAT_MAX_DOCS = int(os.getenv("INDEX_FLAT_MAX_DOCS", "20000"))
+INDEX_IVF_MAX_DOCS = int(os.getenv("INDEX_IVF_MAX_DOCS", "1000000"))
+INDEX_MEMORY_BUDGET_MB = float(os.getenv("INDEX_MEMORY_BUDGET_MB", "2048"))
+INDEX_TARGET_RECALL = float(os.getenv("INDEX_TARGET_RECALL", "0.95"))
+INDEX_TUNING_QUERIES = int(os.getenv("INDEX_TUNING_QUERIES", "200"))
+
+HNSW_M = 32
+# FAISS แนะนำให้มีจุด train อย่างน้อย 39 จุดต่อ cluster
+MIN_POINTS_PER_CENTROID = 39
+
+
+def settings() -> Dict:
+    """ค่าที่มีผลต่อการเลือก index หากเปลี่ยนต้องสร้าง index ใหม่"""
+    return {
+        'type': INDEX_TYPE,
+        'flat_max_docs': INDEX_FLAT_MAX_DOCS,
+        'ivf_max_docs': INDEX_IVF_MAX_DOCS,
+        'memory_budget_mb': INDEX_MEMORY_BUDGET_MB,
+        'target_recall': INDEX_TARGET_RECALL,
+    }
+
+
+def _nlist(n: int) -> int:
+    return max(1, min(int(4 * np.sqrt(n)), n // MIN_POINTS_PER_CENTROID, 65536))
+
+
+def _pq_subquantizers(dimension: int) -> int:
+    # ใช้ประมาณ 1 byte ต่อ 8 มิติ และต้องหาร dimension ลงตัว
+    for m in range(max(1, dimension // 8), 0, -1):
+        if dimension % m == 0:
+            return m
+    return 1
+
+
+def _pq_nbits(n: int) -> int:
+    # PQ ต้องมีจุด train อย่างน้อย 2^nbits จุด ลดจำนวนบิตลงเมื่อ corpus เล็ก
+    return max(1, min(8, int(np.log2(max(2, n)))))
+
+
+def estimate_memory_mb(index_type: str, n: int, dimension: int) -> float:
+    if index_type in ('flat', 'ivf'):
+        per_vector = dimension * 4
+    elif index_type == 'hnsw':
+        per_vector = dimension * 4 + HNSW_M * 2 * 4
+    elif index_type == 'ivfsq8':
+        per_vector = dimension
+    else:
+        per_vector = _pq_subquantizers(dimension)
+    return n * (per_vector + 8) / (1024 * 1024)
+
+
+def choose_index_config(n: int, dimension: int, index_type: str = None) -> Dict:
+    """เลือกชนิด index ตามจำนวนเอกสารและงบหน่วยความจำ (index_type ระบุชนิดเองได้ ค่าเริ่มต้นคือ INDEX_TYPE)"""
+    index_type = index_type or INDEX_TYPE
+    if index_type == 'auto':
+        fits = lambda t: estimate_memory_mb(t, n, dimension) <= INDEX_MEMORY_BUDGET_MB
+        if n <= INDEX_FLAT_MAX_DOCS and fits('flat'):
+            index_type = 'flat'
+        elif n <= INDEX_IVF_MAX_DOCS and fits('ivf'):
+            index_type = 'ivf'
+        elif fits('hnsw'):
+            index_type = 'hnsw'
+        elif fits('ivfsq8'):
+            index_type = 'ivfsq8'
+        else:
+            index_type = 'ivfpq'
+
+    config = {'type': index_type, 'n': n, 'dimension': dimension}
+    if index_type in ('ivf', 'ivfsq8', 'ivfpq'):
+        config['nlist'] = _nlist(n)
+    if index_type == 'ivfpq':
+        config['pq_m'] = _pq_subquantizers(dimension)
+        config['pq_nbits'] = _pq_nbits(n)
+    if index_type == 'hnsw':
+        config['hnsw_m'] = HNSW_M
+    config['memory_mb'] = round(estimate_memory_mb(index_type, n, dimension), 2)
+    return config
+
+
+def build_index(embeddings: np.ndarray, config: Dict):
+    """Build and fill an inner-product index described by config"""
+    dimension = embeddings.shape[1]
+    index_type = config['type']
+    metric = faiss.METRIC_INNER_PRODUCT
+    if index_type == 'flat':
+        index = faiss.IndexFlatIP(dimension)
+    elif index_type == 'hnsw':
+        index = faiss.IndexHNSWFlat(dimension, config.get('hnsw_m', HNSW_M), metric)
+    else:
+        quantizer = faiss.IndexFlatIP(dimension)
+        if index_type == 'ivf':
+            index = faiss.IndexIVFFlat(quantizer, dimension, config['nlist'], metric)
+        elif index_type == 'ivfsq8':
+            index = faiss.IndexIVFScalarQuantizer(quantizer, dimension, config['nlist'],
+                                                  faiss.ScalarQuantizer.QT_8bit, metric)
+        else:
+            index = faiss.IndexIVFPQ(quantizer, dimension, config['nlist'], config['pq_m'],
+                                   config.get('pq_nbits', 8), metric)
+        index.train(embeddings)
+    index.add(embeddings)
+    return index
+
+
+def apply_search_params(index, config: Dict):
+    """ตั้งค่า nprobe / efSearch ที่ปรับไว้แล้วให้กับ index"""
+    if 'nprobe' in config:
+        try:
+            faiss.extract_index_ivf(index).nprobe = config['nprobe']
+        except Exception:
+            pass
+    if 'ef_search' in config and hasattr(index, 'hnsw'):
+        index.hnsw.efSearch = config['ef_search']
+
+
+def _recall(index, queries: np.ndarray, truth: np.ndarray, k: int) -> float:
+    _, found = index.search(queries, k)
+    hits = sum(len(set(f) & set(t)) for f, t in zip(found.tolist(), truth.tolist()))
+    return hits / float(truth.size)
+
+
+def held_out_queries(embeddings: np.ndarray, count: int = INDEX_TUNING_QUERIES, seed: int = 0) -> np.ndarray:
+    """
+    สร้างชุดคำถามทดสอบจากเอกสารสุ่มที่ถูกรบกวนด้วย noise
+    ให้ไม่ตรงกับเวกเตอร์ใน index พอดี
+    """
+    rng = np.random.default_rng(seed)
+    picks = rng.choice(len(embeddings), size=min(count, len(embeddings)), replace=False)
+    queries = np.asarray(embeddings[picks], dtype='float32')
+    queries = queries + rng.normal(scale=0.05, size=queries.shape).astype('float32')
+    queries /= np.linalg.norm(queries, axis=1, keepdims=True)
+    return queries
+
+
+def tune_index(index, config: Dict, embeddings: np.ndarray, queries: np.ndarray = None,
+               k: int = 5, target_recall: float = INDEX_TARGET_RECALL) -> Dict:
+    """
+    Pick the smallest nprobe / efSearch whose recall@k against exact search
+    reaches target_recall, and record it in config.
+    """
+    if config['type'] == 'flat':
+        config['recall'] = 1.0
+        return config
+
+    if queries is None:
+        queries = held_out_queries(embeddings)
+    k = min(k, len(embeddings))
+    # ผลลัพธ์ที่ถูกต้องจากการค้นหาแบบ exact
+    scores = queries @ np.asarray(embeddings, dtype='float32').T
+    truth = np.argsort(-scores, axis=1)[:, :k]
+
+    if config['type'] == 'hnsw':
+        param, candidates = 'ef_search', [16, 32, 64, 128, 256, 512, 1024]
+    else:
+        param = 'nprobe'
+        candidates = [p for p in (1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024) if p < config['nlist']] + [config['nlist']]
+
+    recall = 0.0
+    for value in candidates:
+        config[param] = value
+        apply_search_params(index, config)
+        start = time.perf_counter()
+        recall = _recall(index, queries, truth, k)
+        latency_ms = (time.perf_counter() - start) * 1000 / len(queries)
+        if recall >= target_recall:
+            break
+    config['recall'] = round(recall, 4)
+    config['tuned_latency_ms'] = round(latency_ms, 4)
+    logger.info(f"Tuned {config['type']} index: {param}={config[param]} recall@{k}={recall:.3f}")
+    return config
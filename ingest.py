@@ -0,0 +1,321 @@
+"""
+Document ingestion for the RAG index.
+
+Files are read as a stream of top-level JSON array items, each item is
+turned into documents by the first registered loader that recognises it,
+and files are parsed in a thread pool while the calling thread chunks and
+encodes the documents in batches as they arrive.
+
+    python ingest.py --workers 4            # parse only, documents per loader and docs/s
+    python ingest.py --workers 4 --encode   # parse + chunk + encode
+"""
+import argparse
+import json
+import logging
+import os
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Iterator, List, Tuple
+
+import numpy as np
+
+import chunker
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# จำนวน thread ที่อ่าน/แปลงไฟล์พร้อมกัน และจำนวนเอกสารต่อหนึ่ง batch ที่ส่งให้ encoder
+INGEST_WORKERS = int(os.getenv("INGEST_WORKERS", "4"))
+INGEST_BATCH_SIZE = int(os.getenv("INGEST_BATCH_SIZE", "32"))
+# จำนวนชุดเอกสารที่รอ encode ได้ก่อน parser ต้องหยุดรอ (จำกัดหน่วยความจำเมื่อ encode ช้ากว่า parse)
+INGEST_QUEUE_SIZE = int(os.getenv("INGEST_QUEUE_SIZE", "16"))
+READ_SIZE = 1 << 16
+
+documents_total = metrics.counter("ingest_documents_total", "Documents produced by each loader")
+ingest_rate = metrics.gauge("ingest_docs_per_second", "Documents parsed, chunked and encoded per second in the last ingest")
+ingest_seconds = metrics.histogram("ingest_duration_seconds", "Time to parse and encode the changed files")
+
+
+class Loader:
+    """One file format: detect(item) recognises a top-level item, convert(item, source) yields its documents"""
+
+    def __init__(self, name: str, detect: Callable[[Dict], bool], convert: Callable[[Dict, str], Iterator[Dict]]):
+        self.name = name
+        self.detect = detect
+        self.convert = convert
+
+
+LOADERS: List[Loader] = []
+
+
+def register_loader(name: str, detect: Callable[[Dict], bool]):
+    """Decorator ลงทะเบียนรูปแบบไฟล์ (ตรวจตามลำดับที่ลงทะเบียน ตัวแรกที่ตรงจะถูกใช้)"""
+    def decorator(convert):
+        LOADERS.append(Loader(name, detect, convert))
+        return convert
+    return decorator
+
+
+def find_loader(item) -> Loader:
+    if isinstance(item, dict):
+        for loader in LOADERS:
+            if loader.detect(item):
+                return loader
+    return None
+
+
+@register_loader("part_sections", lambda item: "part" in item and "sections" in item)
+def _part_sections(item: Dict, source: str) -> Iterator[Dict]:
+    # doc.json: ส่วน > sections พร้อมสรุปและคำสำคัญ
+    part = item.get("part")
+    title = item.get("title", "")
+    for section in item.get("sections", []):
+        topic = section.get("topic", "")
+        content = section.get("content", "")
+        page = section.get("page", "")
+        summary = section.get("summary", "")
+        keywords = section.get("keywords", [])
+        text = f"ส่วนที่ {part} เรื่อง: {title} หน้า {page} หัวข้อ: {topic} สรุป: {summary} คำสำคัญ: {', '.join(keywords)} เนื้อหา: {content}"
+        yield {
+            'text': text,
+            "metadata": {
+                'part': part,
+                'title': title,
+                'topic': topic,
+                'content': content,
+                'page': page,
+                'summary': summary,
+                'keywords': keywords,
+                'source': source
+            }
+        }
+
+
+@register_loader("part_data", lambda item: "part" in item and isinstance(item.get("data"), list))
+def _part_data(item: Dict, source: str) -> Iterator[Dict]:
+    # part/title/data: ส่วน > รายการหน้า/หัวข้อ/เนื้อหา
+    part = item.get("part")
+    title = item.get("title", "")
+    for entry in item.get("data", []):
+        page = entry.get("page")
+        topic = entry.get("topic", "")
+        content = entry.get("content", "")
+        yield {
+            'text': f"ส่วนที่ {part} เรื่อง: {title} หน้า {page} หัวข้อ: {topic} เนื้อหา: {content}",
+            "metadata": {
+                'part': part,
+                'title': title,
+                'topic': topic,
+                'content': content,
+                'page': page,
+                'source': source
+            }
+        }
+
+
+@register_loader("qa", lambda item: "question" in item and "answer" in item)
+def _qa(item: Dict, source: str) -> Iterator[Dict]:
+    yield {
+        'text': f"{item['question']} {item['answer']}",
+        'question': item['question'],
+        'answer': item['answer'],
+        'source': source
+    }
+
+
+def iter_json_array(f, read_size: int = READ_SIZE) -> Iterator:
+    """
+    Yield the items of a top-level JSON array one at a time, reading the file
+    in read_size pieces; only the current item and one read buffer are held
+    in memory. A file that is not an array is yielded as a single item.
+    """
+    decoder = json.JSONDecoder()
+    buffer = f.read(read_size).lstrip('\ufeff \t\r\n')
+    if not buffer.startswith('['):
+        yield json.loads(buffer + f.read())
+        return
+
+    pos, eof, expect_item, after_comma = 1, False, True, False
+    while True:
+        # ข้ามช่องว่าง อ่านเพิ่มเมื่อถึงท้าย buffer
+        while True:
+            while pos < len(buffer) and buffer[pos].isspace():
+                pos += 1
+            if pos < len(buffer) or eof:
+                break
+            chunk = f.read(read_size)
+            eof = not chunk
+            buffer, pos = buffer[pos:] + chunk, 0
+        if pos >= len(buffer):
+            raise ValueError("Unexpected end of file inside a JSON array")
+        if buffer[pos] == ']':
+            # json.load ไม่รับ comma ก่อน ] (เช่น [1,]) จึงไม่รับเช่นกัน
+            if after_comma:
+                raise ValueError("Trailing comma before ']' in JSON array")
+            return
+        if not expect_item:
+            if buffer[pos] != ',':
+                raise ValueError(f"Expected ',' or ']' in JSON array, got {buffer[pos]!r}")
+            pos, expect_item, after_comma = pos + 1, True, True
+            continue
+
+        while True:
+            try:
+                item, end = decoder.raw_decode(buffer, pos)
+                if end < len(buffer) or eof:
+                    break
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+            # item ยังไม่ครบใน buffer: ทิ้งส่วนที่อ่านแล้วและอ่านต่อ
+            chunk = f.read(read_size)
+            eof = not chunk
+            buffer, pos = buffer[pos:] + chunk, 0
+        yield item
+        pos, expect_item, after_comma = end, False, False
+
+
+def parse_file(file_path: str, source: str) -> Iterator[Dict]:
+    """เอกสารของไฟล์หนึ่งไฟล์ทีละรายการ ตามรูปแบบที่ loader รู้จัก"""
+    counts = {}
+    skipped = 0
+    with open(file_path, 'r', encoding='utf-8') as f:
+        for item in iter_json_array(f):
+            loader = find_loader(item)
+            if loader is None:
+                skipped += 1
+                continue
+            for doc in loader.convert(item, source):
+                counts[loader.name] = counts.get(loader.name, 0) + 1
+                yield doc
+    for name, count in counts.items():
+        documents_total.inc(count, loader=name)
+    if skipped and not counts:
+        logger.warning(f"Unknown JSON structure in file: {source}")
+    elif skipped:
+        logger.warning(f"Skipped {skipped} unrecognised items in {source}")
+    logger.debug(f"Parsed {source}: {counts}")
+
+
+def ingest(files: List[Tuple[str, str]], encode: Callable[[List[str]], np.ndarray],
+           count_tokens: Callable[[str], int], dimension: int,
+           workers: int = INGEST_WORKERS, batch_size: int = INGEST_BATCH_SIZE) -> Dict[str, Tuple[List[Dict], np.ndarray]]:
+    """
+    Parse (source, path) files in a thread pool and encode their documents
+    while parsing continues. Chunking and encoding stay on the calling thread
+    so the encoder's tokenizer is never used from two threads; the encoder
+    releases the GIL while it computes, which is when the parsers run.
+
+    Returns {source: (documents, embeddings)}; a file that fails to parse
+    gets no documents.
+    """
+    pending = queue.Queue(maxsize=max(1, INGEST_QUEUE_SIZE))
+    stop = threading.Event()
+
+    def put(message):
+        while not stop.is_set():
+            try:
+                pending.put(message, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def parse(source, path):
+        batch = []
+        try:
+            for doc in parse_file(path, source):
+                batch.append(doc)
+                if len(batch) >= batch_size:
+                    put((source, batch, False))
+                    batch = []
+            put((source, batch, True))
+        except Exception as e:
+            logger.error(f"Error loading file {source}: {str(e)}")
+            put((source, None, True))
+
+    start = time.perf_counter()
+    results = {}
+    buffers = {source: ([], [], []) for source, _ in files}  # (documents, รอ encode, embeddings)
+    remaining = len(files)
+    total = 0
+    executor = ThreadPoolExecutor(max_workers=max(1, min(workers, len(files))), thread_name_prefix="ingest")
+    try:
+        for source, path in files:
+            executor.submit(parse, source, path)
+        while remaining:
+            source, docs, last = pending.get()
+            documents, waiting, embeddings = buffers[source]
+            if docs is None:
+                # ไฟล์เสีย: ทิ้งส่วนที่อ่านได้แล้ว ไม่ใช้ไฟล์ครึ่งเดียว
+                documents.clear()
+                waiting.clear()
+                embeddings.clear()
+            else:
+                waiting.extend(chunker.chunk_documents(docs, count_tokens))
+            while len(waiting) >= batch_size or (last and waiting):
+                batch, waiting[:] = waiting[:batch_size], waiting[batch_size:]
+                embeddings.append(encode([doc['text'] for doc in batch]))
+                documents.extend(batch)
+            if last:
+                remaining -= 1
+                del buffers[source]
+                results[source] = (
+                    documents,
+                    np.vstack(embeddings).astype('float32') if embeddings else np.zeros((0, dimension), dtype='float32')
+                )
+                total += len(documents)
+    finally:
+        stop.set()
+        executor.shutdown(wait=True)
+
+    elapsed = time.perf_counter() - start
+    rate = total / elapsed if elapsed > 0 else 0.0
+    ingest_seconds.observe(elapsed)
+    ingest_rate.set(rate)
+    logger.info(f"Ingested {total} documents from {len(files)} files in {elapsed:.2f}s ({rate:.1f} docs/s)")
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Parse (and optionally encode) the documents in data/json")
+    parser.add_argument('files', nargs='*', help="JSON files (default: every file in data/json)")
+    parser.add_argument('--workers', type=int, default=INGEST_WORKERS)
+    parser.add_argument('--batch-size', type=int, default=INGEST_BATCH_SIZE)
+    parser.add_argument('--encode', action='store_true', help="also chunk and encode with ENCODER_BACKEND")
+    parser.add_argument('--model', default='intfloat/multilingual-e5-base')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    paths = args.files
+    if not paths:
+        json_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'json')
+        paths = [os.path.join(json_dir, name) for name in sorted(os.listdir(json_dir)) if name.endswith('.json')]
+    files = [(os.path.basename(path), path) for path in paths]
+
+    if args.encode:
+        from encoders import create_encoder
+        encoder = create_encoder(args.model)
+        tokenizer = getattr(encoder, 'tokenizer', None)
+        count_tokens = (lambda text: len(tokenizer.encode(text, add_special_tokens=False))) if tokenizer else chunker.approximate_tokens
+        encode = lambda texts: encoder.encode(texts, batch_size=args.batch_size, convert_to_numpy=True, normalize_embeddings=True)
+        results = ingest(files, encode, count_tokens, encoder.get_sentence_embedding_dimension(), args.workers, args.batch_size)
+        for source, (documents, embeddings) in results.items():
+            print(f"{source}: {len(documents)} documents, embeddings {embeddings.shape}")
+        return
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max(1, args.workers)) as executor:
+        counts = list(executor.map(lambda f: (f[0], sum(1 for _ in parse_file(f[1], f[0]))), files))
+    elapsed = time.perf_counter() - start
+    total = sum(count for _, count in counts)
+    for source, count in counts:
+        print(f"{source}: {count} documents")
+    for loader in LOADERS:
+        print(f"  {loader.name}: {documents_total.value(loader=loader.name):g}")
+    print(f"{total} documents in {elapsed:.3f}s ({total / elapsed if elapsed else 0:.1f} docs/s)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,176 @@
+import logging
+import math
+import os
+import re
+from collections import defaultdict
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# auto = ใช้ pythainlp ถ้าติดตั้งไว้ ไม่เช่นนั้นใช้ character n-gram | pythainlp | ngram
+LEXICAL_TOKENIZER = os.getenv("LEXICAL_TOKENIZER", "auto").lower()
+LEXICAL_KEYWORD_BOOST = float(os.getenv("LEXICAL_KEYWORD_BOOST", "3.0"))
+LEXICAL_TOPIC_BOOST = float(os.getenv("LEXICAL_TOPIC_BOOST", "2.0"))
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+_THAI_RUN = re.compile(r'[\u0e00-\u0e7f]+')
+_TOKEN = re.compile(r'https?://\S+|[a-z0-9]+(?:[._/\-][a-z0-9]+)*|[\u0e00-\u0e7f]+')
+_ZERO_WIDTH = re.compile(r'[\u200b-\u200d\u2060\ufeff]')
+_PUNCTUATION = re.compile(r'[\s?？!.,…"\'“”‘’()\[\]:;]+')
+
+_word_tokenize = None
+if LEXICAL_TOKENIZER in ('auto', 'pythainlp'):
+    try:
+        from pythainlp.tokenize import word_tokenize as _word_tokenize
+    except ImportError:
+        if LEXICAL_TOKENIZER == 'pythainlp':
+            logger.warning("pythainlp is not installed, falling back to character n-grams")
+
+
+def fix_thai(text: str) -> str:
+    # ข้อความที่แปลงจาก PDF มักใช้ นิคหิต + สระอา แทน สระอำ
+    return text.replace('\u0e4d\u0e32', '\u0e33')
+
+
+def normalize_text(text: str) -> str:
+    """รูปแบบมาตรฐานสำหรับเทียบข้อความแบบตรงตัว"""
+    text = fix_thai(_ZERO_WIDTH.sub('', text or '')).lower()
+    return _PUNCTUATION.sub('', text)
+
+
+def _thai_tokens(run: str) -> List[str]:
+    if _word_tokenize is not None:
+        return [t for t in _word_tokenize(run, keep_whitespace=False) if t.strip()]
+    # ภาษาไทยไม่เว้นวรรคระหว่างคำ ใช้ bigram + trigram ของตัวอักษรแทนการตัดคำ
+    if len(run) < 3:
+        return [run]
+    return [run[i:i + 2] for i in range(len(run) - 1)] + [run[i:i + 3] for i in range(len(run) - 2)]
+
+
+def tokenize(text: str) -> List[str]:
+    tokens = []
+    text = fix_thai(_ZERO_WIDTH.sub('', text or '')).lower()
+    for token in _TOKEN.findall(text):
+        if _THAI_RUN.fullmatch(token):
+            tokens.extend(_thai_tokens(token))
+        else:
+            tokens.append(token)
+            # URL/ชื่อไฟล์: เก็บทั้งคำและส่วนย่อย เพื่อให้ค้นด้วยบางส่วนได้
+            if len(token) > 1 and re.search(r'[._/\-:]', token):
+                tokens.extend(t for t in re.split(r'[^a-z0-9]+', token) if t)
+    return tokens
+
+
+class LexicalIndex:
+    """
+    In-memory BM25 inverted index over the document store.
+
+    The 'keywords' and 'topic' fields (and the question of a Q&A pair) are
+    counted with a boosted term frequency on top of the full 'text'.
+    BM25 weights are precomputed per posting so a query is a handful of
+    numpy scatter-adds.
+    """
+
+    def __init__(self, postings: Dict[str, Tuple[np.ndarray, np.ndarray]], size: int,
+                 exact: Dict[str, int]):
+        self._postings = postings
+        self._size = size
+        self._exact = exact
+
+    @classmethod
+    def from_store(cls, documents) -> 'LexicalIndex':
+        term_docs = defaultdict(list)
+        term_freqs = defaultdict(list)
+        lengths = np.zeros(len(documents), dtype=np.float32)
+        exact = {}
+        owners = {}
+
+        for i in range(len(documents)):
+            weighted = defaultdict(float)
+            for token in tokenize(documents.get_field(i, 'text') or ''):
+                weighted[token] += 1.0
+            fields = (
+                ('question', LEXICAL_TOPIC_BOOST),
+                ('topic', LEXICAL_TOPIC_BOOST),
+                ('keywords', LEXICAL_KEYWORD_BOOST),
+            )
+            for name, boost in fields:
+                value = documents.get_field(i, name)
+                if not value:
+                    continue
+                if isinstance(value, list):
+                    value = ' '.join(str(v) for v in value)
+                # text มีฟิลด์เหล่านี้อยู่แล้ว จึงเพิ่มเฉพาะส่วนที่ boost
+                for token in tokenize(value):
+                    weighted[token] += boost - 1.0
+            lengths[i] = sum(weighted.values())
+            for token, tf in weighted.items():
+                term_docs[token].append(i)
+                term_freqs[token].append(tf)
+
+            # คำถามหรือหัวข้อที่ตรงตัว ใช้เป็นทางลัดโดยไม่ต้อง encode
+            # chunk ของ section เดียวกันมีหัวข้อซ้ำกัน: นับเป็นเจ้าของเดียวและชี้ไปที่ chunk แรก
+            owner = documents.get_field(i, 'parent') or i
+            for name in ('question', 'topic'):
+                key = normalize_text(documents.get_field(i, name) or '')
+                if not key:
+                    continue
+                if key not in exact:
+                    exact[key] = i
+                    owners[key] = owner
+                elif owners[key] != owner:
+                    exact[key] = -1
+
+        n = len(documents)
+        avg_length = float(lengths.mean()) if n else 0.0
+        postings = {}
+        for token, docs in term_docs.items():
+            docs = np.asarray(docs, dtype=np.int32)
+            tf = np.asarray(term_freqs[token], dtype=np.float32)
+            idf = math.log(1 + (n - len(docs) + 0.5) / (len(docs) + 0.5))
+            norm = BM25_K1 * (1 - BM25_B + BM25_B * lengths[docs] / max(avg_length, 1e-6))
+            postings[token] = (docs, (idf * tf * (BM25_K1 + 1) / (tf + norm)).astype(np.float32))
+
+        # ข้อความที่ซ้ำกันหลายเอกสารไม่ถือว่าตรงแบบมั่นใจ
+        exact = {key: i for key, i in exact.items() if i >= 0}
+        logger.info(f"Built lexical index: {len(postings)} terms over {n} documents")
+        return cls(postings, n, exact)
+
+    def __len__(self):
+        return self._size
+
+    def search(self, query: str, k: int = 20) -> List[Tuple[int, float]]:
+        """คืน [(doc_id, bm25_score)] เรียงจากคะแนนสูงไปต่ำ"""
+        terms = set(tokenize(query))
+        scores = None
+        for term in terms:
+            posting = self._postings.get(term)
+            if posting is None:
+                continue
+            if scores is None:
+                scores = np.zeros(self._size, dtype=np.float32)
+            np.add.at(scores, posting[0], posting[1])
+        if scores is None:
+            return []
+        k = min(k, int(np.count_nonzero(scores)))
+        if k <= 0:
+            return []
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(int(i), float(scores[i])) for i in top]
+
+    def exact_match(self, query: str) -> Optional[int]:
+        """เอกสารที่คำถาม/หัวข้อตรงกับ query ทุกตัวอักษร (หลัง normalize)"""
+        return self._exact.get(normalize_text(query))
+
+
+def reciprocal_rank_fusion(rankings: List[List[int]], k: int = 60) -> List[Tuple[int, float]]:
+    """รวมหลายอันดับด้วย RRF: score = sum(1 / (k + rank))"""
+    fused = defaultdict(float)
+    for ranking in rankings:
+        for rank, doc_id in enumerate(ranking, start=1):
+            fused[doc_id] += 1.0 / (k + rank)
+    return sorted(fused.items(), key=lambda item: item[1], reverse=True)
@@ -0,0 +1,435 @@
+"""
+End-to-end webhook load test with local stand-ins for LINE, Dialogflow and Ollama.
+
+Sends correctly signed LINE message events to /callback at a given arrival
+rate (or as a closed loop of --concurrency users) and measures the time until
+the reply (or push) reaches the LINE stub. Dialogflow is replaced in-process
+with a stub that answers after a configurable latency and falls back to the
+RAG path for --fallback-ratio of the questions; the LLM is mock_llm_server.
+
+    # app, stubs and load generator in one process (threaded Flask server)
+    python loadtest.py --rate 2,4,8 --duration 30 --fallback-ratio 0.5
+
+    # real worker setup: the app runs with the Dialogflow stub, LINE and the
+    # mock LLM are served by the load generator
+    LINE_API_ENDPOINT=http://127.0.0.1:18080 LINE_CHANNEL_SECRET=loadtest \\
+    LLM_BASE_URL=http://127.0.0.1:11434 LOADTEST_DIALOGFLOW_FALLBACK_RATIO=0.5 \\
+        gunicorn -w 4 -b 127.0.0.1:5000 'loadtest:stubbed_app()'
+    python loadtest.py --target http://127.0.0.1:5000/callback --rate 2,4,8
+
+--rate 0 runs a closed loop: each of the --concurrency users sends the next
+message as soon as the previous one has been answered.
+"""
+import argparse
+import base64
+import hashlib
+import hmac
+import itertools
+import json
+import logging
+import os
+import random
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List
+
+import numpy as np
+import requests
+
+import mock_llm_server
+
+logger = logging.getLogger(__name__)
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+QUESTIONS_FILE = os.path.join(BASE_DIR, 'data', 'json', '1.json')
+
+# ค่าของ Dialogflow stub เมื่อรันแอปผ่าน stubbed_app() (เช่นใน gunicorn)
+LOADTEST_DIALOGFLOW_LATENCY_MS = float(os.getenv("LOADTEST_DIALOGFLOW_LATENCY_MS", "150"))
+LOADTEST_DIALOGFLOW_JITTER_MS = float(os.getenv("LOADTEST_DIALOGFLOW_JITTER_MS", "50"))
+LOADTEST_DIALOGFLOW_FALLBACK_RATIO = float(os.getenv("LOADTEST_DIALOGFLOW_FALLBACK_RATIO", "0.5"))
+LOADTEST_SECRET = "loadtest"
+
+DIALOGFLOW_ANSWER = "สวัสดีค่ะ คำตอบนี้มาจาก Dialogflow จำลอง"
+DIALOGFLOW_FALLBACK = "ขอโทษค่ะ ไม่เข้าใจ"
+# ข้อความที่แอปส่งเมื่อเกิดข้อผิดพลาด / คิวเต็ม (ใช้แยกประเภทผลลัพธ์)
+ERROR_REPLY_PREFIXES = ("ขออภัย เกิดข้อผิดพลาด",)
+BUSY_REPLY_PREFIXES = ("ขออภัยค่ะ ขณะนี้มีผู้ใช้งานจำนวนมาก",)
+
+
+class LineStub:
+    """
+    Stand-in for the LINE Messaging API reply/push endpoints.
+
+    Reply tokens are single use and expire reply_token_ttl seconds after the
+    event was sent, like the real API; every delivered message is matched
+    back to the event that caused it.
+    """
+
+    def __init__(self, reply_token_ttl: float = 60.0):
+        self.reply_token_ttl = reply_token_ttl
+        self._lock = threading.Lock()
+        self._tokens = {}
+        self._users = {}
+        self._deliveries = {}
+        self._done = {}
+        self.expired_tokens = 0
+        self.invalid_tokens = 0
+
+    def expect(self, event_id: str, reply_token: str, user_id: str, sent_at: float):
+        with self._lock:
+            self._tokens[reply_token] = (event_id, sent_at)
+            self._users[user_id] = event_id
+            self._done[event_id] = threading.Event()
+
+    def reply(self, reply_token: str, messages: List[dict]) -> bool:
+        now = time.monotonic()
+        with self._lock:
+            issued = self._tokens.pop(reply_token, None)
+            if issued is None:
+                self.invalid_tokens += 1
+                return False
+            event_id, sent_at = issued
+            if now - sent_at > self.reply_token_ttl:
+                self.expired_tokens += 1
+                self._record(event_id, now, 'expired', messages)
+                return False
+            self._record(event_id, now, 'reply', messages)
+            return True
+
+    def push(self, to: str, messages: List[dict]):
+        now = time.monotonic()
+        with self._lock:
+            event_id = self._users.get(to)
+            if event_id is not None:
+                self._record(event_id, now, 'push', messages)
+
+    def _record(self, event_id: str, now: float, kind: str, messages: List[dict]):
+        texts = [m.get('text') or m.get('altText') or m.get('type', '') for m in messages]
+        self._deliveries.setdefault(event_id, []).append((now, kind, texts))
+        if kind != 'expired':
+            self._done[event_id].set()
+
+    def wait(self, event_id: str, timeout: float) -> List[tuple]:
+        self._done[event_id].wait(timeout)
+        with self._lock:
+            return list(self._deliveries.get(event_id, []))
+
+
+class LineStubHandler(BaseHTTPRequestHandler):
+    stub: LineStub = None
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        logger.debug("line-stub: " + format, *args)
+
+    def _send_json(self, data, status=200):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        request = json.loads(self.rfile.read(length) or b"{}")
+        messages = request.get("messages", [])
+        sent = {"sentMessages": [{"id": str(uuid.uuid4().int)[:18], "quoteToken": "loadtest"} for _ in messages]}
+        if self.path == "/v2/bot/message/reply":
+            if self.stub.reply(request.get("replyToken", ""), messages):
+                self._send_json(sent)
+            else:
+                self._send_json({"message": "Invalid reply token"}, status=400)
+        elif self.path == "/v2/bot/message/push":
+            self.stub.push(request.get("to", ""), messages)
+            self._send_json(sent)
+        else:
+            self._send_json({"message": "Not found"}, status=404)
+
+
+def serve_line_stub(host: str, port: int, stub: LineStub) -> ThreadingHTTPServer:
+    handler = type("ConfiguredLineStubHandler", (LineStubHandler,), {"stub": stub})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="line-stub", daemon=True).start()
+    return server
+
+
+class DialogflowStub:
+    """แทน detect_intent_texts: หน่วงเวลาตามที่ตั้งไว้ แล้วตอบเองหรือตอบ fallback เพื่อให้ไปค้นเอกสาร"""
+
+    def __init__(self, latency_ms: float, jitter_ms: float, fallback_ratio: float, seed: int = 0):
+        from google.cloud.dialogflow_v2.types import DetectIntentResponse, Intent, QueryResult
+        self._types = (DetectIntentResponse, Intent, QueryResult)
+        self.latency = latency_ms / 1000.0
+        self.jitter = jitter_ms / 1000.0
+        self.fallback_ratio = fallback_ratio
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def __call__(self, project_id, session_id, text, language_code):
+        DetectIntentResponse, Intent, QueryResult = self._types
+        with self._lock:
+            delay = max(0.0, self._random.gauss(self.latency, self.jitter)) if self.jitter else self.latency
+            fallback = self._random.random() < self.fallback_ratio
+        time.sleep(delay)
+        reply = DIALOGFLOW_FALLBACK if fallback else DIALOGFLOW_ANSWER
+        return DetectIntentResponse(query_result=QueryResult(
+            query_text=text,
+            fulfillment_text=reply,
+            fulfillment_messages=[Intent.Message(text=Intent.Message.Text(text=[reply]))],
+        ))
+
+
+def stubbed_app(dialogflow: DialogflowStub = None):
+    """
+    แอป Flask ที่ใช้ Dialogflow stub แทน Google (gunicorn 'loadtest:stubbed_app()')
+    LINE และ LLM ชี้ไปที่ stub ผ่าน LINE_API_ENDPOINT และ LLM_BASE_URL
+    """
+    os.environ.setdefault("LINE_CHANNEL_SECRET", LOADTEST_SECRET)
+    os.environ.setdefault("LINE_CHANNEL_ACCESS_TOKEN", LOADTEST_SECRET)
+    os.environ.setdefault("GOOGLE_APPLICATION_CREDENTIALS", "")
+    import app as app_module
+    app_module.detect_intent_texts = dialogflow or DialogflowStub(
+        LOADTEST_DIALOGFLOW_LATENCY_MS, LOADTEST_DIALOGFLOW_JITTER_MS, LOADTEST_DIALOGFLOW_FALLBACK_RATIO
+    )
+    return app_module.app
+
+
+def signed_event(secret: str, text: str, user_id: str, reply_token: str, timestamp_ms: int):
+    """webhook body ของ text message หนึ่งข้อความ พร้อม X-Line-Signature (HMAC-SHA256 ของ body)"""
+    body = json.dumps({
+        "destination": "Uloadtestbot",
+        "events": [{
+            "type": "message",
+            "mode": "active",
+            "timestamp": timestamp_ms,
+            "webhookEventId": uuid.uuid4().hex,
+            "deliveryContext": {"isRedelivery": False},
+            "replyToken": reply_token,
+            "source": {"type": "user", "userId": user_id},
+            "message": {"id": str(uuid.uuid4().int)[:18], "type": "text", "quoteToken": "loadtest", "text": text},
+        }],
+    }, ensure_ascii=False).encode('utf-8')
+    signature = base64.b64encode(hmac.new(secret.encode('utf-8'), body, hashlib.sha256).digest()).decode('ascii')
+    return body, signature
+
+
+def load_questions(path: str = QUESTIONS_FILE) -> List[str]:
+    with open(path, 'r', encoding='utf-8') as f:
+        return [item['question'] for item in json.load(f) if item.get('question')]
+
+
+class LoadGenerator:
+    def __init__(self, target: str, secret: str, stub: LineStub, questions: List[str],
+                 concurrency: int, timeout: float, seed: int = 0):
+        self.target = target
+        self.secret = secret
+        self.stub = stub
+        self.questions = questions
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self._random = random.Random(seed)
+        self._ids = itertools.count()
+        self._local = threading.local()
+
+    def _session(self) -> requests.Session:
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            session = self._local.session = requests.Session()
+        return session
+
+    def send(self, scheduled: float) -> Dict:
+        """ส่งหนึ่ง event แล้วรอจนคำตอบถึง LINE stub (เวลานับจากกำหนดส่ง รวมเวลารอคิวฝั่งผู้ส่ง)"""
+        n = next(self._ids)
+        event_id, user_id, reply_token = f"e{n}", f"Uloadtest{n:08d}", uuid.uuid4().hex
+        text = self.questions[n % len(self.questions)]
+        body, signature = signed_event(self.secret, text, user_id, reply_token, int(time.time() * 1000))
+        self.stub.expect(event_id, reply_token, user_id, time.monotonic())
+        result = {'ack_seconds': None, 'status': None, 'latency': None, 'outcome': 'unanswered'}
+        try:
+            response = self._session().post(
+                self.target, data=body, timeout=self.timeout,
+                headers={'Content-Type': 'application/json', 'X-Line-Signature': signature},
+            )
+            result['status'] = response.status_code
+            result['ack_seconds'] = time.monotonic() - scheduled
+            if response.status_code != 200:
+                result['outcome'] = 'webhook_error'
+                return result
+        except requests.RequestException as e:
+            logger.debug(f"webhook request failed: {e}")
+            result['outcome'] = 'webhook_error'
+            return result
+
+        deliveries = self.stub.wait(event_id, max(0.0, self.timeout - (time.monotonic() - scheduled)))
+        delivered = [d for d in deliveries if d[1] != 'expired']
+        if any(kind == 'expired' for _, kind, _ in deliveries):
+            result['reply_token_timeout'] = True
+        if not delivered:
+            return result
+        at, kind, texts = delivered[0]
+        result['latency'] = at - scheduled
+        first = texts[0] if texts else ''
+        if first.startswith(BUSY_REPLY_PREFIXES):
+            result['outcome'] = 'busy'
+        elif first.startswith(ERROR_REPLY_PREFIXES):
+            result['outcome'] = 'error_reply'
+        else:
+            result['outcome'] = kind
+        return result
+
+    def run_stage(self, rate: float, duration: float) -> Dict:
+        results = []
+        start = time.monotonic()
+        with ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix="loadgen") as executor:
+            if rate > 0:
+                # open loop: เวลาส่งเป็น Poisson process ไม่รอให้คำขอก่อนหน้าเสร็จ
+                futures = []
+                scheduled = start
+                while True:
+                    scheduled += self._random.expovariate(rate)
+                    if scheduled - start > duration:
+                        break
+                    time.sleep(max(0.0, scheduled - time.monotonic()))
+                    futures.append(executor.submit(self.send, scheduled))
+                results = [future.result() for future in futures]
+            else:
+                # closed loop: ผู้ใช้ concurrency คน ส่งข้อความถัดไปเมื่อได้คำตอบแล้ว
+                lock = threading.Lock()
+
+                def user():
+                    while time.monotonic() - start < duration:
+                        result = self.send(time.monotonic())
+                        with lock:
+                            results.append(result)
+
+                for future in [executor.submit(user) for _ in range(self.concurrency)]:
+                    future.result()
+        return summarize(results, time.monotonic() - start, rate)
+
+
+def _percentiles(seconds: List[float]) -> Dict:
+    if not seconds:
+        return {}
+    values = np.asarray(seconds) * 1000
+    return {
+        'p50_ms': round(float(np.percentile(values, 50)), 1),
+        'p95_ms': round(float(np.percentile(values, 95)), 1),
+        'p99_ms': round(float(np.percentile(values, 99)), 1),
+        'max_ms': round(float(values.max()), 1),
+    }
+
+
+def summarize(results: List[Dict], elapsed: float, rate: float) -> Dict:
+    outcomes = {}
+    for result in results:
+        outcomes[result['outcome']] = outcomes.get(result['outcome'], 0) + 1
+    answered = [r['latency'] for r in results if r['outcome'] in ('reply', 'push')]
+    return {
+        'rate': rate,
+        'sent': len(results),
+        'answered': len(answered),
+        'throughput_per_second': round(len(answered) / elapsed, 2) if elapsed else 0.0,
+        'latency': _percentiles(answered),
+        'ack_latency': _percentiles([r['ack_seconds'] for r in results if r['ack_seconds'] is not None]),
+        'outcomes': outcomes,
+        'reply_token_timeouts': sum(1 for r in results if r.get('reply_token_timeout')),
+        'errors': sum(outcomes.get(k, 0) for k in ('webhook_error', 'error_reply', 'busy', 'unanswered')),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="End-to-end load test of the LINE webhook")
+    parser.add_argument('--target', default=None,
+                        help="webhook URL of an app started separately (default: run the app in this process)")
+    parser.add_argument('--rate', default='2', help="events per second, comma separated for several stages (0 = closed loop)")
+    parser.add_argument('--duration', type=float, default=30, help="seconds per stage")
+    parser.add_argument('--concurrency', type=int, default=16, help="max in-flight events / users in closed loop")
+    parser.add_argument('--timeout', type=float, default=90, help="give up waiting for a reply after this many seconds")
+    parser.add_argument('--secret', default=os.getenv("LINE_CHANNEL_SECRET") or LOADTEST_SECRET)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--app-port', type=int, default=15000)
+    parser.add_argument('--line-port', type=int, default=18080)
+    parser.add_argument('--reply-token-ttl', type=float, default=60, help="seconds a reply token stays valid in the LINE stub")
+    parser.add_argument('--mock-llm-port', type=int, default=11434, help="0 = use the LLM configured in the environment")
+    parser.add_argument('--llm-latency-ms', type=float, default=300)
+    parser.add_argument('--llm-tokens-per-second', type=float, default=25)
+    parser.add_argument('--dialogflow-latency-ms', type=float, default=LOADTEST_DIALOGFLOW_LATENCY_MS)
+    parser.add_argument('--dialogflow-jitter-ms', type=float, default=LOADTEST_DIALOGFLOW_JITTER_MS)
+    parser.add_argument('--fallback-ratio', type=float, default=LOADTEST_DIALOGFLOW_FALLBACK_RATIO,
+                        help="share of questions Dialogflow cannot answer (these go through RAG + LLM)")
+    parser.add_argument('--questions', default=QUESTIONS_FILE)
+    parser.add_argument('--output', default=None, help="write the report as JSON")
+    parser.add_argument('--verbose', action='store_true')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING,
+                        format='%(asctime)s - %(levelname)s - %(message)s')
+    logger.setLevel(logging.INFO)
+
+    stub = LineStub(args.reply_token_ttl)
+    serve_line_stub(args.host, args.line_port, stub)
+    if args.mock_llm_port:
+        mock_llm_server.serve(args.host, args.mock_llm_port, mock_llm_server.MockSettings(
+            latency_ms=args.llm_latency_ms, tokens_per_second=args.llm_tokens_per_second
+        ))
+
+    target = args.target
+    if target is None:
+        # แอปในโปรเซสเดียวกัน: ต้องตั้ง environment ก่อน import app (ค่า config อ่านตอน import)
+        os.environ["LINE_API_ENDPOINT"] = f"http://{args.host}:{args.line_port}"
+        os.environ["LINE_CHANNEL_SECRET"] = args.secret
+        if args.mock_llm_port:
+            os.environ["LLM_BASE_URL"] = f"http://{args.host}:{args.mock_llm_port}"
+        from werkzeug.serving import make_server
+        flask_app = stubbed_app(DialogflowStub(
+            args.dialogflow_latency_ms, args.dialogflow_jitter_ms, args.fallback_ratio, args.seed
+        ))
+        if not args.verbose:
+            # แอปตั้ง root logger เป็น INFO ตอน import
+            logging.getLogger().setLevel(logging.WARNING)
+            flask_app.logger.setLevel(logging.WARNING)
+            logging.getLogger('werkzeug').setLevel(logging.WARNING)
+        server = make_server(args.host, args.app_port, flask_app, threaded=True)
+        threading.Thread(target=server.serve_forever, name="app", daemon=True).start()
+        target = f"http://{args.host}:{args.app_port}/callback"
+    logger.info(f"Sending to {target} (LINE stub on :{args.line_port})")
+
+    generator = LoadGenerator(target, args.secret, stub, load_questions(args.questions),
+                              args.concurrency, args.timeout, args.seed)
+    stages = []
+    for rate in [float(r) for r in args.rate.split(',') if r]:
+        stage = generator.run_stage(rate, args.duration)
+        stages.append(stage)
+        latency = stage['latency']
+        logger.info(
+            f"rate {rate:g}/s: {stage['answered']}/{stage['sent']} answered, "
+            f"{stage['throughput_per_second']}/s, p50 {latency.get('p50_ms')} ms, "
+            f"p95 {latency.get('p95_ms')} ms, p99 {latency.get('p99_ms')} ms, "
+            f"errors {stage['errors']}, reply token timeouts {stage['reply_token_timeouts']}"
+        )
+
+    report = {
+        'target': target,
+        'concurrency': args.concurrency,
+        'duration_per_stage': args.duration,
+        # กับ --target ค่า Dialogflow stub มาจาก LOADTEST_* ของโปรเซสแอป
+        'dialogflow': None if args.target else {'latency_ms': args.dialogflow_latency_ms,
+                                                'fallback_ratio': args.fallback_ratio},
+        'line_stub': {'expired_reply_tokens': stub.expired_tokens, 'invalid_reply_tokens': stub.invalid_tokens},
+        'stages': stages,
+    }
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+    if args.output:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
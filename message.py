@@ -1,10 +1,13 @@
 import json
 import logging
+import time
 from linebot.v3.messaging import (
     TextMessage, FlexMessage, FlexContainer, ReplyMessageRequest,
-    QuickReply, QuickReplyItem, MessageAction
+    PushMessageRequest, QuickReply, QuickReplyItem, MessageAction
 )
 
+from tracing import traced
+
 logger = logging.getLogger(__name__)
 
 def prepend_bot_name_for_group(text, is_group):
@@ -72,6 +75,7 @@ def create_flex_message(flex_content, is_group=False):
         logger.error(f"เกิดข้อผิดพลาดในการสร้าง Flex Message: {str(e)}")
         return None
 
+@traced("line_reply")
 def send_multiple_messages(line_bot_api, reply_token, messages):
     try:
         if not messages:
@@ -91,6 +95,7 @@ def send_multiple_messages(line_bot_api, reply_token, messages):
         except:
             logger.error("ไม่สามารถส่งข้อความสำรองได้")
 
+@traced("line_reply")
 def send_text_message(line_bot_api, reply_token, text):
     try:
         text = text if text else "ขออภัย ไม่พบข้อมูล"
@@ -104,3 +109,39 @@ def send_text_message(line_bot_api, reply_token, text):
         line_bot_api.reply_message_with_http_info(reply_request)
     except Exception as e:
         logger.error(f"เกิดข้อผิดพลาดในการส่งข้อความตัวอักษร: {str(e)}")
+
+def get_push_target(source):
+    """หา id ปลายทางสำหรับ push message (กลุ่ม ห้อง หรือผู้ใช้)"""
+    return (
+        getattr(source, 'group_id', None)
+        or getattr(source, 'room_id', None)
+        or getattr(source, 'user_id', None)
+    )
+
+def is_reply_token_fresh(event_timestamp_ms, ttl_seconds):
+    """ตรวจสอบว่า reply token ของ event ยังไม่หมดอายุ"""
+    if not event_timestamp_ms:
+        return True
+    age = time.time() - event_timestamp_ms / 1000.0
+    return age < ttl_seconds
+
+@traced("line_push")
+def push_messages(line_bot_api, to, messages):
+    try:
+        if not messages:
+            logger.warning("ไม่มีข้อความที่จะส่ง")
+            return
+        if not to:
+            logger.error("ไม่พบปลายทางสำหรับ push message")
+            return
+        logger.info(f"กำลัง push {len(messages)} ข้อความไปยัง {to}")
+        # LINE รับได้ไม่เกิน 5 ข้อความต่อหนึ่งคำขอ
+        for i in range(0, len(messages), 5):
+            push_request = PushMessageRequest(
+                to=to,
+                messages=messages[i:i + 5]
+            )
+            line_bot_api.push_message_with_http_info(push_request)
+        logger.info("push ข้อความสำเร็จ")
+    except Exception as e:
+        logger.error(f"เกิดข้อผิดพลาดในการ push ข้อความ: {str(e)}")
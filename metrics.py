@@ -0,0 +1,239 @@
+import threading
+import time
+from bisect import bisect_left
+
+# ขอบเขต bucket เริ่มต้นสำหรับ histogram ที่วัดเวลาเป็นวินาที
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+_registry = {}
+_registry_lock = threading.Lock()
+
+
+def _label_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+class Counter:
+    """Monotonic counter, optionally split by labels"""
+
+    def __init__(self, name, description=""):
+        self.name = name
+        self.description = description
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self._values.get(_label_key(labels), 0)
+
+    def snapshot(self):
+        with self._lock:
+            return {"type": "counter", "values": [
+                {"labels": dict(key), "value": value} for key, value in self._values.items()
+            ]}
+
+
+class Gauge:
+    """Value that can go up and down, or be read from a callback"""
+
+    def __init__(self, name, description=""):
+        self.name = name
+        self.description = description
+        self._values = {}
+        self._functions = {}
+        self._lock = threading.Lock()
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[_label_key(labels)] = value
+
+    def inc(self, amount=1, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set_function(self, func, **labels):
+        """อ่านค่าจาก func ตอน snapshot แทนการ set ค่าเอง"""
+        with self._lock:
+            self._functions[_label_key(labels)] = func
+
+    def value(self, **labels):
+        key = _label_key(labels)
+        if key in self._functions:
+            return self._functions[key]()
+        return self._values.get(key, 0)
+
+    def snapshot(self):
+        with self._lock:
+            values = dict(self._values)
+            functions = dict(self._functions)
+        for key, func in functions.items():
+            try:
+                values[key] = func()
+            except Exception:
+                continue
+        return {"type": "gauge", "values": [
+            {"labels": dict(key), "value": value} for key, value in values.items()
+        ]}
+
+
+class Histogram:
+    """Cumulative-bucket histogram with count and sum"""
+
+    def __init__(self, name, description="", buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.description = description
+        self.buckets = tuple(sorted(buckets))
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = _label_key(labels)
+        position = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = {
+                    "counts": [0] * (len(self.buckets) + 1), "count": 0, "sum": 0.0
+                }
+            series["counts"][position] += 1
+            series["count"] += 1
+            series["sum"] += value
+
+    def time(self, **labels):
+        """Context manager ที่จับเวลาแล้ว observe เป็นวินาที"""
+        return _Timer(self, labels)
+
+    def snapshot(self):
+        with self._lock:
+            result = []
+            for key, series in self._series.items():
+                cumulative = 0
+                buckets = {}
+                for bound, count in zip(self.buckets, series["counts"]):
+                    cumulative += count
+                    buckets[str(bound)] = cumulative
+                buckets["+Inf"] = series["count"]
+                result.append({
+                    "labels": dict(key),
+                    "count": series["count"],
+                    "sum": series["sum"],
+                    "buckets": buckets,
+                })
+        return {"type": "histogram", "values": result}
+
+
+class _Timer:
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.histogram.observe(time.perf_counter() - self.start, **self.labels)
+        return False
+
+
+def _get_or_create(cls, name, *args, **kwargs):
+    with _registry_lock:
+        metric = _registry.get(name)
+        if metric is None:
+            metric = _registry[name] = cls(name, *args, **kwargs)
+        return metric
+
+
+def counter(name, description=""):
+    return _get_or_create(Counter, name, description)
+
+
+def gauge(name, description=""):
+    return _get_or_create(Gauge, name, description)
+
+
+def histogram(name, description="", buckets=DEFAULT_BUCKETS):
+    return _get_or_create(Histogram, name, description, buckets)
+
+
+def snapshot():
+    """คืนค่าทุก metric ในรูป dict สำหรับส่งออกเป็น JSON"""
+    with _registry_lock:
+        metrics = list(_registry.values())
+    return {metric.name: metric.snapshot() for metric in metrics}
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labels, extra=None):
+    items = list(labels.items()) + list((extra or {}).items())
+    if not items:
+        return ""
+    return "{" + ",".join(f'{key}="{_escape(value)}"' for key, value in items) + "}"
+
+
+def _format_value(value):
+    if isinstance(value, bool):
+        return "1" if value else "0"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+
+def render_prometheus():
+    """ทุก metric ในรูปแบบ text exposition ของ Prometheus (สำหรับ /metrics)"""
+    with _registry_lock:
+        metrics = sorted(_registry.values(), key=lambda metric: metric.name)
+    lines = []
+    for metric in metrics:
+        data = metric.snapshot()
+        kind = data["type"]
+        if metric.description:
+            lines.append(f"# HELP {metric.name} {metric.description}")
+        lines.append(f"# TYPE {metric.name} {kind}")
+        for series in data["values"]:
+            labels = series["labels"]
+            if kind != "histogram":
+                lines.append(f"{metric.name}{_format_labels(labels)} {_format_value(series['value'])}")
+                continue
+            for bound, count in series["buckets"].items():
+                lines.append(f"{metric.name}_bucket{_format_labels(labels, {'le': bound})} {count}")
+            lines.append(f"{metric.name}_sum{_format_labels(labels)} {_format_value(series['sum'])}")
+            lines.append(f"{metric.name}_count{_format_labels(labels)} {series['count']}")
+    return "\n".join(lines) + "\n"
+
+
+def process_memory():
+    """
+    หน่วยความจำของ process ปัจจุบันเป็น bytes
+    pss แบ่งหน้าที่ใช้ร่วมกัน (เช่น ไฟล์ที่ mmap) ตามจำนวน process จึงเหมาะกับการเทียบระหว่าง worker
+    """
+    memory = {}
+    try:
+        with open('/proc/self/smaps_rollup') as f:
+            for line in f:
+                parts = line.split()
+                if len(parts) >= 3 and parts[0] in ('Rss:', 'Pss:', 'Shared_Clean:', 'Shared_Dirty:'):
+                    memory[parts[0][:-1].lower()] = int(parts[1]) * 1024
+    except OSError:
+        import resource
+        # ru_maxrss เป็น KB บน Linux (เป็นค่าสูงสุด ไม่ใช่ค่าปัจจุบัน)
+        memory['rss'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    return memory
+
+
+gauge("process_rss_bytes", "Resident memory of this worker process").set_function(
+    lambda: process_memory().get('rss', 0))
+gauge("process_pss_bytes", "Proportional set size of this worker process").set_function(
+    lambda: process_memory().get('pss', 0))
@@ -0,0 +1,236 @@
+"""
+Local mock LLM server for benchmarks and offline testing.
+
+Speaks enough of the Ollama (/api/generate, /api/chat, /api/tags) and
+OpenAI (/v1/chat/completions, /v1/models) APIs for ollama_client, with a
+configurable first-token latency and token rate.
+
+    python mock_llm_server.py --port 11434 --latency-ms 300 --tokens-per-second 25
+"""
+import argparse
+import json
+import logging
+import os
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_RESPONSE = (
+    "สวัสดีค่ะ ข้อมูลนี้มาจากระบบจำลองสำหรับทดสอบนะคะ "
+    "ขั้นตอนแรกคือเข้าสู่ระบบ DMC จากนั้นเลือกเมนูที่ต้องการ แล้วกดยืนยันข้อมูลค่ะ เย้!"
+)
+
+
+class MockSettings:
+    def __init__(self, latency_ms=200.0, tokens_per_second=20.0, prefill_tokens_per_second=500.0,
+                 load_ms=0.0, response=DEFAULT_RESPONSE, model="llama3.2"):
+        self.latency = latency_ms / 1000.0
+        self.tokens_per_second = tokens_per_second
+        self.prefill_tokens_per_second = prefill_tokens_per_second
+        self.load = load_ms / 1000.0
+        self.response = response
+        self.model = model
+        self._loaded = False
+        self._lock = threading.Lock()
+
+    def load_delay(self) -> float:
+        """เวลาโหลดโมเดลครั้งแรก (จำลอง cold start)"""
+        with self._lock:
+            if self._loaded:
+                return 0.0
+            self._loaded = True
+            return self.load
+
+
+def _prompt_tokens(text: str) -> int:
+    return max(1, len(text) // 3)
+
+
+def _tokens(text: str):
+    return re.findall(r'\S+\s*', text)
+
+
+class MockLLMHandler(BaseHTTPRequestHandler):
+    settings = MockSettings()
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+    def _send_json(self, data, status=200):
+        body = json.dumps(data, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _start_stream(self, content_type):
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+    def _write_chunk(self, text: str):
+        data = text.encode('utf-8')
+        self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+        self.wfile.flush()
+
+    def _end_stream(self):
+        self.wfile.write(b"0\r\n\r\n")
+        self.wfile.flush()
+
+    def do_GET(self):
+        if self.path.startswith("/api/tags"):
+            self._send_json({"models": [{"name": f"{self.settings.model}:latest"}]})
+        elif self.path.startswith("/v1/models"):
+            self._send_json({"object": "list", "data": [{"id": self.settings.model, "object": "model"}]})
+        elif self.path.startswith("/api/version"):
+            self._send_json({"version": "mock"})
+        else:
+            self._send_json({"error": "not found"}, 404)
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        try:
+            request = json.loads(self.rfile.read(length) or b"{}")
+        except ValueError:
+            self._send_json({"error": "invalid json"}, 400)
+            return
+        if self.path.startswith("/api/generate"):
+            prompt = (request.get("system") or "") + (request.get("prompt") or "")
+            self._ollama(request, prompt, chat=False)
+        elif self.path.startswith("/api/chat"):
+            prompt = "".join(m.get("content", "") for m in request.get("messages", []))
+            self._ollama(request, prompt, chat=True)
+        elif self.path.startswith("/v1/chat/completions"):
+            prompt = "".join(m.get("content", "") for m in request.get("messages", []))
+            self._openai(request, prompt)
+        else:
+            self._send_json({"error": "not found"}, 404)
+
+    def _generate(self, prompt: str, max_tokens: int):
+        """
+        หน่วงเวลาแบบ Ollama: โหลดโมเดล (ครั้งแรก) + latency + prefill ตามความยาว prompt
+        แล้วส่ง token ตามอัตราที่ตั้งไว้ คืน generator ของ token และสถิติ
+        """
+        settings = self.settings
+        load = settings.load_delay()
+        prompt_tokens = _prompt_tokens(prompt)
+        prefill = prompt_tokens / settings.prefill_tokens_per_second if settings.prefill_tokens_per_second > 0 else 0.0
+        time.sleep(load + settings.latency + prefill)
+        tokens = _tokens(settings.response)[:max(1, max_tokens)]
+        stats = {
+            "load_duration": int(load * 1e9),
+            "prompt_eval_count": prompt_tokens,
+            "prompt_eval_duration": int(prefill * 1e9),
+            "eval_count": len(tokens),
+        }
+
+        def emit():
+            interval = 1.0 / settings.tokens_per_second if settings.tokens_per_second > 0 else 0.0
+            for token in tokens:
+                if interval:
+                    time.sleep(interval)
+                yield token
+        return emit(), stats
+
+    def _ollama(self, request: dict, prompt: str, chat: bool):
+        options = request.get("options") or {}
+        start = time.perf_counter()
+        tokens, stats = self._generate(prompt, int(options.get("num_predict") or 512))
+
+        def line(token, done=False):
+            data = {"model": request.get("model"), "done": done}
+            if chat:
+                data["message"] = {"role": "assistant", "content": token}
+            else:
+                data["response"] = token
+            return data
+
+        if not request.get("stream", True):
+            text = "".join(tokens)
+            stats["total_duration"] = int((time.perf_counter() - start) * 1e9)
+            self._send_json(dict(line(text, done=True), **stats))
+            return
+
+        self._start_stream("application/x-ndjson; charset=utf-8")
+        generate_start = time.perf_counter()
+        for token in tokens:
+            self._write_chunk(json.dumps(line(token), ensure_ascii=False) + "\n")
+        stats["eval_duration"] = int((time.perf_counter() - generate_start) * 1e9)
+        stats["total_duration"] = int((time.perf_counter() - start) * 1e9)
+        self._write_chunk(json.dumps(dict(line("", done=True), **stats)) + "\n")
+        self._end_stream()
+
+    def _openai(self, request: dict, prompt: str):
+        tokens, stats = self._generate(prompt, int(request.get("max_tokens") or 512))
+        usage = {
+            "prompt_tokens": stats["prompt_eval_count"],
+            "completion_tokens": stats["eval_count"],
+            "total_tokens": stats["prompt_eval_count"] + stats["eval_count"],
+        }
+        if not request.get("stream"):
+            self._send_json({
+                "object": "chat.completion",
+                "model": request.get("model"),
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": "".join(tokens)},
+                             "finish_reason": "stop"}],
+                "usage": usage,
+            })
+            return
+
+        self._start_stream("text/event-stream; charset=utf-8")
+        for token in tokens:
+            chunk = {"object": "chat.completion.chunk", "model": request.get("model"),
+                     "choices": [{"index": 0, "delta": {"content": token}}]}
+            self._write_chunk(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n")
+        if (request.get("stream_options") or {}).get("include_usage"):
+            self._write_chunk(f"data: {json.dumps({'choices': [], 'usage': usage})}\n\n")
+        self._write_chunk("data: [DONE]\n\n")
+        self._end_stream()
+
+
+def serve(host="127.0.0.1", port=11434, settings: MockSettings = None) -> ThreadingHTTPServer:
+    """เริ่ม mock server ใน background thread (ใช้จาก benchmark/load test)"""
+    handler = type("ConfiguredMockLLMHandler", (MockLLMHandler,), {"settings": settings or MockSettings()})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="mock-llm", daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Mock Ollama/OpenAI-compatible LLM server")
+    parser.add_argument("--host", default=os.getenv("MOCK_LLM_HOST", "127.0.0.1"))
+    parser.add_argument("--port", type=int, default=int(os.getenv("MOCK_LLM_PORT", "11434")))
+    parser.add_argument("--latency-ms", type=float, default=float(os.getenv("MOCK_LLM_LATENCY_MS", "200")),
+                        help="delay before the first token")
+    parser.add_argument("--tokens-per-second", type=float, default=float(os.getenv("MOCK_LLM_TOKENS_PER_SECOND", "20")))
+    parser.add_argument("--prefill-tokens-per-second", type=float,
+                        default=float(os.getenv("MOCK_LLM_PREFILL_TOKENS_PER_SECOND", "500")))
+    parser.add_argument("--load-ms", type=float, default=float(os.getenv("MOCK_LLM_LOAD_MS", "0")),
+                        help="extra delay on the first request (cold model load)")
+    parser.add_argument("--model", default=os.getenv("LLM_MODEL", "llama3.2"))
+    parser.add_argument("--response", default=os.getenv("MOCK_LLM_RESPONSE", DEFAULT_RESPONSE))
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    settings = MockSettings(args.latency_ms, args.tokens_per_second, args.prefill_tokens_per_second,
+                            args.load_ms, args.response, args.model)
+    handler = type("ConfiguredMockLLMHandler", (MockLLMHandler,), {"settings": settings})
+    server = ThreadingHTTPServer((args.host, args.port), handler)
+    server.daemon_threads = True
+    logger.info(f"Mock LLM server on http://{args.host}:{args.port} "
+                f"(latency {args.latency_ms} ms, {args.tokens_per_second} tokens/s)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
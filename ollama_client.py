@@ -1,40 +1,203 @@
 import logging
+import os
+import re
+import threading
 import requests
 import time
+from collections import deque
+from contextlib import contextmanager
 from functools import lru_cache
 import json 
 
+import metrics
+from circuit_breaker import CircuitBreaker
+from context_packer import context_budget, count_tokens, pack_context
+from tracing import record, span, traced
+
 logger = logging.getLogger(__name__)
 
-OLLAMA_URL = "http://localhost:11434/api/generate"
-OLLAMA_MODEL = "llama3.2"
+# ollama-generate | ollama-chat | openai (endpoint ที่รองรับ OpenAI chat completions)
+LLM_BACKEND = os.getenv("LLM_BACKEND", "ollama-generate").lower()
+# ว่าง = ค่าเริ่มต้นของ backend (Ollama: http://localhost:11434, openai: http://localhost:8000/v1)
+LLM_BASE_URL = os.getenv("LLM_BASE_URL", "")
+LLM_API_KEY = os.getenv("LLM_API_KEY", "")
+OLLAMA_MODEL = os.getenv("LLM_MODEL", "llama3.2")
+LLM_TEMPERATURE = float(os.getenv("LLM_TEMPERATURE", "0.1"))
+LLM_TOP_K = int(os.getenv("LLM_TOP_K", "10"))
+LLM_TOP_P = float(os.getenv("LLM_TOP_P", "0.9"))
+NUM_THREAD = int(os.getenv("OLLAMA_NUM_THREAD", "4"))
 CONNECT_TIMEOUT = 3 
 READ_TIMEOUT = 60 
 MAX_RETRIES = 3
 BACKOFF_FACTOR = 2
 CACHE_SIZE = 100
+# ขนาด context window และจำนวน token ที่ให้ตอบ ใช้คำนวณงบของข้อมูลอ้างอิงใน prompt
+NUM_CTX = int(os.getenv("OLLAMA_NUM_CTX", "1024"))
+NUM_PREDICT = int(os.getenv("OLLAMA_NUM_PREDICT", "512"))
+# system = ส่ง persona เป็น system prompt คงที่ (Ollama ใช้ KV cache ของ prefix ซ้ำได้) | legacy = persona อยู่ใน prompt เดียวกับ context
+PROMPT_MODE = os.getenv("OLLAMA_PROMPT_MODE", "system").lower()
+# เวลาที่ให้ Ollama เก็บโมเดลไว้ในหน่วยความจำหลังคำขอล่าสุด เช่น 30m, 24h หรือ -1 (ไม่ unload)
+KEEP_ALIVE = os.getenv("OLLAMA_KEEP_ALIVE", "30m")
+PREWARM = os.getenv("OLLAMA_PREWARM", "true").lower() == "true"
+# load_duration ที่เกินค่านี้ถือว่าโมเดลถูกโหลดใหม่ (cold start)
+COLD_LOAD_SECONDS = float(os.getenv("OLLAMA_COLD_LOAD_SECONDS", "0.5"))
+# ขนาดข้อความแต่ละช่วงเมื่อส่งคำตอบแบบ streaming
+STREAM_MIN_CHUNK_CHARS = 40
+STREAM_MAX_CHUNK_CHARS = 300
+# จุดตัดประโยค: ขึ้นบรรทัดใหม่, ! ?, จุดที่ตามด้วยช่องว่าง หรือช่องว่าง (ภาษาไทยใช้ช่องว่างคั่นประโยค)
+SENTENCE_BREAK = re.compile(r'\n+|[!?](?:\s+|$)|\.\s+|\s+')
+# connection pool และการจำกัดจำนวนคำขอที่ส่งไปยัง Ollama พร้อมกัน
+POOL_SIZE = int(os.getenv("OLLAMA_POOL_SIZE", "4"))
+POOL_IDLE_TIMEOUT = float(os.getenv("OLLAMA_POOL_IDLE_TIMEOUT", "300"))
+MAX_CONCURRENCY = int(os.getenv("OLLAMA_MAX_CONCURRENCY", "2"))
+QUEUE_TIMEOUT = float(os.getenv("OLLAMA_QUEUE_TIMEOUT", "30"))
+# circuit breaker: ล้มเหลว LLM_BREAKER_FAILURES ครั้งภายใน LLM_BREAKER_WINDOW_SECONDS จะหยุดเรียก LLM
+# เป็นเวลา LLM_BREAKER_OPEN_SECONDS แล้วลองส่ง probe ทีละคำขอ
+BREAKER_FAILURES = int(os.getenv("LLM_BREAKER_FAILURES", "5"))
+BREAKER_WINDOW_SECONDS = float(os.getenv("LLM_BREAKER_WINDOW_SECONDS", "60"))
+BREAKER_OPEN_SECONDS = float(os.getenv("LLM_BREAKER_OPEN_SECONDS", "30"))
+UNAVAILABLE_MESSAGE = "ขออภัยค่ะ ระบบ AI ไม่พร้อมใช้งานชั่วคราว กรุณาลองใหม่อีกครั้งในภายหลัง"
+
+pool_sessions_created = metrics.counter("ollama_pool_sessions_created_total", "HTTP sessions (connection pools) created for Ollama")
+pool_hits = metrics.counter("ollama_pool_hits_total", "Ollama requests served by an existing pooled session")
+limiter_waits = metrics.counter("ollama_limiter_waits_total", "Ollama requests that had to queue for a concurrency slot")
+limiter_rejections = metrics.counter("ollama_limiter_rejections_total", "Ollama requests rejected after waiting QUEUE_TIMEOUT")
+limiter_wait_seconds = metrics.histogram("ollama_limiter_wait_seconds", "Time spent waiting for a concurrency slot")
+inflight_requests = metrics.gauge("ollama_inflight_requests", "Ollama requests currently in flight")
+TOKEN_BUCKETS = (64, 128, 256, 384, 512, 768, 1024, 2048, 4096)
+prompt_tokens_histogram = metrics.histogram("ollama_prompt_tokens", "Prompt tokens evaluated by Ollama", buckets=TOKEN_BUCKETS)
+context_tokens_histogram = metrics.histogram("ollama_context_tokens", "Estimated tokens of packed reference context", buckets=TOKEN_BUCKETS)
+prefill_seconds = metrics.histogram("ollama_prefill_seconds", "Ollama prompt evaluation (prefill) time")
+request_seconds = metrics.histogram("ollama_request_seconds", "Ollama total request time, split by warm or cold model")
+load_seconds = metrics.histogram("ollama_load_seconds", "Ollama model load time reported per request")
+tokens_per_second = metrics.histogram("ollama_tokens_per_second", "Generation speed reported by Ollama",
+                                      buckets=(1, 2, 5, 10, 15, 20, 30, 50, 75, 100, 200))
+
+
+class OllamaBusyError(Exception):
+    """Raised when no concurrency slot frees up within QUEUE_TIMEOUT"""
+
+
+class LLMUnavailableError(Exception):
+    """Raised without calling the LLM while the circuit breaker is open"""
+
+
+class LLMGenerationError(Exception):
+    """Raised when generation fails after every retry; the message is the answer shown to the user"""
+
+
+class ConcurrencyLimiter:
+    """Semaphore that hands out slots in arrival (FIFO) order"""
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self._active = 0
+        self._waiters = deque()
+        self._lock = threading.Lock()
+
+    def acquire(self, timeout: float) -> bool:
+        with self._lock:
+            if self._active < self.limit and not self._waiters:
+                self._active += 1
+                return True
+            waiter = threading.Event()
+            self._waiters.append(waiter)
+
+        limiter_waits.inc()
+        start = time.monotonic()
+        granted = waiter.wait(timeout)
+        if not granted:
+            with self._lock:
+                # อาจได้ slot ระหว่างที่หมดเวลาพอดี
+                granted = waiter.is_set()
+                if not granted:
+                    self._waiters.remove(waiter)
+        limiter_wait_seconds.observe(time.monotonic() - start)
+        return granted
+
+    def release(self):
+        with self._lock:
+            if self._waiters:
+                # ส่ง slot ต่อให้คนที่รอนานที่สุดโดยตรง
+                self._waiters.popleft().set()
+            else:
+                self._active -= 1
+
+
+class OllamaHTTPClient:
+    """Long-lived keep-alive session shared by every Ollama call"""
+
+    def __init__(self, pool_size: int = POOL_SIZE, idle_timeout: float = POOL_IDLE_TIMEOUT,
+                 max_concurrency: int = MAX_CONCURRENCY, queue_timeout: float = QUEUE_TIMEOUT):
+        self.pool_size = pool_size
+        self.idle_timeout = idle_timeout
+        self.queue_timeout = queue_timeout
+        self.limiter = ConcurrencyLimiter(max_concurrency)
+        self._session = None
+        self._last_used = 0.0
+        self._lock = threading.Lock()
+
+    def _get_session(self) -> requests.Session:
+        with self._lock:
+            now = time.monotonic()
+            if self._session is not None and now - self._last_used > self.idle_timeout:
+                # connection ที่ว่างนานเกินไปอาจถูกฝั่ง server ปิดไปแล้ว
+                self._session.close()
+                self._session = None
+            if self._session is None:
+                session = requests.Session()
+                adapter = requests.adapters.HTTPAdapter(
+                    pool_connections=1, pool_maxsize=self.pool_size, max_retries=1
+                )
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                self._session = session
+                pool_sessions_created.inc()
+            else:
+                pool_hits.inc()
+            self._last_used = now
+            return self._session
+
+    def get(self, url: str, **kwargs):
+        """GET สั้น ๆ (เช่น health check) ไม่ต้องรอ concurrency slot"""
+        return self._get_session().get(url, **kwargs)
+
+    @contextmanager
+    def post(self, url: str, **kwargs):
+        """POST through the shared session while holding a concurrency slot"""
+        if not self.limiter.acquire(self.queue_timeout):
+            limiter_rejections.inc()
+            raise OllamaBusyError(f"No Ollama slot available within {self.queue_timeout}s")
+        inflight_requests.inc()
+        try:
+            response = self._get_session().post(url, **kwargs)
+            try:
+                yield response
+            finally:
+                response.close()
+        finally:
+            inflight_requests.dec()
+            self.limiter.release()
+
+
+http_client = OllamaHTTPClient()
+breaker = CircuitBreaker("llm", BREAKER_FAILURES, BREAKER_WINDOW_SECONDS, BREAKER_OPEN_SECONDS)
+
+
+def llm_available() -> bool:
+    """False เมื่อ circuit breaker เปิดอยู่ ผู้เรียกควรใช้คำตอบสำรองแทนการรอ LLM"""
+    return breaker.available()
 
 @lru_cache(maxsize=CACHE_SIZE)
 def cached_generate(prompt: str) -> str:
-    """Cache wrapper for generate_response"""
+    """Cache wrapper for generate_response (failures raise, so they are never cached)"""
     return _generate_response(prompt)
 
-def generate_response(question: str, context: str = None) -> str:
-    try:
-        if context:
-            context_parts = context.split('\n\n')
-            relevant_parts = []
-
-            if not relevant_parts:
-                relevant_parts = context_parts[:2]
-                
-            shortened_context = '\n\n'.join(relevant_parts)
-
-            prompt = f"""คุณชื่อ DMC Chatbot เป็น AI ผู้ช่วยผู้หญิง นิสัยร่าเริง พูดจาน่ารัก เป็นกันเอง 
+PROMPT_TEMPLATE = """คุณชื่อ DMC Chatbot เป็น AI ผู้ช่วยผู้หญิง นิสัยร่าเริง พูดจาน่ารัก เป็นกันเอง 
 คุณชอบช่วยเหลือผู้อื่นและให้คำแนะนำด้วยภาษาที่เข้าใจง่าย มีความสุภาพแต่ไม่ทางการเกินไป
 
 ข้อมูลอ้างอิง:
-{shortened_context}
+{context}
 
 คำถาม: {question}
 
@@ -45,67 +208,498 @@ def generate_response(question: str, context: str = None) -> str:
 - ใช้คำพูดที่เป็นมิตร เช่น ค่ะ, น้าา, นะคะ, เย้!
 - ตอบให้เข้าใจง่าย กระชับ ตรงประเด็น
 """
+
+# persona และคำแนะนำที่ไม่เปลี่ยนระหว่างคำขอ ส่งเป็น system prompt ให้อยู่ต้น prompt เสมอ
+SYSTEM_PROMPT = """คุณชื่อ DMC Chatbot เป็น AI ผู้ช่วยผู้หญิง นิสัยร่าเริง พูดจาน่ารัก เป็นกันเอง 
+คุณชอบช่วยเหลือผู้อื่นและให้คำแนะนำด้วยภาษาที่เข้าใจง่าย มีความสุภาพแต่ไม่ทางการเกินไป
+
+คำแนะนำในการตอบ:
+- ตอบคำถามด้วยภาษาที่เข้าใจง่ายและเป็นมิตร
+- หากเป็นเรื่องลิงค์หรือ URL ให้แสดง URL เต็ม
+- หากมีขั้นตอนให้แสดงเป็นข้อๆ สรุปให้ชัดเจน
+- ใช้คำพูดที่เป็นมิตร เช่น ค่ะ, น้าา, นะคะ, เย้!
+- ตอบให้เข้าใจง่าย กระชับ ตรงประเด็น
+- ตอบโดยใช้ข้อมูลอ้างอิงที่ให้มา
+"""
+
+USER_TEMPLATE = """ข้อมูลอ้างอิง:
+{context}
+
+คำถาม: {question}
+"""
+
+@traced("prompt_build")
+def _build_prompt(question: str, context) -> str:
+    """
+    สร้าง prompt โดยบรรจุข้อมูลอ้างอิงให้พอดีกับ num_ctx
+    context เป็นข้อความ (คั่นด้วยบรรทัดว่าง) หรือ list ของ (ข้อความ, score)
+    """
+    if PROMPT_MODE == "system":
+        template = USER_TEMPLATE
+        template_tokens = count_tokens(SYSTEM_PROMPT) + count_tokens(template.format(context='', question=question))
+    else:
+        template = PROMPT_TEMPLATE
+        template_tokens = count_tokens(template.format(context='', question=question))
+    budget = context_budget(template_tokens, NUM_CTX, NUM_PREDICT)
+    packed, used = pack_context(question, context, budget)
+    context_tokens_histogram.observe(used)
+    logger.info(f"Prompt context: {used}/{budget} tokens (template {template_tokens}, num_ctx {NUM_CTX})")
+    return template.format(context=packed, question=question)
+
+def _record_prompt_stats(data: dict):
+    """บันทึกจำนวน token ของ prompt และเวลา prefill จากข้อมูลท้าย response ของ Ollama"""
+    prompt_tokens = data.get("prompt_eval_count")
+    prefill_ns = data.get("prompt_eval_duration")
+    if prompt_tokens is None:
+        return
+    prompt_tokens_histogram.observe(prompt_tokens)
+    if prefill_ns:
+        prefill_seconds.observe(prefill_ns / 1e9)
+        record("llm_prefill", prefill_ns / 1e9)
+    if data.get("eval_count") and data.get("eval_duration"):
+        tokens_per_second.observe(data["eval_count"] / (data["eval_duration"] / 1e9))
+        record("llm_eval", data["eval_duration"] / 1e9)
+    load = data.get("load_duration", 0) / 1e9
+    start = "cold" if load > COLD_LOAD_SECONDS else "warm"
+    load_seconds.observe(load)
+    if data.get("total_duration"):
+        request_seconds.observe(data["total_duration"] / 1e9, start=start)
+    logger.info(
+        f"LLM prompt ({start}, load {load * 1000:.0f} ms): {prompt_tokens} tokens, prefill {(prefill_ns or 0) / 1e6:.0f} ms, "
+        f"generated {data.get('eval_count', 0)} tokens in {data.get('eval_duration', 0) / 1e6:.0f} ms"
+    )
+
+def _keep_alive():
+    # Ollama รับได้ทั้งตัวเลข (วินาที) และข้อความแบบ duration
+    try:
+        return int(KEEP_ALIVE)
+    except ValueError:
+        return KEEP_ALIVE
+
+def prewarm() -> bool:
+    """
+    โหลดโมเดลและประมวลผล system prompt ล่วงหน้า เพื่อให้ผู้ใช้คนแรกไม่ต้องรอโหลดโมเดล
+    และ prefix ของ system prompt อยู่ใน KV cache แล้ว
+    """
+    start = time.perf_counter()
+    try:
+        for _ in backend.stream_once("สวัสดี", max_tokens=1):
+            pass
+    except Exception as e:
+        logger.warning(f"LLM prewarm failed: {e}")
+        return False
+    logger.info(f"Prewarmed {backend.name} model {backend.model} in {time.perf_counter() - start:.2f}s (keep_alive {KEEP_ALIVE})")
+    return True
+
+def start_prewarm():
+    """เรียก prewarm ใน background thread ไม่ให้การเริ่มระบบต้องรอ"""
+    if not PREWARM:
+        return None
+    thread = threading.Thread(target=prewarm, name="ollama-prewarm", daemon=True)
+    thread.start()
+    return thread
+
+def _fallback_answer(context) -> str:
+    """คำตอบเมื่อเรียก LLM ไม่ได้: ข้อความอ้างอิงที่ score สูงสุด หรือข้อความแจ้งผู้ใช้"""
+    if isinstance(context, str):
+        passages = [p for p in context.split('\n\n') if p.strip()]
+        return passages[0] if passages else UNAVAILABLE_MESSAGE
+    if context:
+        best = max(context, key=lambda p: p[1] if isinstance(p, tuple) else 0.0)
+        return best[0] if isinstance(best, tuple) else best
+    return UNAVAILABLE_MESSAGE
+
+def generate_response(question: str, context=None) -> str:
+    try:
+        if context:
+            prompt = _build_prompt(question, context)
         return cached_generate(prompt)
 
+    except LLMUnavailableError as e:
+        logger.warning(f"{e}, answering from the retrieved passage")
+        return _fallback_answer(context)
+    except OllamaBusyError as e:
+        logger.warning(str(e))
+        return "ขออภัยค่ะ ขณะนี้มีผู้ใช้งานจำนวนมาก กรุณาลองใหม่อีกครั้ง"
+    except LLMGenerationError as e:
+        return str(e)
     except Exception as e:
         logger.error(f"Error generating response: {str(e)}")
         return "ขออภัยค่ะ เกิดข้อผิดพลาดในการประมวลผล กรุณาลองใหม่อีกครั้งในภายหลัง"
 
-def _generate_response(prompt: str) -> str:
-    """Internal function to generate response from Ollama"""
-    for attempt in range(MAX_RETRIES):
-        try:
-            # Add exponential backoff
-            if attempt > 0:
-                sleep_time = BACKOFF_FACTOR ** attempt
-                logger.info(f"Retrying in {sleep_time} seconds...")
-                time.sleep(sleep_time)
-                
-            session = requests.Session()
-            session.mount('http://', requests.adapters.HTTPAdapter(max_retries=1))
-            
-            response = session.post(OLLAMA_URL, json={
-                "model": OLLAMA_MODEL,
-                "prompt": prompt,
-                "stream": True,  
-                "options": {
-                    "temperature": 0.1,
-                    "num_predict": 512,  
-                    "num_ctx": 1024,    
-                    "num_thread": 4,
-                    "top_k": 10,
-                    "top_p": 0.9
-                }
-            }, timeout=(CONNECT_TIMEOUT, READ_TIMEOUT), stream=True)
-
-            if response.status_code == 200:
+def generate_response_stream(question: str, context=None):
+    """
+    Streaming version of generate_response.
+    Yields sentence-sized chunks as soon as Ollama produces them.
+    """
+    try:
+        if not context:
+            yield "ขออภัยค่ะ เกิดข้อผิดพลาดในการประมวลผล กรุณาลองใหม่อีกครั้งในภายหลัง"
+            return
+        prompt = _build_prompt(question, context)
+        yield from stream_sentences(_stream_tokens(prompt))
+    except LLMUnavailableError as e:
+        # retry เกิดก่อน token แรกเท่านั้น จึงยังไม่มีข้อความใดถูกส่งออกไป
+        logger.warning(f"{e}, answering from the retrieved passage")
+        yield _fallback_answer(context)
+    except OllamaBusyError as e:
+        logger.warning(str(e))
+        yield "ขออภัยค่ะ ขณะนี้มีผู้ใช้งานจำนวนมาก กรุณาลองใหม่อีกครั้ง"
+    except Exception as e:
+        logger.error(f"Error streaming response: {str(e)}")
+        yield "ขออภัยค่ะ เกิดข้อผิดพลาดในการประมวลผล กรุณาลองใหม่อีกครั้งในภายหลัง"
+
+def stream_sentences(tokens, min_chars: int = STREAM_MIN_CHUNK_CHARS, max_chars: int = STREAM_MAX_CHUNK_CHARS):
+    """
+    Group a token stream into chunks that end on a sentence break.
+    Whitespace at the break stays at the end of the chunk, so "".join(chunks)
+    gives back the model output exactly.
+    """
+    buffer = ""
+    for token in tokens:
+        buffer += token
+        while len(buffer) >= min_chars:
+            cut = None
+            for match in SENTENCE_BREAK.finditer(buffer, min_chars):
+                # ไม่ตัดที่ท้าย buffer เพราะ token ถัดไปอาจยังเป็นคำเดียวกัน
+                if match.end() < len(buffer):
+                    cut = match.end()
+                    break
+            if cut is None:
+                if len(buffer) < max_chars:
+                    break
+                # ยาวเกินโดยไม่มีจุดตัดประโยค: ตัดที่ช่องว่างสุดท้ายก่อน max_chars เพื่อไม่ให้คำขาด
+                space = max((i for i in range(1, max_chars) if buffer[i - 1].isspace()), default=None)
+                cut = space or max_chars
+            chunk, buffer = buffer[:cut], buffer[cut:]
+            yield chunk
+    if buffer:
+        yield buffer
+
+def join_chunks(chunks) -> str:
+    """ข้อความเต็มจาก chunk ของ stream_sentences (ตัดช่องว่างหัวท้ายแบบเดียวกับคำตอบที่ไม่ stream)"""
+    return "".join(chunks).strip()
+
+class LLMStatusError(Exception):
+    """The LLM endpoint answered with a non-200 status"""
+
+
+class LLMBackend:
+    """
+    One way of talking to an LLM server over HTTP.
+    Subclasses build the request and read one line of the streamed reply;
+    retries, pooling and the concurrency limit are shared here.
+    """
+
+    name = "base"
+    default_base_url = "http://localhost:11434"
+
+    def __init__(self, base_url: str = None, model: str = None, api_key: str = ""):
+        self.base_url = (base_url or self.default_base_url).rstrip('/')
+        self.model = model
+        self.api_key = api_key
+
+    def request(self, prompt: str, max_tokens: int):
+        """คืน (url, payload, headers) ของคำขอแบบ stream"""
+        raise NotImplementedError
+
+    def parse_line(self, line: str):
+        """คืน (ข้อความ, จบแล้วหรือไม่) จากหนึ่งบรรทัดของ response"""
+        raise NotImplementedError
+
+    def health_url(self) -> str:
+        raise NotImplementedError
+
+    def messages(self, prompt: str):
+        messages = [{"role": "user", "content": prompt}]
+        if PROMPT_MODE == "system":
+            messages.insert(0, {"role": "system", "content": SYSTEM_PROMPT})
+        return messages
+
+    def stream_once(self, prompt: str, max_tokens: int = NUM_PREDICT):
+        """Single attempt without retries; raises on HTTP or connection errors"""
+        url, payload, headers = self.request(prompt, max_tokens)
+        with http_client.post(url, json=payload, headers=headers,
+                              timeout=(CONNECT_TIMEOUT, READ_TIMEOUT), stream=True) as response:
+            if response.status_code != 200:
+                raise LLMStatusError(f"{self.name} API error: Status={response.status_code}, Response={response.text[:200]}")
+            # text/event-stream ที่ไม่ระบุ charset requests จะถอดรหัสเป็น ISO-8859-1
+            response.encoding = 'utf-8'
+            for line in response.iter_lines(decode_unicode=True):
+                if not line:
+                    continue
+                try:
+                    token, done = self.parse_line(line)
+                except Exception as e:
+                    logger.error(f"Error parsing streaming line: {e}")
+                    continue
+                if token:
+                    yield token
+                if done:
+                    break
+
+    def stream(self, prompt: str, max_tokens: int = NUM_PREDICT):
+        """
+        Yield raw tokens.
+        Retries only happen before the first token has been yielded.
+        """
+        yielded = False
+        for attempt in range(MAX_RETRIES):
+            self._acquire_breaker()
+            settled = False
+            try:
+                if attempt > 0:
+                    sleep_time = BACKOFF_FACTOR ** attempt
+                    logger.info(f"Retrying in {sleep_time} seconds...")
+                    time.sleep(sleep_time)
+                for token in self.stream_once(prompt, max_tokens):
+                    if not settled:
+                        breaker.record_success()
+                        settled = True
+                    yielded = True
+                    yield token
+                if not settled:
+                    breaker.record_success()
+                    settled = True
+                return
+
+            except LLMStatusError as e:
+                breaker.record_failure()
+                settled = True
+                logger.error(str(e))
+                if attempt < MAX_RETRIES - 1:
+                    continue
+                yield "ขออภัยค่ะ ระบบยังไม่พร้อมให้บริการ กรุณาติดต่อผู้ดูแลระบบ"
+                return
+
+            except (requests.exceptions.ConnectTimeout,
+                    requests.exceptions.ReadTimeout,
+                    requests.exceptions.ConnectionError) as e:
+                breaker.record_failure()
+                settled = True
+                logger.error(f"Connection error on attempt {attempt + 1}/{MAX_RETRIES}: {str(e)}")
+                # ส่งข้อความบางส่วนไปแล้ว ลองใหม่ไม่ได้เพราะจะได้ข้อความซ้ำ
+                if yielded:
+                    return
+                if attempt < MAX_RETRIES - 1:
+                    continue
+                yield "ขออภัยค่ะ ระบบ AI ไม่สามารถตอบคำถามได้ในขณะนี้ กรุณาลองใหม่อีกครั้ง"
+                return
+            finally:
+                # ถูกยกเลิกหรือเกิดข้อผิดพลาดอื่นก่อนรู้ผล: คืน probe ให้ half-open
+                if not settled:
+                    breaker.release()
+
+    def generate(self, prompt: str, max_tokens: int = NUM_PREDICT) -> str:
+        for attempt in range(MAX_RETRIES):
+            self._acquire_breaker()
+            settled = False
+            try:
+                # Add exponential backoff
+                if attempt > 0:
+                    sleep_time = BACKOFF_FACTOR ** attempt
+                    logger.info(f"Retrying in {sleep_time} seconds...")
+                    time.sleep(sleep_time)
                 # อ่านทีละบรรทัดและรวม response
-                result = ""
-                for line in response.iter_lines(decode_unicode=True):
-                    if not line:
-                        continue
-                    try:
-                        data = json.loads(line)
-                        if "response" in data:
-                            result += data["response"]
-                        if data.get("done"):
-                            break
-                    except Exception as e:
-                        logger.error(f"Error parsing streaming line: {e}")
-                        continue
-                return result.strip()
-                
-            logger.error(f"Ollama API error: Status={response.status_code}, Response={response.text[:200]}")
-            if attempt < MAX_RETRIES - 1:
-                continue
-            return "ขออภัยค่ะ ระบบยังไม่พร้อมให้บริการ กรุณาติดต่อผู้ดูแลระบบ"
-
-        except (requests.exceptions.ConnectTimeout,
-                requests.exceptions.ReadTimeout,
-                requests.exceptions.ConnectionError) as e:
-            logger.error(f"Connection error on attempt {attempt + 1}/{MAX_RETRIES}: {str(e)}")
-            if attempt < MAX_RETRIES - 1:
-                continue
-            return "ขออภัยค่ะ ระบบ AI ไม่สามารถตอบคำถามได้ในขณะนี้ กรุณาลองใหม่อีกครั้ง"
-            
-    return "ขออภัยค่ะ เกิดข้อผิดพลาดในการประมวลผล"
+                text = "".join(self.stream_once(prompt, max_tokens)).strip()
+                breaker.record_success()
+                settled = True
+                return text
+
+            except LLMStatusError as e:
+                breaker.record_failure()
+                settled = True
+                logger.error(str(e))
+                if attempt < MAX_RETRIES - 1:
+                    continue
+                raise LLMGenerationError("ขออภัยค่ะ ระบบยังไม่พร้อมให้บริการ กรุณาติดต่อผู้ดูแลระบบ")
+
+            except (requests.exceptions.ConnectTimeout,
+                    requests.exceptions.ReadTimeout,
+                    requests.exceptions.ConnectionError) as e:
+                breaker.record_failure()
+                settled = True
+                logger.error(f"Connection error on attempt {attempt + 1}/{MAX_RETRIES}: {str(e)}")
+                if attempt < MAX_RETRIES - 1:
+                    continue
+                raise LLMGenerationError("ขออภัยค่ะ ระบบ AI ไม่สามารถตอบคำถามได้ในขณะนี้ กรุณาลองใหม่อีกครั้ง")
+            finally:
+                if not settled:
+                    breaker.release()
+
+        raise LLMGenerationError("ขออภัยค่ะ เกิดข้อผิดพลาดในการประมวลผล")
+
+    def _acquire_breaker(self):
+        # ตรวจก่อนทุกครั้งรวมถึง retry เมื่อ breaker เปิดระหว่าง retry จะเลิกทันทีแทนการรอ backoff
+        if not breaker.allow():
+            raise LLMUnavailableError(f"{self.name} circuit breaker is {breaker.state}")
+
+    def health(self) -> dict:
+        """ตรวจว่า server ตอบและมีโมเดลที่ตั้งค่าไว้"""
+        status = {"backend": self.name, "url": self.base_url, "model": self.model, "ok": False}
+        start = time.perf_counter()
+        try:
+            response = http_client.get(self.health_url(), headers=self._headers(), timeout=(CONNECT_TIMEOUT, 5))
+            status["latency_ms"] = round((time.perf_counter() - start) * 1000, 1)
+            if response.status_code != 200:
+                status["error"] = f"Status={response.status_code}"
+                return status
+            models = self._model_names(response.json())
+            status["model_available"] = any(name == self.model or name.split(':')[0] == self.model for name in models)
+            status["ok"] = True
+        except Exception as e:
+            status["error"] = str(e)
+        return status
+
+    def _headers(self) -> dict:
+        return {}
+
+    def _model_names(self, data: dict):
+        return []
+
+
+class OllamaGenerateBackend(LLMBackend):
+    """Ollama /api/generate (persona in the system field)"""
+
+    name = "ollama-generate"
+
+    def _options(self, max_tokens: int) -> dict:
+        return {
+            "temperature": LLM_TEMPERATURE,
+            "num_predict": max_tokens,
+            "num_ctx": NUM_CTX,
+            "num_thread": NUM_THREAD,
+            "top_k": LLM_TOP_K,
+            "top_p": LLM_TOP_P
+        }
+
+    def request(self, prompt: str, max_tokens: int):
+        payload = {
+            "model": self.model,
+            "prompt": prompt,
+            "stream": True,
+            "keep_alive": _keep_alive(),
+            "options": self._options(max_tokens)
+        }
+        if PROMPT_MODE == "system":
+            payload["system"] = SYSTEM_PROMPT
+        return f"{self.base_url}/api/generate", payload, self._headers()
+
+    def parse_line(self, line: str):
+        data = json.loads(line)
+        if data.get("done"):
+            _record_prompt_stats(data)
+        return data.get("response"), bool(data.get("done"))
+
+    def health_url(self) -> str:
+        return f"{self.base_url}/api/tags"
+
+    def _model_names(self, data: dict):
+        return [model.get("name", "") for model in data.get("models", [])]
+
+
+class OllamaChatBackend(OllamaGenerateBackend):
+    """Ollama /api/chat with system and user messages"""
+
+    name = "ollama-chat"
+
+    def request(self, prompt: str, max_tokens: int):
+        payload = {
+            "model": self.model,
+            "messages": self.messages(prompt),
+            "stream": True,
+            "keep_alive": _keep_alive(),
+            "options": self._options(max_tokens)
+        }
+        return f"{self.base_url}/api/chat", payload, self._headers()
+
+    def parse_line(self, line: str):
+        data = json.loads(line)
+        if data.get("done"):
+            _record_prompt_stats(data)
+        return (data.get("message") or {}).get("content"), bool(data.get("done"))
+
+
+class OpenAICompatibleBackend(LLMBackend):
+    """Any server exposing the OpenAI /chat/completions API (vLLM, llama.cpp server, LM Studio, Ollama /v1)"""
+
+    name = "openai"
+    default_base_url = "http://localhost:8000/v1"
+
+    def request(self, prompt: str, max_tokens: int):
+        payload = {
+            "model": self.model,
+            "messages": self.messages(prompt),
+            "stream": True,
+            "max_tokens": max_tokens,
+            "temperature": LLM_TEMPERATURE,
+            "top_p": LLM_TOP_P,
+            "stream_options": {"include_usage": True}
+        }
+        return f"{self.base_url}/chat/completions", payload, self._headers()
+
+    def parse_line(self, line: str):
+        # Server-sent events: "data: {...}" และจบด้วย "data: [DONE]"
+        if not line.startswith("data:"):
+            return None, False
+        data = line[5:].strip()
+        if data == "[DONE]":
+            return None, True
+        chunk = json.loads(data)
+        usage = chunk.get("usage")
+        if usage:
+            _record_prompt_stats({
+                "prompt_eval_count": usage.get("prompt_tokens"),
+                "eval_count": usage.get("completion_tokens", 0)
+            })
+        choices = chunk.get("choices") or []
+        if not choices:
+            return None, False
+        return (choices[0].get("delta") or {}).get("content"), False
+
+    def health_url(self) -> str:
+        return f"{self.base_url}/models"
+
+    def _headers(self) -> dict:
+        return {"Authorization": f"Bearer {self.api_key}"} if self.api_key else {}
+
+    def _model_names(self, data: dict):
+        return [model.get("id", "") for model in data.get("data", [])]
+
+
+BACKENDS = {
+    backend.name: backend
+    for backend in (OllamaGenerateBackend, OllamaChatBackend, OpenAICompatibleBackend)
+}
+
+
+def create_backend(name: str = LLM_BACKEND, base_url: str = LLM_BASE_URL,
+                   model: str = OLLAMA_MODEL, api_key: str = LLM_API_KEY) -> LLMBackend:
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown LLM_BACKEND '{name}', expected one of: {', '.join(BACKENDS)}")
+    return BACKENDS[name](base_url or None, model, api_key)
+
+
+backend = create_backend()
+
+
+def health() -> dict:
+    status = backend.health()
+    status["circuit"] = breaker.status()
+    return status
+
+def _stream_tokens(prompt: str):
+    start = time.perf_counter()
+    first = True
+    for token in backend.stream(prompt):
+        if first:
+            record("llm_first_token", time.perf_counter() - start)
+            first = False
+        yield token
+    # รวมเวลาที่ผู้เรียกใช้ส่งแต่ละช่วงด้วย เพราะ generation รอให้อ่าน stream
+    record("llm_stream", time.perf_counter() - start)
+
+def _generate_response(prompt: str) -> str:
+    """Internal function to generate response from the configured backend"""
+    with span("llm_generate"):
+        return backend.generate(prompt)
@@ -0,0 +1,76 @@
+import re
+import threading
+from collections import OrderedDict
+from typing import Optional
+
+import numpy as np
+
+import metrics
+
+BOT_MENTION = "@DMC Chatbot"
+
+_ZERO_WIDTH = re.compile(r'[\u200b-\u200d\u2060\ufeff]')
+_WHITESPACE = re.compile(r'\s+')
+
+cache_lookups_total = metrics.counter("query_embedding_cache_lookups_total", "Query embedding cache lookups by result")
+cache_entries = metrics.gauge("query_embedding_cache_entries", "Query embeddings currently cached")
+
+
+def normalize_query(text: str) -> str:
+    """ตัด zero-width, ชื่อบอทที่ขึ้นต้นข้อความในกลุ่ม และยุบช่องว่างให้เหลือช่องเดียว"""
+    text = _ZERO_WIDTH.sub('', text or '')
+    text = _WHITESPACE.sub(' ', text).strip()
+    if text.startswith(BOT_MENTION):
+        text = text[len(BOT_MENTION):].strip()
+    return text
+
+
+class QueryEmbeddingCache:
+    """
+    Bounded LRU cache of query embeddings keyed on the normalised query.
+    Vectors are kept as float16 to halve memory; get() returns float32.
+    """
+
+    def __init__(self, max_size: int = 2048):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[np.ndarray]:
+        with self._lock:
+            vector = self._entries.get(key)
+            if vector is not None:
+                self._entries.move_to_end(key)
+        cache_lookups_total.inc(result="hit" if vector is not None else "miss")
+        if vector is None:
+            return None
+        return vector.astype('float32')[None, :]
+
+    def put(self, key: str, embedding: np.ndarray):
+        if self.max_size <= 0:
+            return
+        vector = np.asarray(embedding, dtype=np.float16).reshape(-1)
+        with self._lock:
+            self._entries[key] = vector
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    def track_metrics(self):
+        """ให้ gauge จำนวน entry อ่านจาก cache นี้ (เรียกเมื่อ cache นี้เป็นของระบบที่ใช้งานอยู่)"""
+        cache_entries.set_function(lambda: len(self._entries))
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def hit_rate(self) -> float:
+        hits = cache_lookups_total.value(result="hit")
+        total = hits + cache_lookups_total.value(result="miss")
+        return hits / total if total else 0.0
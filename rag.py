@@ -1,250 +1,690 @@
+import hashlib
 import json
 import logging
 import numpy as np
 import faiss
 import os
-from sentence_transformers import SentenceTransformer
+import threading
+import time
 from typing import List, Dict
-import pickle
 from tqdm import tqdm
 
+import chunker
+import index_factory
+import ingest
+import metrics
+from document_store import DocumentStore
+from encoders import create_encoder
+from lexical_index import LexicalIndex, normalize_text, reciprocal_rank_fusion
+from query_cache import QueryEmbeddingCache, normalize_query
+from tracing import span
+
 logger = logging.getLogger(__name__)
 
+# เปลี่ยนเลขนี้เมื่อรูปแบบข้อมูลใน cache เปลี่ยน เพื่อไม่ให้อ่าน cache เก่า
+INDEX_CACHE_VERSION = 2
+
+# ค้นหาแบบผสม BM25 + vector แล้วรวมอันดับด้วย reciprocal rank fusion
+HYBRID_SEARCH = os.getenv("HYBRID_SEARCH", "true").lower() == "true"
+HYBRID_CANDIDATES = int(os.getenv("HYBRID_CANDIDATES", "20"))
+RRF_K = int(os.getenv("RRF_K", "60"))
+
+# จำนวนผลที่ดึงต่อ k เมื่อเอกสารถูกแบ่งเป็น chunk (chunk หลายอันอาจมาจาก section เดียวกัน)
+CHUNK_SEARCH_FACTOR = int(os.getenv("CHUNK_SEARCH_FACTOR", "3"))
+CHUNK_MERGE_MAX = int(os.getenv("CHUNK_MERGE_MAX", "3"))
+
+# รวม query ที่เข้ามาพร้อมกันเป็น batch เดียว: รอไม่เกิน window แล้ว encode/search ครั้งเดียว
+# QUERY_BATCH_WINDOW_MS=0 หรือ QUERY_BATCH_MAX_SIZE=1 คือปิดการรวม batch
+QUERY_BATCH_WINDOW_MS = float(os.getenv("QUERY_BATCH_WINDOW_MS", "3"))
+QUERY_BATCH_MAX_SIZE = int(os.getenv("QUERY_BATCH_MAX_SIZE", "16"))
+
+# ทางลัด Q&A: เทียบกับ index ที่มีเฉพาะคำถาม แล้วตอบด้วยคำตอบสำเร็จรูปโดยไม่ค้น content และไม่เรียก LLM
+QA_DIRECT_ENABLED = os.getenv("QA_DIRECT_ENABLED", "true").lower() == "true"
+# e5 ให้ score ราว 0.7-0.95 แม้คำถามไม่ตรงกัน: ตั้งเกณฑ์จากตาราง qa_direct ของ benchmark_retrieval.py
+# และถ้าคำถามที่คำตอบต่างกันมี score ห่างไม่ถึง QA_DIRECT_MARGIN ให้ค้นตามปกติแทน
+QA_DIRECT_THRESHOLD = float(os.getenv("QA_DIRECT_THRESHOLD", "0.95"))
+QA_DIRECT_MARGIN = float(os.getenv("QA_DIRECT_MARGIN", "0.03"))
+
+# cache embedding ของคำถามที่ normalize แล้ว (0 = ปิด)
+QUERY_CACHE_SIZE = int(os.getenv("QUERY_CACHE_SIZE", "2048"))
+
+batch_size_histogram = metrics.histogram(
+    "rag_batch_size", "Queries per micro-batch", buckets=(1, 2, 4, 8, 16, 32, 64, 128))
+batch_wait_seconds = metrics.histogram(
+    "rag_batch_wait_seconds", "Time a query waited for its micro-batch to start")
+batch_run_seconds = metrics.histogram(
+    "rag_batch_run_seconds", "Time to run one micro-batch")
+
+
+class _Pending:
+    __slots__ = ("item", "submitted", "result", "error", "lead", "event")
+
+    def __init__(self, item):
+        self.item = item
+        self.submitted = time.perf_counter()
+        self.result = None
+        self.error = None
+        self.lead = False
+        self.event = threading.Event()
+
+
+class MicroBatcher:
+    """
+    Collect items submitted by concurrent callers and process them together.
+
+    A caller that arrives while no batch is queued or running becomes the
+    leader and runs at once, so a lone request pays no batching delay.
+    Callers arriving while a batch runs queue up; when it finishes, the
+    oldest of them takes over, waits until window_ms after its own arrival
+    (or until max_batch items are queued), runs func on one batch that
+    contains its own item, hands every caller its result and passes
+    leadership on. Each caller runs at most one batch, so nobody is held
+    back draining everyone else's work.
+    No background thread is used, so the batcher is safe to create before a
+    gunicorn --preload fork.
+    """
+
+    def __init__(self, name: str, func, max_batch: int = QUERY_BATCH_MAX_SIZE,
+                 window_ms: float = QUERY_BATCH_WINDOW_MS):
+        self.name = name
+        self.func = func
+        self.max_batch = max(1, max_batch)
+        self.window = max(0.0, window_ms) / 1000.0
+        self._pending = []
+        self._leader_active = False
+        self._cond = threading.Condition()
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_batch > 1 and self.window > 0
+
+    def submit(self, item):
+        if not self.enabled:
+            return self._run([item])[0]
+
+        request = _Pending(item)
+        idle = False
+        with self._cond:
+            self._pending.append(request)
+            if not self._leader_active:
+                # คิวว่างเมื่อไม่มี leader ผู้เรียกคนนี้จึงอยู่หัวคิวเสมอ และไม่มี batch ที่กำลังทำงาน
+                # จึงไม่มีงานให้รอรวม ทำทันที
+                self._leader_active = True
+                request.lead = True
+                idle = True
+            elif len(self._pending) >= self.max_batch:
+                self._cond.notify()
+        while True:
+            if request.lead:
+                request.lead = False
+                self._lead(request, wait=not idle)
+            request.event.wait()
+            if not request.lead:
+                break
+            request.event.clear()
+        if request.error is not None:
+            raise request.error
+        return request.result
+
+    def _lead(self, request: _Pending, wait: bool = True):
+        # นับ window จากเวลาที่ leader เข้าคิว: ผู้ที่รอระหว่าง batch ก่อนหน้าจะไม่ต้องรอซ้ำ
+        deadline = request.submitted + self.window
+        with self._cond:
+            while wait and len(self._pending) < self.max_batch:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            # leader อยู่หัวคิว batch นี้จึงมีงานของ leader เองเสมอ
+            batch = self._pending[:self.max_batch]
+            del self._pending[:self.max_batch]
+
+        started = time.perf_counter()
+        for pending in batch:
+            batch_wait_seconds.observe(started - pending.submitted, stage=self.name)
+        try:
+            results = self._run([pending.item for pending in batch])
+            for pending, result in zip(batch, results):
+                pending.result = result
+        except Exception as e:
+            for pending in batch:
+                pending.error = e
+        finally:
+            with self._cond:
+                # ส่งต่อหน้าที่ leader ให้ผู้ที่รอนานที่สุด
+                if self._pending:
+                    successor = self._pending[0]
+                    successor.lead = True
+                    successor.event.set()
+                else:
+                    self._leader_active = False
+            for pending in batch:
+                pending.event.set()
+
+    def _run(self, items):
+        batch_size_histogram.observe(len(items), stage=self.name)
+        with batch_run_seconds.time(stage=self.name):
+            return self.func(items)
+
+
+def _model_slug(model_name: str) -> str:
+    return model_name.replace('/', '__').replace(':', '_')
+
+def _file_sha256(file_path: str) -> str:
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def _corpus_key(model_name: str, files_manifest: Dict, chunking: Dict = None) -> str:
+    """Key of the whole corpus: model name, chunking settings plus every file's name and content hash"""
+    digest = hashlib.sha256(model_name.encode('utf-8'))
+    if chunking:
+        digest.update(json.dumps(chunking, sort_keys=True).encode('utf-8'))
+    for name in sorted(files_manifest):
+        digest.update(f"{name}:{files_manifest[name]['sha256']}".encode('utf-8'))
+    return digest.hexdigest()
+
+def _overlap(previous: str, text: str) -> int:
+    """ความยาวของส่วนท้าย previous ที่ซ้ำกับส่วนต้น text (ตัดที่ขอบคำเท่านั้น)"""
+    for size in range(min(len(previous), len(text)), 0, -1):
+        if (size == len(text) or text[size].isspace()) and previous.endswith(text[:size]):
+            return size
+    return 0
+
+def _merge_chunks(results: List[Dict]) -> List[Dict]:
+    """
+    รวม chunk ที่มาจาก section เดียวกันเป็นผลเดียว (ตำแหน่งของ chunk ที่อันดับดีที่สุด)
+    เนื้อหาเรียงตามลำดับ chunk ในเอกสาร ใช้ไม่เกิน CHUNK_MERGE_MAX chunk ต่อ section
+    chunk ที่ติดกันตัดข้อความที่ซ้อนกันออก chunk ที่ไม่ติดกันคั่นด้วย "..."
+    """
+    merged = []
+    groups = {}
+    for result in results:
+        parent = result.get('parent')
+        if parent is None:
+            merged.append(result)
+            continue
+        group = groups.get(parent)
+        if group is None:
+            groups[parent] = group = dict(result, chunks=[result])
+            merged.append(group)
+        elif len(group['chunks']) < CHUNK_MERGE_MAX:
+            group['chunks'].append(result)
+            group['score'] = max(group['score'], result['score'])
+    for group in groups.values():
+        chunks = sorted(group.pop('chunks'), key=lambda r: r.get('chunk') or 0)
+        group['chunks'] = [r.get('chunk') for r in chunks]
+        content = chunks[0]['content']
+        for previous, result in zip(chunks, chunks[1:]):
+            text = result['content']
+            if (result.get('chunk') or 0) - (previous.get('chunk') or 0) == 1:
+                size = _overlap(previous['content'], text)
+                content += text[size:] if size else " " + text
+            else:
+                content += "\n...\n" + text
+        group['content'] = content
+    return merged
+
+def _read_index_mmap(index_path: str):
+    """Read a FAISS index memory-mapped when this FAISS build supports it"""
+    for flag_name in ('IO_FLAG_MMAP_IFC', 'IO_FLAG_MMAP'):
+        flag = getattr(faiss, flag_name, None)
+        if flag is None:
+            continue
+        try:
+            return faiss.read_index(index_path, flag)
+        except Exception as e:
+            logger.debug(f"Could not read index with {flag_name}: {e}")
+    return faiss.read_index(index_path)
+
+def _remove_unreferenced(files_dir: str, files_manifest: Dict):
+    """ลบ documents/embeddings/คำถามของไฟล์ที่ถูกลบหรือแก้ไขไปแล้ว"""
+    referenced = {entry['sha256'] for entry in files_manifest.values()}
+    for name in os.listdir(files_dir):
+        if name.split('.', 1)[0] not in referenced:
+            try:
+                os.remove(os.path.join(files_dir, name))
+            except OSError:
+                pass
+
 class RAGSystem:
-    def __init__(self, model_name: str = 'intfloat/multilingual-e5-base'):
-        self.encoder = SentenceTransformer(model_name)
+    def __init__(self, model_name: str = 'intfloat/multilingual-e5-base', encoder=None):
+        self.model_name = model_name
+        # torch / ONNX / ONNX int8 ตาม ENCODER_BACKEND (torch จะถูก import เฉพาะเมื่อเลือก torch)
+        # ส่ง encoder เดิมมาได้ตอน reload index เพื่อไม่ต้องโหลดโมเดลซ้ำ
+        self.encoder = encoder or create_encoder(model_name)
+        # ชื่อที่ใช้แยก cache ของ index (embedding ของ int8 ต่างจาก torch)
+        self.embedding_id = self.encoder.cache_id
         self.index = None
         self.documents = []
+        self.embeddings = None
         self.dimension = None
+        self.index_config = {}
+        self.lexical = None
+        self.question_ids = None
+        self.question_embeddings = None
+        self._question_map = {}
+        self._encode_batcher = MicroBatcher("encode", self._encode_batch)
+        self._search_batcher = MicroBatcher("search", self._search_batch)
+        self.query_cache = QueryEmbeddingCache(QUERY_CACHE_SIZE) if QUERY_CACHE_SIZE > 0 else None
+        self.corpus_version = None
         self.cache_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cache')
         os.makedirs(self.cache_dir, exist_ok=True)
-        logger.info(f"Initialized RAG system with model: {model_name}")
+        logger.info(f"Initialized RAG system with model: {model_name} ({self.encoder.name} encoder)")
 
-        # ตรวจสอบว่ามี GPU หรือไม่
+        # ตรวจสอบว่ามี GPU หรือไม่ (ถามจาก faiss เพื่อไม่ต้อง import torch)
         self.use_gpu = False
         try:
-            import torch
-            if torch.cuda.is_available():
+            if hasattr(faiss, 'get_num_gpus') and faiss.get_num_gpus() > 0:
                 self.use_gpu = True
                 logger.info("GPU acceleration enabled")
-        except:
+        except Exception:
             pass
 
     def load_documents(self, json_path: str):
         try:
             base_dir = os.path.dirname(os.path.abspath(__file__))
             json_dir = os.path.join(base_dir, 'data', 'json')
-            cache_file = os.path.join(self.cache_dir, 'faiss_index.cache')
-            
-            # ตรวจสอบ cache
-            if os.path.exists(cache_file):
-                try:
-                    with open(cache_file, 'rb') as f:
-                        cache_data = pickle.load(f)
-                        self.documents = cache_data['documents']
-                        self.index = cache_data['index']
-                        self.dimension = cache_data['dimension']
-                        logger.info("Loaded index from cache")
-                        return True
-                except Exception as e:
-                    logger.warning(f"Could not load cache: {e}")
-
-            # ถ้าไม่มี cache หรือโหลดไม่สำเร็จ ให้โหลดจากไฟล์
+
             if not os.path.exists(json_dir):
                 logger.error(f"Directory not found: {json_dir}")
                 return False
 
-            processed_docs = []
-            json_files = [f for f in os.listdir(json_dir) if f.endswith('.json')]
+            json_files = sorted(f for f in os.listdir(json_dir) if f.endswith('.json'))
 
             if not json_files:
                 logger.warning(f"No JSON files found in {json_dir}")
                 return False
-            
-            for json_file in tqdm(json_files, desc="Loading documents"):
-                logger.info(f"Processing file: {json_file}")
-                try:
-                    file_path = os.path.join(json_dir, json_file)
-                    with open(file_path, 'r', encoding='utf-8') as f:
-                        data = json.load(f)
-
-                    # แบบที่ 1: Q&A
-                    if isinstance(data, list) and all(isinstance(item, dict) for item in data):
-                        # ตรวจสอบ doc.json (มี sections)
-                        if (
-                            "part" in data[0] and
-                            "sections" in data[0]
-                        ):
-                            # รองรับ doc.json
-                            for part_item in data:
-                                part = part_item.get("part")
-                                title = part_item.get("title", "")
-                                for section in part_item.get("sections", []):
-                                    topic = section.get("topic", "")
-                                    content = section.get("content", "")
-                                    page = section.get("page", "")
-                                    summary = section.get("summary", "")
-                                    keywords = section.get("keywords", [])
-                                    text = f"ส่วนที่ {part} เรื่อง: {title} หน้า {page} หัวข้อ: {topic} สรุป: {summary} คำสำคัญ: {', '.join(keywords)} เนื้อหา: {content}"
-                                    processed_docs.append({
-                                        'text': text,
-                                        "metadata": {
-                                            'part': part,
-                                            'title': title,
-                                            'topic': topic,
-                                            'content': content,
-                                            'page': page,
-                                            'summary': summary,
-                                            'keywords': keywords,
-                                            'source': json_file
-                                        }
-                                    })
-                        else:
-                            # Q&A ปกติ
-                            for item in data:
-                                if "question" in item and "answer" in item:
-                                    text = f"{item['question']} {item['answer']}"
-                                    processed_docs.append({
-                                        'text': text,
-                                        'question': item['question'],
-                                        'answer': item['answer'],
-                                        'source': json_file
-                                    })
-                    # แบบที่ 2: part/title/data
-                    elif isinstance(data, list) and all(isinstance(item, dict) and "data" in item for item in data):
-                        for section in data:
-                            part = section.get("part")
-                            title = section.get("title", "")
-                            for entry in section.get("data", []):
-                                page = entry.get("page")
-                                topic = entry["topic"]
-                                content = entry["content"]
-                                text = f"ส่วนที่ {part} เรื่อง: {title} หน้า {page} หัวข้อ: {topic} เนื้อหา: {content}"
-                                logger.info(f"Processing part: {part}, title: {title}, topic: {topic}, page: {page}")
-                                processed_docs.append({
-                                    'text': text,
-                                    "metadata": {
-                                        'part': part,
-                                        'title': title,
-                                        'topic': topic,
-                                        'content': content,
-                                        'page': page,
-                                        'source': json_file
-                                    }
-                                })
-                    else:
-                        logger.warning(f"Unknown JSON structure in file: {json_file}")
-                except Exception as e:
-                    logger.error(f"Error loading file {json_file}: {str(e)}")
-                    continue
-            
-            
-            self.documents = processed_docs
-            self._build_index()
 
-            # บันทึก cache
-            try:
-                with open(cache_file, 'wb') as f:
-                    pickle.dump({
-                        'documents': self.documents,
-                        'index': self.index,
-                        'dimension': self.dimension
-                    }, f)
-                logger.info("Saved index to cache")
-            except Exception as e:
-                logger.warning(f"Could not save cache: {e}")
+            # cache แยกตามเวอร์ชันของรูปแบบ cache และชื่อโมเดล
+            store_dir = os.path.join(self.cache_dir, f"index_v{INDEX_CACHE_VERSION}", _model_slug(self.embedding_id))
+            files_dir = os.path.join(store_dir, 'files')
+            os.makedirs(files_dir, exist_ok=True)
+            manifest = self._read_manifest(store_dir)
+            cached_files = manifest.get('files', {})
+
+            file_hashes = {name: _file_sha256(os.path.join(json_dir, name)) for name in json_files}
+            chunking = chunker.settings()
+            corpus_key = _corpus_key(self.embedding_id, {name: {'sha256': h} for name, h in file_hashes.items()}, chunking)
+
+            # ไม่มีไฟล์ใดเปลี่ยน: map index, embeddings และเอกสารจากดิสก์โดยตรง
+            if (
+                manifest.get('corpus_key') == corpus_key and
+                manifest.get('index_settings') == index_factory.settings() and
+                self._load_mapped(store_dir, manifest.get('index_config', {}))
+            ):
+                self.corpus_version = corpus_key
+                logger.info("Loaded index from cache")
+                return True
+
+            documents = []
+            embeddings = []
+            files_manifest = {}
+            removed = set(cached_files) - set(json_files)
+            if removed:
+                logger.info(f"Removed files: {', '.join(sorted(removed))}")
+
+            per_file = {}
+            changed = []
+            for json_file in json_files:
+                file_hash = file_hashes[json_file]
+                docs_path = os.path.join(files_dir, f"{file_hash}.json")
+                emb_path = os.path.join(files_dir, f"{file_hash}.npy")
+                cached = cached_files.get(json_file)
+                if (
+                    cached and cached.get('sha256') == file_hash and cached.get('chunking') == chunking and
+                    os.path.exists(docs_path) and os.path.exists(emb_path)
+                ):
+                    with open(docs_path, 'r', encoding='utf-8') as f:
+                        per_file[json_file] = (json.load(f), np.load(emb_path))
+                else:
+                    changed.append((json_file, os.path.join(json_dir, json_file)))
+
+            if changed:
+                # ไฟล์ใหม่หรือมีการแก้ไข: parse พร้อมกันหลายไฟล์และ encode ไปพร้อมกับการ parse
+                logger.info(f"Processing files: {', '.join(name for name, _ in changed)}")
+                parsed = ingest.ingest(changed, self._encode_documents, self._count_tokens,
+                                       self.encoder.get_sentence_embedding_dimension())
+                for json_file, (docs, file_embeddings) in parsed.items():
+                    file_hash = file_hashes[json_file]
+                    with open(os.path.join(files_dir, f"{file_hash}.json"), 'w', encoding='utf-8') as f:
+                        json.dump(docs, f, ensure_ascii=False)
+                    np.save(os.path.join(files_dir, f"{file_hash}.npy"), file_embeddings)
+                    per_file[json_file] = (docs, file_embeddings)
 
+            changed_files = {name for name, _ in changed}
+            question_ids, question_embeddings = [], []
+            for json_file in json_files:
+                docs, file_embeddings = per_file[json_file]
+                files_manifest[json_file] = {'sha256': file_hashes[json_file], 'count': len(docs), 'chunking': chunking}
+                if QA_DIRECT_ENABLED:
+                    ids, questions = self._file_questions(files_dir, file_hashes[json_file], docs,
+                                                          json_file in changed_files)
+                    question_ids.extend(len(documents) + i for i in ids)
+                    question_embeddings.append(questions)
+                documents.extend(docs)
+                if docs:
+                    embeddings.append(file_embeddings)
+
+            if not documents:
+                logger.warning("No documents to index")
+                return False
+            # เก็บเอกสารแบบ columnar แทน list ของ dict
+            self.documents = DocumentStore.from_documents(documents)
+            del documents
+
+            embeddings = np.vstack(embeddings).astype('float32')
+            self._build_index(embeddings)
+            self._set_question_index(question_ids, question_embeddings)
+            self._save_store(store_dir, embeddings)
+            self._write_manifest(store_dir, {
+                'version': INDEX_CACHE_VERSION,
+                'model': self.embedding_id,
+                'corpus_key': corpus_key,
+                'dimension': self.dimension,
+                'index_settings': index_factory.settings(),
+                'index_config': self.index_config,
+                'files': files_manifest
+            })
+            _remove_unreferenced(files_dir, files_manifest)
+            self.corpus_version = corpus_key
+
+            # เปลี่ยนไปใช้ข้อมูลแบบ memory-mapped แทนสำเนาบน heap (index คำถามที่เพิ่งสร้างใช้ต่อได้เลย)
+            if not self._load_mapped(store_dir, self.index_config, questions=False):
+                self.embeddings = embeddings
+                self._build_lexical()
             return True
-            
+
         except Exception as e:
             logger.error(f"Error loading documents: {str(e)}")
             return False
 
-    def _build_index(self):
-        if not self.documents:
-            logger.warning("No documents to index")
+    def _read_manifest(self, store_dir: str) -> Dict:
+        manifest_path = os.path.join(store_dir, 'manifest.json')
+        if not os.path.exists(manifest_path):
+            return {}
+        try:
+            with open(manifest_path, 'r', encoding='utf-8') as f:
+                manifest = json.load(f)
+            if manifest.get('version') != INDEX_CACHE_VERSION or manifest.get('model') != self.embedding_id:
+                return {}
+            return manifest
+        except Exception as e:
+            logger.warning(f"Could not read cache manifest: {e}")
+            return {}
+
+    def _write_manifest(self, store_dir: str, manifest: Dict):
+        try:
+            tmp_path = os.path.join(store_dir, 'manifest.json.tmp')
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(manifest, f, ensure_ascii=False, indent=2)
+            os.replace(tmp_path, os.path.join(store_dir, 'manifest.json'))
+        except Exception as e:
+            logger.warning(f"Could not save cache manifest: {e}")
+
+    def _save_store(self, store_dir: str, embeddings: np.ndarray):
+        """Write the index, all embeddings and all documents as files that can be memory-mapped"""
+        try:
+            index = faiss.index_gpu_to_cpu(self.index) if self.use_gpu and hasattr(faiss, 'index_gpu_to_cpu') else self.index
+            index_path = os.path.join(store_dir, 'index.faiss')
+            faiss.write_index(index, index_path + '.tmp')
+            os.replace(index_path + '.tmp', index_path)
+            emb_path = os.path.join(store_dir, 'embeddings.npy')
+            with open(emb_path + '.tmp', 'wb') as f:
+                np.save(f, embeddings)
+            os.replace(emb_path + '.tmp', emb_path)
+            self.documents.save(os.path.join(store_dir, 'documents'))
+            if self.question_embeddings is not None:
+                for name, array in (('question_ids.npy', self.question_ids), ('questions.npy', self.question_embeddings)):
+                    path = os.path.join(store_dir, name)
+                    with open(path + '.tmp', 'wb') as f:
+                        np.save(f, array)
+                    os.replace(path + '.tmp', path)
+            logger.info("Saved index to cache")
+        except Exception as e:
+            logger.warning(f"Could not save cache: {e}")
+
+    def _load_mapped(self, store_dir: str, index_config: Dict, questions: bool = True) -> bool:
+        paths = [os.path.join(store_dir, name) for name in ('index.faiss', 'embeddings.npy', 'documents')]
+        if not all(os.path.exists(path) for path in paths[:2]) or not DocumentStore.exists(paths[2]):
+            return False
+        try:
+            index = _read_index_mmap(paths[0])
+            index_factory.apply_search_params(index, index_config)
+            self.index_config = index_config
+            self.embeddings = np.load(paths[1], mmap_mode='r')
+            self.documents = DocumentStore.load(paths[2])
+            self.index = self._to_gpu(index)
+            self.dimension = index.d
+            self._build_lexical()
+            if questions:
+                self._load_question_index(store_dir)
+            return True
+        except Exception as e:
+            logger.warning(f"Could not map cached index: {e}")
+            return False
+
+    def _build_question_index(self):
+        """Embed only the question of every Q&A document and map its normalised text"""
+        self.question_ids = None
+        self.question_embeddings = None
+        self._question_map = {}
+        if not QA_DIRECT_ENABLED:
+            return
+        ids, questions = [], []
+        for i in range(len(self.documents)):
+            question = self.documents.get_field(i, 'question')
+            if question and self.documents.get_field(i, 'answer') is not None:
+                ids.append(i)
+                questions.append(question)
+        self.question_ids = np.asarray(ids, dtype=np.int32)
+        self.question_embeddings = self._encode_texts(questions) if questions else None
+        self._build_question_map()
+
+    def _file_questions(self, files_dir: str, file_hash: str, docs: List[Dict], changed: bool):
+        """
+        ตำแหน่ง (ภายในไฟล์) และ embedding ของคำถาม Q&A ของไฟล์หนึ่ง
+        เก็บไว้คู่กับ files/<sha>.npy และ encode ใหม่เฉพาะไฟล์ที่เปลี่ยน
+        """
+        ids = [i for i, doc in enumerate(docs) if doc.get('question') and doc.get('answer') is not None]
+        path = os.path.join(files_dir, f"{file_hash}.questions.npy")
+        if not changed and os.path.exists(path):
+            try:
+                questions = np.load(path)
+                if len(questions) == len(ids):
+                    return ids, questions
+            except Exception as e:
+                logger.warning(f"Could not read cached question embeddings: {e}")
+        questions = self._encode_texts([docs[i]['question'] for i in ids])
+        try:
+            with open(path + '.tmp', 'wb') as f:
+                np.save(f, questions)
+            os.replace(path + '.tmp', path)
+        except Exception as e:
+            logger.warning(f"Could not save question embeddings: {e}")
+        return ids, questions
+
+    def _set_question_index(self, ids: List[int], embeddings: List[np.ndarray]):
+        """ใช้ embedding ของคำถามที่รวบรวมจากแต่ละไฟล์เป็น index คำถาม"""
+        self.question_ids = None
+        self.question_embeddings = None
+        self._question_map = {}
+        if not QA_DIRECT_ENABLED:
+            return
+        self.question_ids = np.asarray(ids, dtype=np.int32)
+        self.question_embeddings = np.vstack(embeddings).astype('float32') if ids else None
+        self._build_question_map()
+
+    def _load_question_index(self, store_dir: str):
+        paths = [os.path.join(store_dir, name) for name in ('question_ids.npy', 'questions.npy')]
+        if not QA_DIRECT_ENABLED or not all(os.path.exists(path) for path in paths):
+            self._build_question_index()
+            return
+        self.question_ids = np.load(paths[0])
+        self.question_embeddings = np.load(paths[1], mmap_mode='r')
+        self._build_question_map()
+
+    def _build_question_map(self):
+        # คำถามซ้ำกันหลายข้อ (คำตอบต่างกัน) ไม่ใช้เป็นทางลัด
+        question_map = {}
+        for idx in self.question_ids.tolist():
+            key = normalize_text(normalize_query(self.documents.get_field(idx, 'question')))
+            question_map[key] = idx if key not in question_map else -1
+        self._question_map = {key: idx for key, idx in question_map.items() if idx >= 0}
+
+    def _build_lexical(self):
+        # index คำสร้างใหม่จากเอกสารทุกครั้งที่โหลด (ใช้เวลาน้อยเมื่อเทียบกับการ encode)
+        self.lexical = None
+        if not HYBRID_SEARCH:
             return
+        try:
+            self.lexical = LexicalIndex.from_store(self.documents)
+        except Exception as e:
+            logger.warning(f"Could not build lexical index: {e}")
+
+    def _to_gpu(self, index):
+        # ใช้ GPU ถ้ามี
+        if self.use_gpu:
+            try:
+                res = faiss.StandardGpuResources()
+                index = faiss.index_cpu_to_gpu(res, 0, index)
+                logger.info("Using GPU for FAISS index")
+            except Exception as e:
+                logger.warning(f"Could not use GPU: {e}")
+        return index
 
+    def _count_tokens(self, text: str) -> int:
+        # นับด้วย tokenizer ของ encoder เพื่อให้ chunk ไม่เกินความยาวที่ encoder รับได้
+        tokenizer = getattr(self.encoder, 'tokenizer', None)
+        if tokenizer is None:
+            return chunker.approximate_tokens(text)
+        return len(tokenizer.encode(text, add_special_tokens=False))
+
+    def _encode_documents(self, texts: List[str]) -> np.ndarray:
+        # หนึ่ง batch จาก ingest (ขนาด INGEST_BATCH_SIZE)
+        return self.encoder.encode(texts, batch_size=len(texts), convert_to_numpy=True, normalize_embeddings=True)
+
+    def _encode_texts(self, texts: List[str]) -> np.ndarray:
         # Encode documents in batches
         batch_size = 32
-        texts = [doc['text'] for doc in self.documents]
         embeddings = []
-        
+
         for i in tqdm(range(0, len(texts), batch_size), desc="Encoding documents"):
             batch_texts = texts[i:i + batch_size]
             batch_embeddings = self.encoder.encode(batch_texts, convert_to_numpy=True, normalize_embeddings=True)
             embeddings.append(batch_embeddings)
-        
-        embeddings = np.vstack(embeddings)
-        
-        # Initialize IVF index for faster search
+
+        if not embeddings:
+            return np.zeros((0, self.encoder.get_sentence_embedding_dimension()), dtype='float32')
+        return np.vstack(embeddings).astype('float32')
+
+    def _build_index(self, embeddings: np.ndarray):
+        # เลือกชนิด index ตามขนาด corpus แล้วปรับ nprobe/efSearch ให้ได้ recall ตามเป้า
         self.dimension = embeddings.shape[1]
-        n_lists = min(int(np.sqrt(len(self.documents))), 100)  # จำนวน clusters
-        quantizer = faiss.IndexFlatIP(self.dimension)
-        self.index = faiss.IndexIVFFlat(quantizer, self.dimension, n_lists, faiss.METRIC_INNER_PRODUCT)
-        
-        # ใช้ GPU ถ้ามี
-        if self.use_gpu:
-            try:
-                res = faiss.StandardGpuResources()
-                self.index = faiss.index_cpu_to_gpu(res, 0, self.index)
-                logger.info("Using GPU for FAISS index")
-            except Exception as e:
-                logger.warning(f"Could not use GPU: {e}")
+        config = index_factory.choose_index_config(len(embeddings), self.dimension)
+        index = index_factory.build_index(embeddings, config)
+        self.index_config = index_factory.tune_index(index, config, embeddings)
+        self.index = self._to_gpu(index)
+        logger.info(f"Built FAISS {config['type']} index with {len(self.documents)} documents")
+
+    def encode_query(self, query: str) -> np.ndarray:
+        """Encode a single query into a normalised float32 vector of shape (1, dimension)"""
+        key = normalize_query(query)
+        if self.query_cache is not None:
+            cached = self.query_cache.get(key)
+            if cached is not None:
+                return cached
+        with span("encode"):
+            embedding = self._encode_batcher.submit(key or query)
+        if self.query_cache is not None:
+            self.query_cache.put(key, embedding)
+        return embedding
+
+    def prewarm_query_cache(self, texts: List[str]) -> int:
+        """Encode texts ล่วงหน้าเป็น batch แล้วเก็บลง query cache คืนจำนวนที่เพิ่ม"""
+        if self.query_cache is None:
+            return 0
+        keys = []
+        for text in texts:
+            key = normalize_query(text)
+            if key and key not in self.query_cache and key not in keys:
+                keys.append(key)
+        keys = keys[:self.query_cache.max_size]
+        if not keys:
+            return 0
+        embeddings = self.encoder.encode(keys, batch_size=32, convert_to_numpy=True, normalize_embeddings=True)
+        for key, embedding in zip(keys, embeddings):
+            self.query_cache.put(key, embedding)
+        logger.info(f"Pre-populated query embedding cache with {len(keys)} queries")
+        return len(keys)
 
-        # Train and add vectors
-        self.index.train(embeddings)
-        self.index.add(embeddings.astype('float32'))
-        logger.info(f"Built FAISS IVF index with {len(self.documents)} documents")
+    def cached_questions(self) -> List[str]:
+        """คำถามของเอกสาร Q&A ทั้งหมด ใช้เติม query cache ตอนเริ่มระบบ"""
+        questions = (self.documents.get_field(i, 'question') for i in range(len(self.documents)))
+        return [q for q in questions if q]
+
+    def _encode_batch(self, queries: List[str]) -> List[np.ndarray]:
+        embeddings = self.encoder.encode(queries, convert_to_numpy=True, normalize_embeddings=True).astype('float32')
+        return [embeddings[i:i + 1] for i in range(len(queries))]
+
+    def _search_batch(self, items) -> List:
+        # ค้นหาทุก query ในครั้งเดียวด้วย k ที่มากที่สุด แล้วตัดผลตาม k ของแต่ละคน
+        k = max(item_k for _, item_k in items)
+        scores, indices = self.index.search(np.vstack([embedding for embedding, _ in items]), k)
+        return [(scores[i:i + 1, :item_k], indices[i:i + 1, :item_k]) for i, (_, item_k) in enumerate(items)]
 
     def search(self, query: str, k: int = 3) -> List[Dict]:
         try:
             if self.index is None:
                 return []
+            return self.search_embedding(self.encode_query(query), k, query)
+        except Exception as e:
+            logger.error(f"Error during search: {str(e)}")
+            return []
 
-            # Set number of probes for better recall
-            if isinstance(self.index, faiss.IndexIVFFlat):
-                self.index.nprobe = min(16, self.index.nlist)
+    def search_embedding(self, query_embedding: np.ndarray, k: int = 3, query: str = None) -> List[Dict]:
+        """Search with an embedding that was already computed by encode_query"""
+        try:
+            if self.index is None:
+                return []
 
-            query_embedding = self.encoder.encode([query], convert_to_numpy=True, normalize_embeddings=True)
-            scores, indices = self.index.search(query_embedding.astype('float32'), k)
+            query_embedding = query_embedding.astype('float32')
+            hybrid = query is not None and self.lexical is not None
+            chunked = chunker.CHUNK_MAX_TOKENS > 0
+            candidates = k * CHUNK_SEARCH_FACTOR if chunked else k
+            with span("vector_search"):
+                scores, indices = self._search_batcher.submit((query_embedding, max(candidates, HYBRID_CANDIDATES) if hybrid else candidates))
+            hits = [(int(idx), float(score)) for idx, score in zip(indices[0], scores[0])]
+            if hybrid:
+                with span("lexical_search"):
+                    hits = self._fuse(query, query_embedding, hits, candidates)
 
             results = []
-            for idx, score in zip(indices[0], scores[0]):
+            for idx, score in hits:
                 if idx >= 0 and idx < len(self.documents):
-                    doc = self.documents[idx]
-
-                    # รองรับโครงสร้างทั้งสองแบบ
-                    result = {
-                        'score': float(score),
-                        'text': doc.get('text', '')
-                    }
+                    # สร้าง dict เฉพาะเอกสารที่อยู่ใน top-k
+                    result = self.documents.search_result(idx, score)
 
                     # ถ้าเป็นแบบ question-answer
-                    if 'question' in doc and 'answer' in doc:
-                        
-                        logger.info(f"Found question-answer in document: {doc['question']}")
-                        
-                        result['question'] = doc['question']
-                        result['answer'] = doc['answer']
+                    if 'question' in result:
+                        logger.info(f"Found question-answer in document: {result['question']}")
 
                     # ถ้าเป็นแบบ topic-content-page
-                    if 'metadata' in doc:
-                        
-                        logger.info(f"Found metadata in document: {doc['metadata']}")
-                        
-                        meta = doc['metadata']
-                        result.update({
-                            'topic': meta.get('topic'),
-                            'content': meta.get('content'),
-                            'page': meta.get('page'),
-                            'title': meta.get('title')
-                        })
+                    if 'topic' in result:
+                        logger.info(f"Found section in document: {result['topic']} (page: {result['page']})")
 
                     results.append(result)
 
-            # Sort by score
-            results.sort(key=lambda x: x['score'], reverse=True)
+            # Sort by score (ผลแบบ hybrid เรียงตามอันดับที่รวมแล้ว)
+            if not hybrid:
+                results.sort(key=lambda x: x['score'], reverse=True)
+            if chunked:
+                results = _merge_chunks(results)
+            results = results[:k]
+            if not results:
+                return []
 
             # Logging แสดงคำถาม/หัวข้อที่เจออันดับแรก
             top = results[0]
@@ -261,3 +701,71 @@ class RAGSystem:
             logger.error(f"Error during search: {str(e)}")
             return []
 
+    def _fuse(self, query: str, query_embedding: np.ndarray, vector_hits, k: int):
+        """
+        รวมอันดับจาก vector และ BM25 ด้วย RRF แล้วคืน k อันดับแรก
+        score ที่คืนยังเป็น cosine similarity เพื่อให้ threshold เดิมใช้ได้
+        """
+        lexical_hits = self.lexical.search(query, HYBRID_CANDIDATES)
+        if not lexical_hits:
+            return vector_hits[:k]
+        cosine = {idx: score for idx, score in vector_hits if idx >= 0}
+        fused = reciprocal_rank_fusion([
+            [idx for idx, _ in vector_hits if idx >= 0],
+            [idx for idx, _ in lexical_hits]
+        ], RRF_K)[:k]
+        hits = []
+        for idx, _ in fused:
+            if idx not in cosine:
+                if self.embeddings is None:
+                    continue
+                cosine[idx] = float(np.dot(self.embeddings[idx], query_embedding[0]))
+            hits.append((idx, cosine[idx]))
+        return hits
+
+    def lexical_match(self, query: str):
+        """ผลค้นหาแบบตรงตัวจาก index คำ (ไม่ต้อง encode) หรือ None"""
+        if self.lexical is None:
+            return None
+        idx = self.lexical.exact_match(query)
+        if idx is None:
+            return None
+        logger.info(f"Exact lexical match for query: {query}")
+        return self.documents.search_result(idx, 1.0)
+
+    def best_question(self, scores: np.ndarray, threshold: float = None, margin: float = None):
+        """
+        ตำแหน่งใน index คำถามที่ score >= threshold และนำคำถามที่คำตอบต่างกันอย่างน้อย margin
+        หรือ None ถ้าไม่ถึงเกณฑ์หรือก้ำกึ่ง (ให้ค้นตามปกติแทน)
+        """
+        threshold = QA_DIRECT_THRESHOLD if threshold is None else threshold
+        margin = QA_DIRECT_MARGIN if margin is None else margin
+        order = np.argsort(-scores)
+        best = int(order[0])
+        if float(scores[best]) < threshold:
+            return None
+        answer = self.documents.get_field(int(self.question_ids[best]), 'answer')
+        for other in order[1:]:
+            if float(scores[best]) - float(scores[other]) >= margin:
+                break
+            if self.documents.get_field(int(self.question_ids[other]), 'answer') != answer:
+                return None
+        return best
+
+    def match_question(self, query: str, query_embedding: np.ndarray = None):
+        """
+        ค้นหาใน index คำถามของ Q&A: ตรงตัวหลัง normalize (ไม่ต้อง encode) หรือ
+        ใกล้เคียงตาม best_question คืน (ผลค้นหา, 'exact'|'vector') หรือ None
+        """
+        if self.question_ids is None:
+            return None
+        idx = self._question_map.get(normalize_text(normalize_query(query)))
+        if idx is not None:
+            return self.documents.search_result(idx, 1.0), 'exact'
+        if query_embedding is None or self.question_embeddings is None:
+            return None
+        scores = self.question_embeddings @ query_embedding[0]
+        best = self.best_question(scores)
+        if best is None:
+            return None
+        return self.documents.search_result(int(self.question_ids[best]), float(scores[best])), 'vector'
@@ -1,18 +1,84 @@
+import atexit
 import os
 import json
 import logging
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+import metrics
 from rag import RAGSystem
-from ollama_client import generate_response
+from ollama_client import generate_response, generate_response_stream, join_chunks, llm_available
+from semantic_cache import SemanticCache
+from tracing import span
+
+try:
+    import fcntl
+except ImportError:  # Windows: ไม่มี flock ข้ามโปรเซส
+    fcntl = None
 
 logger = logging.getLogger(__name__)
 rag_system = None
+_init_lock = threading.Lock()
+_reload_lock = threading.Lock()
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+DATA_DIR = os.path.join(BASE_DIR, 'data', 'json')
+# ตรวจ data/json ทุกกี่วินาทีแล้ว reload index เมื่อไฟล์เปลี่ยน (0 = ปิด ใช้ /admin/reload แทน)
+INDEX_WATCH_INTERVAL = float(os.getenv("INDEX_WATCH_INTERVAL", "0"))
+
+# cache คำตอบตามความหมายของคำถาม (ใช้ embedding เดียวกับที่ใช้ค้นหา)
+# ปิดไว้เป็นค่าเริ่มต้น: คำถามที่ต่างกันเพียงคำเดียว (ย้ายเข้า/ย้ายออก) ได้ score เกิน 0.95 ได้
+# ก่อนเปิดให้ตั้ง THRESHOLD จาก held_out_false_positive_rate ในตาราง qa_direct ของ benchmark_retrieval.py
+SEMANTIC_CACHE_ENABLED = os.getenv("SEMANTIC_CACHE_ENABLED", "false").lower() == "true"
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.95"))
+SEMANTIC_CACHE_TTL = float(os.getenv("SEMANTIC_CACHE_TTL", "86400"))
+SEMANTIC_CACHE_SIZE = int(os.getenv("SEMANTIC_CACHE_SIZE", "1000"))
+SEMANTIC_CACHE_PERSIST = os.getenv("SEMANTIC_CACHE_PERSIST", "false").lower() == "true"
+
+semantic_cache = SemanticCache(
+    threshold=SEMANTIC_CACHE_THRESHOLD,
+    ttl=SEMANTIC_CACHE_TTL,
+    max_size=SEMANTIC_CACHE_SIZE,
+    persist_path=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cache', 'semantic_cache') if SEMANTIC_CACHE_PERSIST else None
+) if SEMANTIC_CACHE_ENABLED and SEMANTIC_CACHE_SIZE > 0 else None
+if semantic_cache is not None and SEMANTIC_CACHE_PERSIST:
+    atexit.register(semantic_cache.save)
+
+# ตอบจากคำถาม/หัวข้อที่ตรงตัวโดยไม่ต้อง encode
+LEXICAL_PREFILTER = os.getenv("LEXICAL_PREFILTER", "true").lower() == "true"
+# เติม query embedding cache ตอน preload ด้วยคำถาม Q&A และข้อความ quick reply (ไฟล์ละหนึ่งบรรทัด)
+QUERY_CACHE_PREWARM = os.getenv("QUERY_CACHE_PREWARM", "false").lower() == "true"
+QUERY_CACHE_PREWARM_FILE = os.getenv("QUERY_CACHE_PREWARM_FILE", "")
+
+qa_direct_total = metrics.counter("qa_direct_total", "Questions answered from the Q&A question index without content search or LLM")
+llm_fallback_total = metrics.counter("llm_fallback_total", "Answers served from the best retrieved passage because the LLM circuit breaker was open")
+lexical_prefilter_total = metrics.counter("lexical_prefilter_total", "Queries answered by an exact lexical match without encoding")
+# แหล่งของคำตอบ (dialogflow นับใน app.py) ใช้ดูสัดส่วนที่ต้องค้นเอกสารหรือเรียก LLM
+answers_total = metrics.counter("answers_total", "Replies by source")
+SCORE_BUCKETS = (0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.85, 0.9, 0.95, 1.0)
+top_score_histogram = metrics.histogram("rag_top_score", "Score of the best retrieved result by document type", buckets=SCORE_BUCKETS)
+index_build_seconds = metrics.gauge("rag_index_build_seconds", "Time to build or load the active RAG index")
+index_documents = metrics.gauge("rag_index_documents", "Documents in the active RAG index")
+index_reloads_total = metrics.counter("rag_index_reloads_total", "Background index reloads by outcome")
+
+# สถานะของ index ที่ใช้งานอยู่ (แสดงใน /health และ /admin/reload)
+_index_status = {
+    "version": None,
+    "loaded_at": None,
+    "build_seconds": None,
+    "documents": 0,
+    "index_type": None,
+    "reloading": False,
+    "last_reload": None,
+}
+_watch_pid = None
 
 def initialize_rag():
-    global rag_system
     try:
-        rag_system = RAGSystem()
-        success = rag_system.load_documents(None)  # No need to pass json_dir anymore
-        if success:
+        system, seconds = _load_system()
+        if system is not None:
+            _activate(system, seconds)
             logger.info("RAG system initialized successfully")
             return True
         logger.error("Failed to initialize RAG system")
@@ -21,48 +87,359 @@ def initialize_rag():
         logger.error(f"Error initializing RAG system: {str(e)}")
         return False
 
-def search_from_documents(question):
+def _ensure_rag():
+    _ensure_watch()
+    # ป้องกันการโหลดซ้ำเมื่อมีหลาย worker เรียกพร้อมกัน
+    if rag_system is not None:
+        return True
+    with _init_lock:
+        if rag_system is not None:
+            return True
+        return initialize_rag()
+
+@contextmanager
+def _build_lock():
+    """
+    ให้ worker ของ gunicorn สร้าง index ทีละโปรเซส: ตัวแรก encode และเขียน cache
+    ตัวถัดไปจะพบว่าไฟล์ไม่เปลี่ยนและโหลดจาก cache แทน
+    """
+    if fcntl is None:
+        yield
+        return
+    cache_dir = os.path.join(BASE_DIR, 'cache')
+    os.makedirs(cache_dir, exist_ok=True)
+    with open(os.path.join(cache_dir, 'index.lock'), 'w') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+def _load_system(encoder=None):
+    """สร้าง RAGSystem และโหลด index (สร้างใหม่เฉพาะไฟล์ที่เปลี่ยน) คืน (system หรือ None, วินาที)"""
+    start = time.perf_counter()
+    system = RAGSystem(encoder=encoder)
+    with _build_lock():
+        success = system.load_documents(None)
+    return (system if success else None), time.perf_counter() - start
+
+def _activate(system, seconds):
+    """สลับ rag_system เป็นระบบใหม่ในครั้งเดียว คำขอที่ถือระบบเดิมอยู่จะทำงานต่อจนจบ"""
+    global rag_system
+    previous = rag_system
+    if previous is not None and previous.encoder is system.encoder and previous.query_cache is not None:
+        # encoder เดียวกัน: embedding ของคำถามที่ cache ไว้ยังใช้ได้
+        system.query_cache = previous.query_cache
+    if system.query_cache is not None:
+        # ระบบที่สร้างใน background แล้วไม่ถูกใช้ต้องไม่เป็นเจ้าของ gauge จึงผูกตอนสลับเท่านั้น
+        system.query_cache.track_metrics()
+    rag_system = system
+    _index_status.update(
+        version=(system.corpus_version or "")[:12],
+        loaded_at=datetime.now().isoformat(timespec='seconds'),
+        build_seconds=round(seconds, 3),
+        documents=len(system.documents),
+        index_type=system.index_config.get('type'),
+    )
+    index_build_seconds.set(seconds)
+    index_documents.set(len(system.documents))
+
+def index_status():
+    return dict(_index_status)
+
+def reload_index(reason="manual", wait=False):
+    """
+    สร้าง index และเอกสารชุดใหม่จาก data/json ใน background thread แล้วสลับเข้า rag_system
+    คืน False หากมีการ reload ทำงานอยู่แล้ว
+    """
+    if not _reload_lock.acquire(blocking=False):
+        return False
+    _index_status["reloading"] = True
+    thread = threading.Thread(target=_reload, args=(reason,), name="index-reload", daemon=True)
+    thread.start()
+    if wait:
+        thread.join()
+    return True
+
+def _reload(reason):
+    start = time.perf_counter()
+    outcome, error = "failed", None
+    try:
+        current = rag_system
+        system, seconds = _load_system(current.encoder if current is not None else None)
+        if system is None:
+            error = "could not load documents"
+        elif (
+            current is not None and system.corpus_version == current.corpus_version and
+            system.index_config == current.index_config
+        ):
+            # ไม่มีอะไรเปลี่ยน: ใช้ระบบเดิมต่อ (mmap และ cache อุ่นอยู่แล้ว)
+            outcome = "unchanged"
+        else:
+            _activate(system, seconds)
+            outcome = "swapped"
+    except Exception as e:
+        error = str(e)
+    finally:
+        elapsed = time.perf_counter() - start
+        index_reloads_total.inc(outcome=outcome)
+        _index_status["last_reload"] = {
+            "reason": reason,
+            "outcome": outcome,
+            "seconds": round(elapsed, 3),
+            "finished_at": datetime.now().isoformat(timespec='seconds'),
+            "error": error,
+        }
+        _index_status["reloading"] = False
+        _reload_lock.release()
+    if outcome == "failed":
+        logger.error(f"Index reload ({reason}) failed after {elapsed:.2f}s: {error}")
+    else:
+        logger.info(f"Index reload ({reason}) {outcome} in {elapsed:.2f}s, active version {_index_status['version']}")
+
+def _data_signature():
     try:
-        global rag_system
-        if rag_system is None:
-            if not initialize_rag():
-                return "ขออภัย ระบบยังไม่พร้อมใช้งาน", False, None
+        return tuple(sorted(
+            (entry.name, entry.stat().st_mtime_ns, entry.stat().st_size)
+            for entry in os.scandir(DATA_DIR) if entry.name.endswith('.json')
+        ))
+    except OSError:
+        return None
 
+def _ensure_watch():
+    """เริ่มเฝ้า data/json หนึ่ง thread ต่อโปรเซส (thread ไม่ข้ามการ fork ของ gunicorn --preload)"""
+    global _watch_pid
+    if INDEX_WATCH_INTERVAL <= 0 or _watch_pid == os.getpid():
+        return
+    _watch_pid = os.getpid()
+    threading.Thread(target=_watch, name="index-watch", daemon=True).start()
+
+def _watch():
+    seen = _data_signature()
+    pending = None
+    while True:
+        time.sleep(INDEX_WATCH_INTERVAL)
+        current = _data_signature()
+        if current == seen or current is None:
+            pending = None
+            continue
+        # รอให้ไฟล์นิ่งหนึ่งรอบก่อน (ผู้แก้ไขอาจยังเขียนไม่เสร็จ)
+        if current != pending:
+            pending = current
+            continue
+        if rag_system is None or reload_index("watch"):
+            seen, pending = current, None
+
+def preload():
+    """
+    โหลด RAG และอุ่นเครื่อง encoder ตั้งแต่เริ่มระบบ แทนที่จะรอข้อความแรก
+    เมื่อใช้กับ gunicorn --preload ทุก worker จะใช้ index และเอกสารที่ mmap ร่วมกัน
+    """
+    start = time.perf_counter()
+    if not _ensure_rag():
+        return False
+    rag_system.encode_query("warmup")
+    if QUERY_CACHE_PREWARM:
+        _prewarm_query_cache()
+    elapsed = time.perf_counter() - start
+    metrics.gauge("rag_startup_seconds", "Time to load the RAG index and warm the encoder").set(elapsed)
+    memory = metrics.process_memory()
+    logger.info(
+        f"โหลด RAG ล่วงหน้าเสร็จใน {elapsed:.2f} วินาที "
+        f"(RSS {memory.get('rss', 0) / 1e6:.1f} MB, PSS {memory.get('pss', 0) / 1e6:.1f} MB)"
+    )
+    return True
+
+def _prewarm_query_cache():
+    texts = rag_system.cached_questions()
+    if QUERY_CACHE_PREWARM_FILE:
+        try:
+            with open(QUERY_CACHE_PREWARM_FILE, 'r', encoding='utf-8') as f:
+                texts.extend(line.strip() for line in f if line.strip())
+        except OSError as e:
+            logger.warning(f"Could not read {QUERY_CACHE_PREWARM_FILE}: {e}")
+    try:
+        rag_system.prewarm_query_cache(texts)
+    except Exception as e:
+        logger.warning(f"Could not pre-populate query cache: {e}")
+
+def _direct_answer(system, question, query_embedding=None):
+    """คำตอบสำเร็จรูปจาก Q&A เมื่อคำถามตรงหรือใกล้เคียงมาก ไม่ค้น content และไม่เรียก LLM"""
+    matched = system.match_question(question, query_embedding)
+    if matched is None:
+        return None
+    result, match = matched
+    qa_direct_total.inc(match=match)
+    answers_total.inc(source="qa_direct")
+    logger.info(f"Direct Q&A match ({match}, score {result['score']:.4f}): {result['question']}")
+    return result['answer'], True, {
+        'question': question,
+        'contexts': [result['answer']],
+        'score': result['score']
+    }
+
+def retrieve_documents(question):
+    """
+    ค้นหาเอกสารที่เกี่ยวข้องเท่านั้น (ยังไม่สร้างคำตอบ)
+    คืน (query_embedding, results) หรือ None หากระบบยังไม่พร้อม
+    """
+    if not _ensure_rag():
+        return None
+    # ใช้ระบบเดียวกันตลอดคำขอ แม้ index จะถูกสลับระหว่างทาง
+    system = rag_system
+    exact = _lexical_match(system, question)
+    if exact is not None:
+        return None, [exact]
+    query_embedding = system.encode_query(question)
+    return query_embedding, system.search_embedding(query_embedding, k=5, query=question)
+
+def _lexical_match(system, question):
+    if not LEXICAL_PREFILTER:
+        return None
+    exact = system.lexical_match(question)
+    if exact is not None:
+        lexical_prefilter_total.inc()
+    return exact
+
+def _is_cacheable(answer):
+    # ไม่เก็บข้อความแจ้งข้อผิดพลาดจาก LLM
+    return bool(answer) and not answer.startswith("ขออภัย")
+
+def _cache_answer(question, query_embedding, corpus_version, reply, rag_context):
+    """เก็บคำตอบลง semantic cache (รองรับคำตอบแบบ stream โดยเก็บเมื่อส่งครบ)"""
+    if isinstance(reply, str):
+        # breaker เปิดอยู่: คำตอบอาจเป็นข้อความอ้างอิงสำรอง ไม่ควรค้างใน cache หลัง LLM กลับมา
+        if _is_cacheable(reply) and llm_available():
+            semantic_cache.store(question, query_embedding, reply, rag_context, corpus_version)
+        return reply
+
+    def collect():
+        parts = []
+        for chunk in reply:
+            parts.append(chunk)
+            yield chunk
+        answer = join_chunks(parts)
+        if _is_cacheable(answer) and llm_available():
+            semantic_cache.store(question, query_embedding, answer, rag_context, corpus_version)
+    return collect()
+
+def speculative_answer(question, cancel_event):
+    """
+    สร้างคำตอบจากเอกสารล่วงหน้าระหว่างรอ Dialogflow
+    ใช้ generation แบบ stream เพื่อหยุดได้ทันทีเมื่อ cancel_event ถูกตั้ง คืน None เมื่อถูกยกเลิก
+    """
+    reply, found_in_docs, rag_context = search_from_documents(question, stream=True)
+    if isinstance(reply, str):
+        return reply, found_in_docs, rag_context
+    parts = []
+    for chunk in reply:
+        if cancel_event.is_set():
+            # ปิด generator เพื่อปิด connection และหยุด generation ที่ Ollama
+            reply.close()
+            return None
+        parts.append(chunk)
+    return join_chunks(parts), found_in_docs, rag_context
+
+def search_from_documents(question, stream=False, retrieved=None):
+    """
+    ค้นหาคำตอบจากเอกสาร หาก stream=True และต้องใช้ LLM
+    คำตอบที่คืนจะเป็น generator ที่ให้ข้อความทีละช่วง
+    retrieved คือผลจาก retrieve_documents ที่ค้นหาไว้ล่วงหน้า (ถ้ามี)
+    query_embedding เป็น None เมื่อพบคำถามที่ตรงตัวจาก index คำ (ไม่ได้ encode)
+    """
+    try:
+        if not _ensure_rag():
+            return "ขออภัย ระบบยังไม่พร้อมใช้งาน", False, None
+        # ใช้ระบบเดียวกันตลอดคำขอ แม้ index จะถูกสลับระหว่างทาง
+        system = rag_system
+        if retrieved is None:
+            direct = _direct_answer(system, question)
+            if direct is not None:
+                return direct
+            exact = _lexical_match(system, question)
+            if exact is not None:
+                query_embedding, base_results = None, [exact]
+            else:
+                query_embedding = system.encode_query(question)
+                base_results = None
+        else:
+            query_embedding, base_results = retrieved
+        corpus_version = system.corpus_version
+
+        # คำถามใกล้เคียงกับคำถามใน Q&A มาก: ตอบทันที
+        if query_embedding is not None:
+            direct = _direct_answer(system, question, query_embedding)
+            if direct is not None:
+                return direct
+
+        # ตรวจสอบคำถามที่ความหมายใกล้เคียงกับที่เคยตอบแล้ว
+        if semantic_cache is not None and query_embedding is not None:
+            with span("semantic_cache"):
+                cached = semantic_cache.lookup(query_embedding, corpus_version)
+            if cached:
+                answers_total.inc(source="semantic_cache")
+                return cached['answer'], True, cached['context']
+
+        if base_results is None:
+            # ค้นหาข้อมูลจากเอกสาร
+            base_results = system.search_embedding(query_embedding, k=5, query=question)
+
+        reply, found_in_docs, rag_context = _answer_from_results(question, base_results, stream)
+        if found_in_docs and semantic_cache is not None and query_embedding is not None:
+            reply = _cache_answer(question, query_embedding, corpus_version, reply, rag_context)
+        return reply, found_in_docs, rag_context
+
+    except Exception as e:
+        logger.error(f"เกิดข้อผิดพลาดในการค้นหา: {str(e)}")
+        return "เกิดข้อผิดพลาดในการค้นหา", False, None
+
+def _answer_from_results(question, base_results, stream=False):
+    """
+    เลือกคำตอบจากผลค้นหา: ใช้คำตอบ Q&A โดยตรง หรือให้ LLM สรุปจากเนื้อหา
+    """
+    try:
         qa_candidates = []
         content_candidates = []
 
-        # ค้นหาข้อมูลจากเอกสาร
-        base_results = rag_system.search(question, k=5)
-
         # แยก Q&A และ content พร้อมเก็บ score
         if base_results:
-            for r in base_results:
+            for rank, r in enumerate(base_results):
                 if isinstance(r, dict):
                     if 'question' in r and 'answer' in r:
                         qa_candidates.append({
                             'type': 'qa',
                             'question': r['question'],
                             'answer': r['answer'],
-                            'score': r['score']
+                            'score': r['score'],
+                            'rank': rank
                         })
                     elif 'content' in r:
                         content_candidates.append({
                             'type': 'content',
                             'text': r.get('content', ''),
-                            'score': r['score']
+                            'score': r['score'],
+                            'rank': rank
                         })
 
         # ถ้าไม่มีอะไรเลย
         if not qa_candidates and not content_candidates:
+            answers_total.inc(source="not_found")
             return "ขออภัย ไม่พบข้อมูลที่เกี่ยวข้อง", False, None
 
-        # หา Q&A และ content ที่ score สูงสุด
-        best_qa = max(qa_candidates, key=lambda x: x['score']) if qa_candidates else None
-        best_content = max(content_candidates, key=lambda x: x['score']) if content_candidates else None
+        generate = generate_response_stream if stream else generate_response
+
+        # ผลค้นหาเรียงตามอันดับแล้ว (vector หรือ hybrid) ตัวแรกของแต่ละแบบคืออันดับดีที่สุด
+        best_qa = qa_candidates[0] if qa_candidates else None
+        best_content = content_candidates[0] if content_candidates else None
+        if best_qa:
+            top_score_histogram.observe(best_qa['score'], type="qa")
+        if best_content:
+            top_score_histogram.observe(best_content['score'], type="content")
 
-        # เปรียบเทียบ score และเลือกแบบที่สูงสุด
-        if best_qa and (not best_content or best_qa['score'] >= best_content['score']):
+        # เลือกแบบที่อยู่อันดับสูงกว่า
+        if best_qa and (not best_content or best_qa['rank'] <= best_content['rank']):
             logger.info(f"Found question-answer in document: {best_qa['question']}")
+            answers_total.inc(source="qa")
             return best_qa['answer'], True, {
                 'question': question,
                 'contexts': [best_qa['answer']],
@@ -71,20 +448,32 @@ def search_from_documents(question):
         elif best_content:
             logger.info(f"Query: {question}")
             logger.info(f"Top content result: {best_content['text'][:30]} (score: {best_content['score']:.4f})")
+            if best_content['score'] >= 0.3 and not llm_available():
+                # LLM ล่ม: ตอบด้วยเนื้อหาที่ตรงที่สุดทันทีแทนการรอ timeout และ retry
+                llm_fallback_total.inc()
+                answers_total.inc(source="passage_fallback")
+                logger.warning("LLM circuit breaker is open, answering with the best retrieved passage")
+                return best_content['text'], True, {
+                    'question': question,
+                    'contexts': [best_content['text']],
+                    'score': best_content['score']
+                }
             # ถ้า match ดี (score >= 0.8)
             if best_content['score'] >= 0.8:
-                return generate_response(question, best_content['text']), True, {
+                answers_total.inc(source="llm")
+                return generate(question, best_content['text']), True, {
                     'question': question,
                     'contexts': [best_content['text']],
                     'score': best_content['score']
                 }
             if best_content['score'] >= 0.3:
                 # รวม context ที่ score >= 0.2
-                sorted_contents = sorted(content_candidates, key=lambda x: x['score'], reverse=True)
-                contexts = [r['text'] for r in sorted_contents[:3] if r['score'] >= 0.2]
-                combined_context = "\n\n".join(contexts)
+                passages = [(r['text'], r['score']) for r in content_candidates[:3] if r['score'] >= 0.2]
+                contexts = [text for text, _ in passages]
+                answers_total.inc(source="llm")
                 try:
-                    return generate_response(question, combined_context), True, {
+                    # ollama_client จัดลำดับตาม score และตัดให้พอดีกับงบ token ของ prompt
+                    return generate(question, passages), True, {
                         'question': question,
                         'contexts': contexts,
                         'score': best_content['score']
@@ -96,8 +485,10 @@ def search_from_documents(question):
                         'contexts': contexts,
                         'score': best_content['score']
                     }
+            answers_total.inc(source="not_found")
             return "ขออภัย ไม่พบข้อมูลที่ตรงกับคำถามของคุณ", False, None
 
+        answers_total.inc(source="not_found")
         return "ขออภัย ไม่พบข้อมูลที่ตรงกับคำถามของคุณ", False, None
 
     except Exception as e:
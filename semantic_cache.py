@@ -0,0 +1,180 @@
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+cache_lookups = metrics.counter("semantic_cache_lookups_total", "Semantic cache lookups by result (hit, miss, expired)")
+cache_evictions = metrics.counter("semantic_cache_evictions_total", "Entries evicted because the cache was full")
+cache_entries = metrics.gauge("semantic_cache_entries", "Entries currently held in the semantic cache")
+
+
+class SemanticCache:
+    """
+    Answer cache keyed by query embedding.
+    A lookup hits when a stored question has cosine similarity >= threshold.
+    max_size <= 0 disables the cache.
+    """
+
+    def __init__(self, threshold: float = 0.95, ttl: float = 86400, max_size: int = 1000,
+                 persist_path: str = None, save_interval: float = 60):
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_size = max_size
+        self.persist_path = persist_path
+        self.save_interval = save_interval
+        self.corpus_version = None
+        self._vectors = None
+        self._entries = OrderedDict()  # slot -> entry (เรียงตามการใช้งานล่าสุด)
+        self._free_slots = list(range(max(max_size, 0) - 1, -1, -1))
+        self._last_saved = time.monotonic()
+        self._dirty = False
+        self._lock = threading.Lock()
+        cache_entries.set_function(lambda: len(self._entries))
+        if persist_path:
+            self._load()
+
+    def lookup(self, embedding, corpus_version):
+        """คืน entry ที่ใกล้เคียงที่สุด หรือ None"""
+        vector = np.asarray(embedding, dtype='float32').reshape(-1)
+        with self._lock:
+            self._check_version(corpus_version)
+            if not self._entries:
+                cache_lookups.inc(result="miss")
+                return None
+            slots = np.fromiter(self._entries.keys(), dtype=np.int64)
+            scores = self._vectors[slots] @ vector
+            best = int(np.argmax(scores))
+            if scores[best] < self.threshold:
+                cache_lookups.inc(result="miss")
+                return None
+            slot = int(slots[best])
+            entry = self._entries[slot]
+            if time.time() - entry['created'] > self.ttl:
+                self._remove(slot)
+                cache_lookups.inc(result="expired")
+                return None
+            self._entries.move_to_end(slot)
+            cache_lookups.inc(result="hit")
+            logger.info(f"Semantic cache hit: {entry['question']} (score: {scores[best]:.4f})")
+            return dict(entry, score=float(scores[best]))
+
+    def store(self, question, embedding, answer, context, corpus_version):
+        if self.max_size <= 0:
+            return
+        vector = np.asarray(embedding, dtype='float32').reshape(-1)
+        with self._lock:
+            self._check_version(corpus_version)
+            if self._vectors is None:
+                self._vectors = np.zeros((self.max_size, vector.shape[0]), dtype='float32')
+            if not self._free_slots:
+                self._purge_expired()
+            if not self._free_slots:
+                # เต็มแล้ว ลบรายการที่ไม่ได้ใช้นานที่สุด
+                oldest = next(iter(self._entries))
+                self._remove(oldest)
+                cache_evictions.inc()
+            slot = self._free_slots.pop()
+            self._vectors[slot] = vector
+            self._entries[slot] = {
+                'question': question,
+                'answer': answer,
+                'context': context,
+                'created': time.time(),
+            }
+            self._dirty = True
+            should_save = self.persist_path and time.monotonic() - self._last_saved > self.save_interval
+        if should_save:
+            self.save()
+
+    def clear(self):
+        with self._lock:
+            self._clear()
+
+    def _clear(self):
+        self._entries.clear()
+        self._free_slots = list(range(max(self.max_size, 0) - 1, -1, -1))
+        self._dirty = True
+
+    def _check_version(self, corpus_version):
+        # เอกสารเปลี่ยน คำตอบเดิมอาจไม่ถูกต้องแล้ว
+        if corpus_version != self.corpus_version:
+            if self._entries:
+                logger.info("Corpus changed, clearing semantic cache")
+            self._clear()
+            self.corpus_version = corpus_version
+
+    def _remove(self, slot):
+        del self._entries[slot]
+        self._free_slots.append(slot)
+        self._dirty = True
+
+    def _purge_expired(self):
+        now = time.time()
+        for slot in [s for s, e in self._entries.items() if now - e['created'] > self.ttl]:
+            self._remove(slot)
+
+    def save(self):
+        """บันทึก cache ลงดิสก์ (vectors เป็น .npy, ข้อมูลอื่นเป็น .json)"""
+        if not self.persist_path:
+            return
+        with self._lock:
+            if not self._dirty:
+                return
+            slots = list(self._entries.keys())
+            vectors = self._vectors[slots] if slots else np.zeros((0, 0), dtype='float32')
+            data = {
+                'corpus_version': self.corpus_version,
+                'entries': [self._entries[slot] for slot in slots],
+            }
+            self._dirty = False
+            self._last_saved = time.monotonic()
+        try:
+            os.makedirs(os.path.dirname(self.persist_path), exist_ok=True)
+            # เขียนไฟล์ชั่วคราวแล้วค่อยแทนที่ ไฟล์ที่เขียนไม่จบจะไม่ถูกโหลดตอนเริ่มครั้งถัดไป
+            with open(self.persist_path + '.npy.tmp', 'wb') as f:
+                np.save(f, vectors)
+            os.replace(self.persist_path + '.npy.tmp', self.persist_path + '.npy')
+            tmp_path = self.persist_path + '.json.tmp'
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(data, f, ensure_ascii=False)
+            os.replace(tmp_path, self.persist_path + '.json')
+            logger.info(f"Saved semantic cache ({len(slots)} entries)")
+        except Exception as e:
+            logger.warning(f"Could not save semantic cache: {e}")
+
+    def _load(self):
+        try:
+            json_path = self.persist_path + '.json'
+            if self.max_size <= 0 or not os.path.exists(json_path):
+                return
+            with open(json_path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            vectors = np.load(self.persist_path + '.npy')
+            entries = data.get('entries', [])
+            if len(vectors) != len(entries):
+                # หยุดระหว่างแทนที่ไฟล์ทั้งสอง: ข้อมูลไม่ตรงกัน เริ่มใหม่แทนการจับคู่ผิด
+                logger.warning("Semantic cache files do not match, starting empty")
+                return
+            entries = entries[-self.max_size:]
+            vectors = vectors[-len(entries):] if entries else vectors[:0]
+            self.corpus_version = data.get('corpus_version')
+            if entries:
+                self._vectors = np.zeros((self.max_size, vectors.shape[1]), dtype='float32')
+            now = time.time()
+            for entry, vector in zip(entries, vectors):
+                if now - entry['created'] > self.ttl:
+                    continue
+                slot = self._free_slots.pop()
+                self._vectors[slot] = vector
+                self._entries[slot] = entry
+            logger.info(f"Loaded semantic cache ({len(self._entries)} entries)")
+        except Exception as e:
+            logger.warning(f"Could not load semantic cache: {e}")
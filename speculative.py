@@ -0,0 +1,65 @@
+import logging
+import threading
+import time
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+speculative_started = metrics.counter("speculative_started_total", "Speculative tasks started, by stage")
+speculative_used = metrics.counter("speculative_used_total", "Speculative results that were used, by stage")
+speculative_cancelled = metrics.counter("speculative_cancelled_total", "Speculative tasks cancelled before they started, by stage")
+speculative_wasted = metrics.counter("speculative_wasted_total", "Speculative tasks that ran but were discarded, by stage")
+speculative_saved_seconds = metrics.histogram("speculative_saved_seconds", "Work already done by a speculative task when its result was needed")
+speculative_wasted_seconds = metrics.histogram("speculative_wasted_seconds", "Work done by a speculative task whose result was discarded")
+
+
+class SpeculativeTask:
+    """
+    งานที่เริ่มทำล่วงหน้าขณะรอผลอย่างอื่น (เช่น Dialogflow)
+    ผู้เรียกต้องเรียก result() หรือ discard() อย่างใดอย่างหนึ่ง
+    """
+
+    def __init__(self, executor, stage, func, *args, cancellable=False):
+        self.stage = stage
+        # งานที่รองรับการยกเลิกกลางทางจะได้ cancel_event เป็น argument สุดท้าย
+        self.cancel_event = threading.Event()
+        if cancellable:
+            args = args + (self.cancel_event,)
+        self._run_started = None
+        self._run_finished = None
+        self._settled = False
+        self.future = executor.submit(self._run, func, *args)
+        speculative_started.inc(stage=stage)
+
+    def _run(self, func, *args):
+        self._run_started = time.monotonic()
+        try:
+            return func(*args)
+        finally:
+            self._run_finished = time.monotonic()
+
+    def _elapsed(self):
+        if self._run_started is None:
+            return 0.0
+        return (self._run_finished or time.monotonic()) - self._run_started
+
+    def result(self, timeout=None):
+        """รอและคืนผลของงาน พร้อมบันทึกเวลาที่ประหยัดได้"""
+        self._settled = True
+        speculative_used.inc(stage=self.stage)
+        speculative_saved_seconds.observe(self._elapsed(), stage=self.stage)
+        return self.future.result(timeout)
+
+    def discard(self):
+        """ทิ้งผลของงาน ยกเลิกถ้ายังไม่เริ่ม หรือส่งสัญญาณให้หยุดถ้ากำลังทำอยู่"""
+        if self._settled:
+            return
+        self._settled = True
+        self.cancel_event.set()
+        if self.future.cancel():
+            speculative_cancelled.inc(stage=self.stage)
+            return
+        speculative_wasted.inc(stage=self.stage)
+        speculative_wasted_seconds.observe(self._elapsed(), stage=self.stage)
+        logger.info(f"Discarded speculative {self.stage} task after {self._elapsed():.3f}s")
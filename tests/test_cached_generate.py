@@ -0,0 +1,21 @@
+import ollama_client
+
+
+def test_failed_generation_is_not_cached(monkeypatch):
+    answers = iter([ollama_client.LLMGenerationError("ขออภัยค่ะ ระบบ AI ไม่สามารถตอบคำถามได้ในขณะนี้"), "ย้ายเข้าได้ที่สำนักงานค่ะ"])
+
+    def generate(prompt, max_tokens=None):
+        answer = next(answers)
+        if isinstance(answer, Exception):
+            raise answer
+        return answer
+
+    monkeypatch.setattr(ollama_client.backend, "generate", generate)
+    ollama_client.cached_generate.cache_clear()
+
+    first = ollama_client.generate_response("ย้ายเข้าทำอย่างไร", "ยื่นคำร้องที่สำนักงาน")
+    second = ollama_client.generate_response("ย้ายเข้าทำอย่างไร", "ยื่นคำร้องที่สำนักงาน")
+
+    assert first.startswith("ขออภัยค่ะ")
+    assert second == "ย้ายเข้าได้ที่สำนักงานค่ะ"
+    ollama_client.cached_generate.cache_clear()
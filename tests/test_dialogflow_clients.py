@@ -0,0 +1,33 @@
+import asyncio
+
+import dialogflow
+
+
+class _Client:
+    def __init__(self):
+        # เหมือน gRPC channel จริงที่อ้างถึง loop ที่สร้างมัน
+        self.loop = asyncio.get_running_loop()
+
+
+async def _get():
+    return dialogflow.get_async_sessions_client()
+
+
+def test_async_client_is_reused_within_a_loop(monkeypatch):
+    monkeypatch.setattr(dialogflow, "SessionsAsyncClient", _Client)
+
+    async def twice():
+        return await _get(), await _get()
+
+    first, second = asyncio.run(twice())
+
+    assert first is second
+
+
+def test_clients_of_closed_loops_are_released(monkeypatch):
+    monkeypatch.setattr(dialogflow, "SessionsAsyncClient", _Client)
+
+    for _ in range(20):
+        asyncio.run(_get())
+
+    assert len(dialogflow._async_clients) <= 1
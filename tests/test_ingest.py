@@ -0,0 +1,30 @@
+import io
+import json
+
+import pytest
+
+from ingest import iter_json_array
+
+
+def _items(text, read_size=4):
+    return list(iter_json_array(io.StringIO(text), read_size=read_size))
+
+
+@pytest.mark.parametrize("text", [
+    '[]',
+    ' [ ] ',
+    '[1]',
+    '[{"question": "ย้ายเข้าทำอย่างไร", "answer": "ยื่นคำร้อง"}, {"part": 1, "data": []}]',
+    '[\n  "a" ,\n  [1, 2],\n  null\n]',
+    '{"part": 1}',
+])
+def test_matches_json_load(text):
+    assert _items(text) == (json.loads(text) if text.strip().startswith('[') else [json.loads(text)])
+
+
+@pytest.mark.parametrize("text", ['[1,]', '[1, ]', '[{"a": 1},\n]', '[,1]', '[1 2]', '[1,'])
+def test_rejects_what_json_load_rejects(text):
+    with pytest.raises(json.JSONDecodeError):
+        json.loads(text)
+    with pytest.raises(ValueError):
+        _items(text)
@@ -0,0 +1,33 @@
+import chunker
+from document_store import DocumentStore
+from lexical_index import LexicalIndex
+
+
+def _section(topic, content, page=1):
+    return {
+        'text': f"ส่วนที่ 1 เรื่อง: คู่มือ หน้า {page} หัวข้อ: {topic} เนื้อหา: {content}",
+        'metadata': {'part': 1, 'title': 'คู่มือ', 'topic': topic, 'content': content, 'page': page, 'source': 'doc.json'}
+    }
+
+
+def _index(documents):
+    return LexicalIndex.from_store(DocumentStore.from_documents(documents))
+
+
+def test_exact_match_on_chunked_section_returns_first_chunk():
+    content = " ".join(f"ขั้นตอนที่ {i} กดปุ่มเข้าสู่ระบบแล้วกรอกรหัสผ่าน." for i in range(40))
+    documents = chunker.chunk_documents([_section("ขั้นตอนการเข้าระบบ", content), _section("การออกจากระบบ", "กดออก", 2)],
+                                        max_tokens=64, overlap_tokens=8)
+    chunks = [i for i, doc in enumerate(documents) if doc['metadata']['topic'] == "ขั้นตอนการเข้าระบบ"]
+    assert len(chunks) > 1
+
+    index = _index(documents)
+
+    assert index.exact_match("ขั้นตอนการเข้าระบบ") == chunks[0]
+    assert index.exact_match("การออกจากระบบ") == len(documents) - 1
+
+
+def test_exact_match_ignores_topic_shared_by_different_sections():
+    index = _index([_section("สิทธิการใช้งาน", "ก", 1), _section("สิทธิการใช้งาน", "ข", 2)])
+
+    assert index.exact_match("สิทธิการใช้งาน") is None
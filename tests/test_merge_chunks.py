@@ -0,0 +1,27 @@
+import chunker
+from rag import _merge_chunks
+
+
+def _results(pieces, chunks):
+    return [{'score': 1.0 - 0.1 * i, 'parent': 'doc.json#1/1/topic', 'chunk': i, 'content': pieces[i]} for i in chunks]
+
+
+def test_adjacent_chunks_are_joined_without_the_overlap():
+    content = " ".join(f"ประโยคที่ {i} อธิบายขั้นตอนการใช้งานระบบ." for i in range(30))
+    pieces = chunker.chunk_text(content, max_tokens=40, overlap_tokens=10)
+    assert len(pieces) > 3
+
+    merged = _merge_chunks(_results(pieces, [1, 0, 2]))
+
+    assert len(merged) == 1
+    assert merged[0]['chunks'] == [0, 1, 2]
+    assert content.startswith(merged[0]['content'])
+    assert merged[0]['content'].count("ประโยคที่ 1 ") == 1
+
+
+def test_non_adjacent_chunks_are_separated():
+    pieces = ["ก ข ค", "ค ง จ", "จ ฉ ช"]
+
+    merged = _merge_chunks(_results(pieces, [0, 2]))
+
+    assert merged[0]['content'] == "ก ข ค\n...\nจ ฉ ช"
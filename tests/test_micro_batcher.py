@@ -0,0 +1,78 @@
+import threading
+import time
+
+import pytest
+
+from rag import MicroBatcher
+
+
+def test_batches_concurrent_calls_and_returns_each_result():
+    batches = []
+
+    def double(items):
+        batches.append(len(items))
+        time.sleep(0.01)
+        return [item * 2 for item in items]
+
+    batcher = MicroBatcher("test", double, max_batch=8, window_ms=20)
+    results = {}
+    threads = [threading.Thread(target=lambda i=i: results.__setitem__(i, batcher.submit(i))) for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert results == {i: i * 2 for i in range(8)}
+    assert max(batches) > 1
+
+
+def test_leader_is_not_starved_under_sustained_load():
+    def slow(items):
+        time.sleep(0.02)
+        return items
+
+    batcher = MicroBatcher("test", slow, max_batch=4, window_ms=5)
+    latencies = []
+    lock = threading.Lock()
+    stop = time.perf_counter() + 1.5
+
+    def worker():
+        while time.perf_counter() < stop:
+            start = time.perf_counter()
+            batcher.submit(1)
+            with lock:
+                latencies.append(time.perf_counter() - start)
+
+    threads = [threading.Thread(target=worker) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    # 8 callers, 4 per batch, 20 ms per batch: nobody should wait more than a few batches
+    assert len(latencies) > 50
+    assert max(latencies) < 0.3
+
+
+def test_error_reaches_every_caller_in_the_batch_and_leadership_moves_on():
+    calls = []
+
+    def flaky(items):
+        calls.append(len(items))
+        if len(calls) == 1:
+            raise RuntimeError("boom")
+        return items
+
+    batcher = MicroBatcher("test", flaky, max_batch=2, window_ms=5)
+    with pytest.raises(RuntimeError):
+        batcher.submit(1)
+    assert batcher.submit(2) == 2
+
+
+def test_lone_caller_does_not_wait_for_the_window():
+    batcher = MicroBatcher("test", lambda items: items, max_batch=8, window_ms=200)
+
+    start = time.perf_counter()
+    assert batcher.submit(1) == 1
+
+    assert time.perf_counter() - start < 0.05
@@ -0,0 +1,37 @@
+import numpy as np
+
+from document_store import DocumentStore
+from rag import RAGSystem
+
+
+def _system(pairs):
+    system = RAGSystem.__new__(RAGSystem)
+    system.documents = DocumentStore.from_documents(
+        [{'text': f"{q} {a}", 'question': q, 'answer': a, 'source': '1.json'} for q, a in pairs]
+    )
+    system.question_ids = np.arange(len(pairs), dtype=np.int32)
+    return system
+
+
+def test_clear_winner_is_answered_directly():
+    system = _system([("ย้ายเข้าต้องทำอย่างไร", "ยื่นคำร้องย้ายเข้า"), ("ค่าเทอมเท่าไร", "5,000 บาท")])
+
+    assert system.best_question(np.array([0.97, 0.80]), threshold=0.95, margin=0.03) == 0
+
+
+def test_below_threshold_is_not_answered():
+    system = _system([("ย้ายเข้าต้องทำอย่างไร", "ยื่นคำร้องย้ายเข้า"), ("ค่าเทอมเท่าไร", "5,000 บาท")])
+
+    assert system.best_question(np.array([0.93, 0.80]), threshold=0.95, margin=0.03) is None
+
+
+def test_close_runner_up_with_a_different_answer_goes_to_normal_search():
+    system = _system([("ย้ายเข้าต้องทำอย่างไร", "ยื่นคำร้องย้ายเข้า"), ("ย้ายออกต้องทำอย่างไร", "ยื่นคำร้องย้ายออก")])
+
+    assert system.best_question(np.array([0.97, 0.96]), threshold=0.95, margin=0.03) is None
+
+
+def test_close_runner_up_with_the_same_answer_is_still_answered():
+    system = _system([("ย้ายเข้าต้องทำอย่างไร", "ยื่นคำร้องย้ายเข้า"), ("ขอย้ายเข้าทำยังไง", "ยื่นคำร้องย้ายเข้า")])
+
+    assert system.best_question(np.array([0.97, 0.96]), threshold=0.95, margin=0.03) == 0
@@ -0,0 +1,82 @@
+import hashlib
+import json
+import os
+
+import numpy as np
+
+from rag import RAGSystem
+
+
+class _Encoder:
+    name = "fake"
+    cache_id = "fake-encoder"
+    tokenizer = None
+
+    def encode(self, texts, batch_size=32, convert_to_numpy=True, normalize_embeddings=True):
+        single = isinstance(texts, str)
+        rows = []
+        for text in [texts] if single else texts:
+            seed = int.from_bytes(hashlib.sha256(text.encode('utf-8')).digest()[:4], 'little')
+            row = np.random.default_rng(seed).standard_normal(16).astype('float32')
+            rows.append(row / np.linalg.norm(row))
+        return rows[0] if single else np.vstack(rows)
+
+    def get_sentence_embedding_dimension(self):
+        return 16
+
+
+def _system(tmp_path, encoded):
+    system = RAGSystem(encoder=_Encoder())
+    system.cache_dir = str(tmp_path)
+    encode_texts = system._encode_texts
+    system._encode_texts = lambda texts: encoded.append(len(texts)) or encode_texts(texts)
+    return system
+
+
+def _manifest_path(tmp_path):
+    for root, _, files in os.walk(tmp_path):
+        if 'manifest.json' in files:
+            return os.path.join(root, 'manifest.json')
+
+
+def test_questions_are_encoded_once_per_build(tmp_path):
+    encoded = []
+
+    system = _system(tmp_path, encoded)
+    assert system.load_documents(None)
+
+    assert len(system.question_ids) > 0
+    assert sum(encoded) == len(system.question_ids)
+
+
+def test_rebuild_reuses_cached_question_embeddings(tmp_path):
+    first = _system(tmp_path, [])
+    assert first.load_documents(None)
+    expected = np.asarray(first.question_embeddings).copy()
+
+    # ให้ index ทั้งก้อนต้องสร้างใหม่ทั้งที่ไฟล์ข้อมูลไม่เปลี่ยน
+    path = _manifest_path(tmp_path)
+    with open(path, 'r', encoding='utf-8') as f:
+        manifest = json.load(f)
+    manifest['corpus_key'] = 'stale'
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f)
+
+    encoded = []
+    second = _system(tmp_path, encoded)
+    assert second.load_documents(None)
+
+    assert encoded == []
+    np.testing.assert_array_equal(np.asarray(second.question_embeddings), expected)
+    assert second.question_ids.tolist() == first.question_ids.tolist()
+
+
+def test_questions_are_not_encoded_again_when_mapping_fails(tmp_path):
+    encoded = []
+    system = _system(tmp_path, encoded)
+    system._load_mapped = lambda *args, **kwargs: False
+
+    assert system.load_documents(None)
+
+    assert sum(encoded) == len(system.question_ids)
+    assert system.question_embeddings is not None
@@ -0,0 +1,26 @@
+from types import SimpleNamespace
+
+import numpy as np
+
+import retriever
+from query_cache import QueryEmbeddingCache, cache_entries
+
+
+def _system(encoder):
+    return SimpleNamespace(encoder=encoder, query_cache=QueryEmbeddingCache(8), corpus_version="abc",
+                           documents=[], index_config={})
+
+
+def test_query_cache_gauge_follows_the_carried_over_cache(monkeypatch):
+    monkeypatch.setattr(retriever, "rag_system", None)
+    encoder = object()
+    first = _system(encoder)
+    retriever._activate(first, 0.1)
+    first.query_cache.put("ย้ายเข้า", np.ones(4))
+
+    # ระบบที่ reload สร้าง cache ใหม่ไว้ แต่จะใช้ cache เดิมแทนเพราะ encoder เดียวกัน
+    second = _system(encoder)
+    retriever._activate(second, 0.1)
+
+    assert second.query_cache is first.query_cache
+    assert cache_entries.value() == 1
@@ -0,0 +1,43 @@
+import os
+
+import numpy as np
+
+from semantic_cache import SemanticCache
+
+
+def _vector(i, dimension=8):
+    vector = np.zeros(dimension, dtype='float32')
+    vector[i % dimension] = 1.0
+    return vector
+
+
+def test_zero_size_disables_the_cache():
+    cache = SemanticCache(max_size=0)
+
+    cache.store("ย้ายเข้า", _vector(0), "ยื่นคำร้อง", [], "v1")
+
+    assert cache.lookup(_vector(0), "v1") is None
+
+
+def test_saved_cache_is_loaded_back(tmp_path):
+    path = str(tmp_path / "semantic_cache")
+    cache = SemanticCache(max_size=4, persist_path=path)
+    for i in range(3):
+        cache.store(f"คำถาม {i}", _vector(i), f"คำตอบ {i}", [], "v1")
+    cache.save()
+
+    assert not [name for name in os.listdir(tmp_path) if name.endswith('.tmp')]
+    loaded = SemanticCache(max_size=4, persist_path=path)
+    assert loaded.lookup(_vector(1), "v1")['answer'] == "คำตอบ 1"
+
+
+def test_mismatched_files_start_empty(tmp_path):
+    path = str(tmp_path / "semantic_cache")
+    cache = SemanticCache(max_size=4, persist_path=path)
+    cache.store("คำถาม", _vector(0), "คำตอบ", [], "v1")
+    cache.save()
+    np.save(path + '.npy', np.zeros((3, 8), dtype='float32'))
+
+    loaded = SemanticCache(max_size=4, persist_path=path)
+
+    assert loaded.lookup(_vector(0), "v1") is None
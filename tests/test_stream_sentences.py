@@ -0,0 +1,35 @@
+from ollama_client import join_chunks, stream_sentences
+
+
+def _tokens(text, size=3):
+    return [text[i:i + size] for i in range(0, len(text), size)]
+
+
+def test_joined_chunks_give_back_the_original_text():
+    text = ("สวัสดีค่ะ มีอะไรให้ช่วยไหมคะ ยินดีให้บริการค่ะ! การย้ายเข้าต้องยื่นคำร้องที่สำนักงาน.\n\n"
+            "เอกสารที่ใช้ได้แก่ สำเนาทะเบียนบ้าน และบัตรประชาชน ") * 4
+
+    chunks = list(stream_sentences(_tokens(text), min_chars=20, max_chars=60))
+
+    assert len(chunks) > 1
+    assert "".join(chunks) == text
+    assert join_chunks(chunks) == text.strip()
+
+
+def test_forced_cut_falls_back_to_the_last_whitespace():
+    words = ["word%02d" % i for i in range(40)]
+    text = "-".join(words[:10]) + " " + "-".join(words[10:])
+
+    # ช่องว่างเดียวอยู่ก่อน min_chars จึงไม่มีจุดตัดประโยคให้ใช้ ต้องตัดแบบบังคับ
+    chunks = list(stream_sentences(_tokens(text), min_chars=80, max_chars=100))
+
+    assert "".join(chunks) == text
+    assert chunks[0] == "-".join(words[:10]) + " "
+
+
+def test_forced_cut_without_whitespace_keeps_the_limit():
+    text = "ก" * 250
+
+    chunks = list(stream_sentences(_tokens(text), min_chars=10, max_chars=100))
+
+    assert [len(chunk) for chunk in chunks] == [100, 100, 50]
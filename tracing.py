@@ -0,0 +1,114 @@
+import functools
+import logging
+import os
+import threading
+import time
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# วัดเวลาแต่ละขั้นตอนของคำขอ (ปิดได้ เมื่อปิดจะเหลือเพียงการเรียกฟังก์ชันที่ไม่ทำอะไร)
+TRACING_ENABLED = os.getenv("TRACING_ENABLED", "true").lower() == "true"
+# เขียน log สรุปเวลาแต่ละขั้นตอนเมื่อคำขอใช้เวลาตั้งแต่ค่านี้ (ms) ขึ้นไป (-1 = ไม่เขียน)
+TRACE_LOG_MIN_MS = float(os.getenv("TRACE_LOG_MIN_MS", "1000"))
+
+stage_seconds = metrics.histogram("stage_duration_seconds", "Time spent in each request stage")
+request_seconds = metrics.histogram("request_duration_seconds", "End-to-end time of a traced request")
+
+_local = threading.local()
+
+
+class _NoopSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+_NOOP = _NoopSpan()
+
+
+class Span:
+    """Times one stage and records it in stage_duration_seconds and the current trace"""
+
+    __slots__ = ("stage", "start")
+
+    def __init__(self, stage: str):
+        self.stage = stage
+        self.start = 0.0
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        record(self.stage, time.perf_counter() - self.start)
+        return False
+
+
+class Trace:
+    """
+    Root of a request: collects the spans finished on this thread and
+    logs a per-stage breakdown when the request was slow.
+    """
+
+    __slots__ = ("name", "start", "_parent")
+
+    def __init__(self, name: str):
+        self.name = name
+        self.start = 0.0
+        self._parent = None
+
+    def __enter__(self):
+        self._parent = getattr(_local, "spans", None)
+        _local.spans = []
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        elapsed = time.perf_counter() - self.start
+        spans, _local.spans = _local.spans, self._parent
+        outcome = "error" if exc_type else "ok"
+        request_seconds.observe(elapsed, name=self.name, outcome=outcome)
+        if 0 <= TRACE_LOG_MIN_MS <= elapsed * 1000:
+            breakdown = " ".join(f"{stage}={duration * 1000:.0f}ms" for stage, duration in spans)
+            logger.info(f"trace {self.name} {elapsed * 1000:.0f}ms ({outcome}): {breakdown}")
+        return False
+
+
+def record(stage: str, seconds: float):
+    """บันทึกขั้นตอนที่วัดเวลาเอง (เช่น ช่วงที่คร่อม yield ของ generator หรือเวลาที่ server รายงานมา)"""
+    if not TRACING_ENABLED:
+        return
+    stage_seconds.observe(seconds, stage=stage)
+    spans = getattr(_local, "spans", None)
+    if spans is not None:
+        spans.append((stage, seconds))
+
+
+def span(stage: str):
+    """with span("encode"): ... วัดเวลาขั้นตอนหนึ่ง"""
+    return Span(stage) if TRACING_ENABLED else _NOOP
+
+
+def trace(name: str):
+    """with trace("handle_message"): ... ขอบเขตของหนึ่งคำขอ"""
+    return Trace(name) if TRACING_ENABLED else _NOOP
+
+
+def traced(stage: str):
+    """Decorator ที่วัดเวลาทั้งฟังก์ชันเป็น span ชื่อ stage"""
+    def decorator(func):
+        if not TRACING_ENABLED:
+            return func
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with Span(stage):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
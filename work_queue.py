@@ -0,0 +1,81 @@
+import logging
+import os
+import queue
+import threading
+import time
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+queue_depth = metrics.gauge("webhook_queue_depth", "Events waiting in the webhook work queue")
+queue_wait_seconds = metrics.histogram("webhook_queue_wait_seconds", "Time an event waited before a worker picked it up")
+queue_process_seconds = metrics.histogram("webhook_queue_process_seconds", "Time a worker spent on one event")
+queue_enqueued_total = metrics.counter("webhook_queue_enqueued_total", "Events accepted into the work queue")
+queue_rejected_total = metrics.counter("webhook_queue_rejected_total", "Events rejected because the queue was full")
+queue_failed_total = metrics.counter("webhook_queue_failed_total", "Events whose handler raised an exception")
+
+
+class WorkQueue:
+    """Bounded in-process queue served by a fixed pool of worker threads"""
+
+    def __init__(self, workers=4, max_size=100, enqueue_timeout=0.5, name="webhook"):
+        self.name = name
+        self.workers = workers
+        self.max_size = max_size
+        self.enqueue_timeout = enqueue_timeout
+        self._queue = queue.Queue(maxsize=max_size)
+        self._threads = []
+        self._pid = None
+        self._start_lock = threading.Lock()
+        queue_depth.set_function(self._queue.qsize)
+
+    def _ensure_started(self):
+        # เริ่ม worker เมื่อใช้งานครั้งแรก thread ที่สร้างก่อน fork (gunicorn --preload) จะไม่ติดไปกับ worker process
+        if self._pid == os.getpid():
+            return
+        with self._start_lock:
+            if self._pid == os.getpid():
+                return
+            self._queue = queue.Queue(maxsize=self.max_size)
+            queue_depth.set_function(self._queue.qsize)
+            self._threads = []
+            for i in range(self.workers):
+                thread = threading.Thread(target=self._worker, name=f"{self.name}-worker-{i}", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+            self._pid = os.getpid()
+            logger.info(f"Started {self.workers} {self.name} workers (queue size {self.max_size})")
+
+    def submit(self, func, *args):
+        """
+        ใส่งานลงคิว หากคิวเต็มจะรอไม่เกิน enqueue_timeout วินาที
+        คืนค่า False เมื่อคิวเต็ม (backpressure) เพื่อให้ผู้เรียกตัดสินใจเอง
+        """
+        self._ensure_started()
+        try:
+            self._queue.put((func, args, time.monotonic()), timeout=self.enqueue_timeout)
+        except queue.Full:
+            queue_rejected_total.inc()
+            logger.warning(f"{self.name} queue is full, rejecting task")
+            return False
+        queue_enqueued_total.inc()
+        return True
+
+    def depth(self):
+        return self._queue.qsize()
+
+    def _worker(self):
+        work = self._queue
+        while True:
+            func, args, enqueued_at = work.get()
+            started = time.monotonic()
+            queue_wait_seconds.observe(started - enqueued_at)
+            try:
+                func(*args)
+            except Exception as e:
+                queue_failed_total.inc()
+                logger.error(f"Error in {self.name} worker: {str(e)}")
+            finally:
+                queue_process_seconds.observe(time.monotonic() - started)
+                work.task_done()